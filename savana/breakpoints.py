@@ -6,6 +6,10 @@ Hillary Elrick
 """
 #!/usr/bin/env python3
 
+import os
+import shutil
+
+from time import time
 from statistics import median
 import pysam
 import numpy as np
@@ -13,10 +17,14 @@ import numpy as np
 from math import floor, ceil
 
 import savana.helper as helper
-from savana.core import PotentialBreakpoint, ConsensusBreakpoint, Cluster
+import savana.checkpoint as checkpoint
+from savana.core import PotentialBreakpoints, ConsensusBreakpoint, Cluster
+
+# alignment files opened once per worker process by init_alignment_worker (by filename)
+worker_aln_files = {}
 
-def get_supplementary_breakpoints(read, cigar_tuples, chimeric_regions, label, contig_order):
-	""" reconstruct the breakpoints from the supplementary alignments """
+def get_supplementary_breakpoints(read, cigar_tuples, chimeric_regions, label, contig_order, potential_breakpoints):
+	""" reconstruct the breakpoints from the supplementary alignments and add them to the potential breakpoints """
 	primary_clipping = helper.get_clipping(cigar_tuples, read.is_reverse)
 	breakpoint_pairs = []
 	# sort the chimeric regions by the left soft clip pos (ascending)
@@ -100,20 +108,37 @@ def get_supplementary_breakpoints(read, cigar_tuples, chimeric_regions, label, c
 				}])
 			right_index+=1
 	# once all pairs completed, create breakpoints for each edge
-	supplementary_breakpoints = []
 	for start, end in breakpoint_pairs:
 		if start['chr'] not in contig_order or end['chr'] not in contig_order:
 			continue
 		if start['chr'] == end['chr']:
 			if start['loc'] < end['loc']:
-				supplementary_breakpoints.append(PotentialBreakpoint([start, end], "SUPP", read.query_name, read.mapping_quality, label, "".join((start['bp_notation'], end['bp_notation']))))
+				potential_breakpoints.append([start, end], "SUPP", read.query_name, read.mapping_quality, label, "".join((start['bp_notation'], end['bp_notation'])))
 			else:
-				supplementary_breakpoints.append(PotentialBreakpoint([end, start], "SUPP", read.query_name, read.mapping_quality, label, "".join((end['bp_notation'], start['bp_notation']))))
+				potential_breakpoints.append([end, start], "SUPP", read.query_name, read.mapping_quality, label, "".join((end['bp_notation'], start['bp_notation'])))
 		elif contig_order.index(start['chr']) <= contig_order.index(end['chr']):
-			supplementary_breakpoints.append(PotentialBreakpoint([start, end], "SUPP", read.query_name, read.mapping_quality, label, "".join((start['bp_notation'], end['bp_notation']))))
+			potential_breakpoints.append([start, end], "SUPP", read.query_name, read.mapping_quality, label, "".join((start['bp_notation'], end['bp_notation'])))
 		elif start['loc'] < end['loc']:
-			supplementary_breakpoints.append(PotentialBreakpoint([end, start], "SUPP", read.query_name, read.mapping_quality, label, "".join((end['bp_notation'], start['bp_notation']))))
-	return supplementary_breakpoints
+			potential_breakpoints.append([end, start], "SUPP", read.query_name, read.mapping_quality, label, "".join((end['bp_notation'], start['bp_notation'])))
+
+def open_alignment_file(aln_filename, is_cram, ref):
+	""" open an alignment file for reading (CRAMs are decoded using the shared reference cache if ref is None) """
+	if is_cram:
+		return pysam.AlignmentFile(aln_filename, "rc", reference_filename=ref)
+	return pysam.AlignmentFile(aln_filename, "rb")
+
+def init_alignment_worker(aln_filenames, is_cram, ref, ref_cache=None):
+	""" open the alignment files once when a worker starts so its tasks can fetch from them (decoding CRAMs from ref_cache if given) """
+	global worker_aln_files
+	if ref_cache:
+		helper.use_ref_cache(ref_cache)
+	worker_aln_files = {aln_filename: open_alignment_file(aln_filename, is_cram, ref) for aln_filename in aln_filenames}
+
+def get_alignment_file(aln_filename, is_cram, ref):
+	""" return the alignment file opened by this worker (or a newly opened one) and whether it belongs to the worker """
+	if aln_filename in worker_aln_files:
+		return worker_aln_files[aln_filename], True
+	return open_alignment_file(aln_filename, is_cram, ref), False
 
 def count_num_labels(source_breakpoints):
 	""" given a list of unique breakpoints, return the counts for each label """
@@ -130,17 +155,47 @@ def count_num_labels(source_breakpoints):
 
 	return label_counts
 
-def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=None, start=None, end=None):
-	""" iterate through alignment file, tracking potential breakpoints and saving relevant reads to fastq """
-	potential_breakpoints = {}
-	if args.is_cram:
-		aln_file = pysam.AlignmentFile(aln_filename, "rc", reference_filename=args.ref)
-	else:
-		aln_file = pysam.AlignmentFile(aln_filename, "rb")
+def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=None, start=None, end=None, owned_from=None, owned_until=None, can_split=None, checkpoint_chunk=True):
+	"""
+	iterate through alignment file, tracking potential breakpoints and saving relevant reads to fastq
+	- owned_from: only consider reads starting from this position (those starting before it belong to a previous chunk)
+	- owned_until: only consider reads ending by this position (those ending after it belong to a region already read)
+	- can_split: given the seconds spent so far, whether to stop and return the position the chunk was split at (None if finished)
+	- checkpoint_chunk: re-use/store the chunk's checkpoint (pieces of a split chunk are stored together once all are done)
+	"""
+	if args.checkpoint_dir and checkpoint_chunk:
+		# re-use the potential breakpoints of a chunk finished by a previous run
+		checkpointed = checkpoint.load_potential_breakpoints(args.checkpoint_dir, label, chrom, start, end)
+		if checkpointed and (not args.coverage_dir or checkpointed[1] is not None):
+			potential_breakpoints, read_bounds = checkpointed
+			if args.coverage_dir:
+				write_read_bounds(args.coverage_dir, label, chrom, start, read_bounds[0], read_bounds[1])
+			return potential_breakpoints, None
+	potential_breakpoints = PotentialBreakpoints(contig_order)
+	aln_file, is_worker_file = get_alignment_file(aln_filename, args.is_cram, None if args.ref_cache else args.ref)
 	# adjust the thresholds depending on sample source
 	args_length = max((args.length - floor(args.length/5)), 0) if label == 'normal' else args.length
 	mapq = min((args.mapq - ceil(args.mapq/2)), 1) if label == 'normal' else args.mapq
+	# track read boundaries for local depth (only reads starting in this chunk)
+	read_starts, read_ends = [], []
+	start_time = time()
+	split_at = None
+	last_start = start if start else 0
 	for read in aln_file.fetch(chrom, start, end):
+		if owned_from is not None and read.reference_start < owned_from:
+			continue # counted by a previous chunk
+		if owned_until is not None and read.reference_end > owned_until:
+			continue # counted by the region it extends into
+		if can_split and read.reference_start > last_start:
+			if can_split(time() - start_time):
+				# taking too long, leave the reads starting from here for the remainder of the chunk
+				split_at = read.reference_start
+				break
+			last_start = read.reference_start
+		if args.coverage_dir and not (read.mapping_quality == 0 or read.is_duplicate):
+			if start is None or read.reference_start >= start:
+				read_starts.append(read.reference_start)
+				read_ends.append(read.reference_end)
 		if read.is_secondary or read.is_supplementary:
 			continue # only consider primary
 		if read.mapping_quality < mapq:
@@ -153,9 +208,7 @@ def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=Non
 		cigar_tuples = read.cigartuples
 		chimeric_regions = helper.get_chimeric_regions(read, mapq)
 		if chimeric_regions:
-			chimeric_breakpoints = get_supplementary_breakpoints(read, cigar_tuples, chimeric_regions, label, contig_order)
-			for bp in chimeric_breakpoints:
-				potential_breakpoints.setdefault(bp.start_chr,[]).append(bp)
+			get_supplementary_breakpoints(read, cigar_tuples, chimeric_regions, label, contig_order, potential_breakpoints)
 		# look for insertions and deletions in the CIGAR
 		curr_chrom = read.reference_name
 		prev_deletion = []
@@ -168,11 +221,11 @@ def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=Non
 				]
 				if prev_deletion:
 					# record and clear the previously tracked deletion
-					potential_breakpoints.setdefault(curr_chrom,[]).append(PotentialBreakpoint(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-"))
+					potential_breakpoints.append(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-")
 					prev_deletion = []
 				# record the insertion
 				inserted_sequence = read.query_sequence[curr_pos['query']:(curr_pos['query']+length)]
-				potential_breakpoints.setdefault(curr_chrom,[]).append(PotentialBreakpoint(location, "INS", read.query_name, read.mapping_quality, label, "<INS>", inserted_sequence))
+				potential_breakpoints.append(location, "INS", read.query_name, read.mapping_quality, label, "<INS>", inserted_sequence)
 			elif sam_flag == helper.samflag_desc_to_number["BAM_CDEL"] and length > args_length:
 				# deletion has one breakpoint (read->read)
 				if prev_deletion:
@@ -185,7 +238,7 @@ def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=Non
 					]
 			elif prev_deletion and length > args_length:
 				# record and clear the previously tracked deletion
-				potential_breakpoints.setdefault(curr_chrom,[]).append(PotentialBreakpoint(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-"))
+				potential_breakpoints.append(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-")
 				prev_deletion = []
 			# increment values
 			curr_pos['cigar'] += length
@@ -195,49 +248,128 @@ def get_potential_breakpoints(aln_filename, args, label, contig_order, chrom=Non
 				curr_pos['reference'] += length
 		if prev_deletion:
 			# if reached end of string and no chance to expand deletion, add it
-			potential_breakpoints.setdefault(curr_chrom,[]).append(PotentialBreakpoint(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-"))
+			potential_breakpoints.append(prev_deletion, "DEL", read.query_name, read.mapping_quality, label, "+-")
+
+	if not is_worker_file:
+		aln_file.close()
+	if split_at is not None:
+		# what was processed is the chunk up to the split
+		start, end = (start if start else 0), split_at
+	potential_breakpoints.consolidate()
+	read_bounds = None
+	if args.coverage_dir:
+		read_bounds = write_read_bounds(args.coverage_dir, label, chrom, start, read_starts, read_ends)
+	if args.checkpoint_dir and checkpoint_chunk and split_at is None:
+		checkpoint.save_potential_breakpoints(args.checkpoint_dir, label, chrom, start, end, potential_breakpoints, read_bounds)
 
-	aln_file.close()
+	return potential_breakpoints, split_at
+
+def get_read_bounds(aln_file, chrom, start, end):
+	""" return sorted arrays of the starts and ends of reads counted towards local depth """
+	read_starts = []
+	read_ends = []
+	for read in aln_file.fetch(chrom, start, end):
+		if read.mapping_quality == 0 or read.is_duplicate:
+			continue
+		read_starts.append(read.reference_start)
+		read_ends.append(read.reference_end)
+	read_starts = np.sort(np.array(read_starts, dtype=np.int64))
+	read_ends = np.sort(np.array(read_ends, dtype=np.int64))
+
+	return read_starts, read_ends
+
+def get_split_read_loci(aln_filename, args, chrom, start, end):
+	""" return the loci (chrom, position) of the other alignments of reads with a supplementary alignment in a region """
+	aln_file, is_worker_file = get_alignment_file(aln_filename, args.is_cram, None if args.ref_cache else args.ref)
+	loci = set()
+	for read in aln_file.fetch(chrom, start, end):
+		if not read.is_supplementary or not read.has_tag('SA'):
+			continue # the primary alignment of the read is in the region
+		for supp_alignment in read.get_tag('SA').rstrip(';').split(';'):
+			sa_chrom, sa_pos = supp_alignment.split(',')[:2]
+			loci.add((sa_chrom, int(sa_pos) - 1))
+	if not is_worker_file:
+		aln_file.close()
 
-	return potential_breakpoints
+	return sorted(loci)
 
-def add_local_depth(intervals, aln_filenames, is_cram, ref):
-	""" given intervals and uids, get the local depth for each interval """
+def write_read_bounds(coverage_dir, label, chrom, start, read_starts, read_ends):
+	""" store the sorted read starts/ends of a chunk to be merged once all chunks are done """
+	chunk_dir = os.path.join(coverage_dir, label, chrom)
+	os.makedirs(chunk_dir, exist_ok=True)
+	read_bounds = np.vstack([
+		np.sort(np.array(read_starts, dtype=np.int64)),
+		np.sort(np.array(read_ends, dtype=np.int64))
+	])
+	np.save(os.path.join(chunk_dir, f'{start if start else 0}.npy'), read_bounds)
+
+	return read_bounds
+
+def load_chunk_read_bounds(coverage_dir, label, chrom, starts):
+	""" return the combined read starts/ends stored for chunks of a chromosome (by their starts) """
+	chunk_dir = os.path.join(coverage_dir, label, chrom)
+	chunks = [np.load(os.path.join(chunk_dir, f'{start}.npy')) for start in starts]
+
+	return np.sort(np.concatenate(chunks, axis=1), axis=1)
+
+def merge_read_bounds(coverage_dir):
+	""" combine the chunks of read starts/ends into one sorted file per label and chromosome """
+	for label in os.listdir(coverage_dir):
+		label_dir = os.path.join(coverage_dir, label)
+		for chrom in os.listdir(label_dir):
+			chunk_dir = os.path.join(label_dir, chrom)
+			if not os.path.isdir(chunk_dir):
+				continue
+			chunks = [np.load(os.path.join(chunk_dir, f)) for f in os.listdir(chunk_dir)]
+			read_bounds = np.sort(np.concatenate(chunks, axis=1), axis=1)
+			np.save(os.path.join(label_dir, f'{chrom}.npy'), read_bounds)
+			shutil.rmtree(chunk_dir)
+
+def has_read_bounds(coverage_dir, label):
+	""" whether the read starts/ends of a label were recorded in the coverage store """
+	return bool(coverage_dir) and os.path.isdir(os.path.join(coverage_dir, label))
+
+def load_read_bounds(coverage_dir, label, chrom):
+	""" return the sorted read starts/ends of a chromosome from the coverage store """
+	coverage_file = os.path.join(coverage_dir, label, f'{chrom}.npy')
+	if not os.path.isfile(coverage_file):
+		# no reads were recorded on this chromosome
+		return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+	read_bounds = np.load(coverage_file, mmap_mode='r')
+
+	return read_bounds[0], read_bounds[1]
+
+def count_overlapping_reads(read_starts, read_ends, interval_starts, interval_ends):
+	""" given sorted read starts/ends, count the reads overlapping each interval """
+	# a read overlaps if it starts before the interval ends and doesn't end before it starts
+	# (every read ending before the interval start also starts before the interval end)
+	starting_before_end = np.searchsorted(read_starts, interval_ends, side='right')
+	ending_before_start = np.searchsorted(read_ends, interval_starts, side='left')
+
+	return starting_before_end - ending_before_start
+
+def add_local_depth(intervals, aln_filenames, is_cram, ref, coverage_dir=None):
+	""" given intervals and uids, get the local depth for each interval (from coverage store if given and the label is in it) """
 	uid_dp_dict = {}
 	chrom = intervals[0][0]
 	start = max(int(intervals[0][1])-1, 0) # first start
 	end = int(intervals[-1][2]) # last end
-	read_stats = {}
+	interval_starts = np.array([int(i[1]) for i in intervals], dtype=np.int64)
+	interval_ends = np.array([int(i[2]) for i in intervals], dtype=np.int64)
 	for file_type, aln_filename in aln_filenames.items():
-		if is_cram:
-			aln_file = pysam.AlignmentFile(aln_filename, "rc", reference_filename=ref)
+		if has_read_bounds(coverage_dir, file_type):
+			read_starts, read_ends = load_read_bounds(coverage_dir, file_type, chrom)
+			# only count reads that fetching the window from the alignment file would return
+			depths = count_overlapping_reads(read_starts, read_ends, interval_starts, np.minimum(interval_ends, end-1))
 		else:
-			aln_file = pysam.AlignmentFile(aln_filename, "rb")
-		read_stats[file_type] = []
-		for read in aln_file.fetch(chrom, start, end):
-			if read.mapping_quality == 0 or read.is_duplicate:
-				continue
-			read_stats[file_type].append([int(read.reference_start), int(read.reference_end), read.query_name])
-			del read
-		aln_file.close()
-		del aln_file
-	for i in intervals:
-		uid = i[3]
-		interval_start = int(i[1])
-		interval_end = int(i[2])
-		edge = int(i[4])
-		for file_type, reads in read_stats.items():
-			comparison = [[(interval_start - r[1]), (r[0] - interval_end)] for r in reads]
-			dp = sum(1 for x,y in comparison if x <= 0 and y <= 0)
-			del comparison
-			# for some reason, these methods aren't faster
-			'''
-			comparison = [[(interval_start <= r[1]), (r[0] <= interval_end)] for r in reads]
-			dp = sum(1 for x,y in comparison if x and y)
-			del comparison
-			'''
-			# nor
-			#dp = sum(1 for r in reads if (interval_start - r[1]) <= 0 and (r[0] - interval_end) <= 0)
+			aln_file, is_worker_file = get_alignment_file(aln_filename, is_cram, ref)
+			read_starts, read_ends = get_read_bounds(aln_file, chrom, start, end)
+			if not is_worker_file:
+				aln_file.close()
+			depths = count_overlapping_reads(read_starts, read_ends, interval_starts, interval_ends)
+		for i, dp in zip(intervals, depths):
+			uid = i[3]
+			edge = int(i[4])
 			if uid not in uid_dp_dict:
 				uid_dp_dict[uid] = {}
 			if file_type not in uid_dp_dict[uid]:
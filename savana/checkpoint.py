@@ -0,0 +1,183 @@
+"""
+Module containing functions to checkpoint and resume the stages of a SAVANA run
+"""
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import pickle
+import shutil
+import hashlib
+
+import numpy as np
+
+from argparse import Namespace
+
+from savana.core import PotentialBreakpoints
+
+# arguments of the run stored with the checkpoints (to re-call from the cached potential breakpoints)
+run_arguments = ['tumour', 'normal', 'ref', 'ref_index', 'contigs', 'length', 'mapq', 'buffer', 'insertion_buffer', 'depth', 'sample', 'is_cram', 'targeted_normal']
+
+# stages in the order they're run, with the arguments each one depends on (cumulatively)
+stage_arguments = {
+	'potential_breakpoints': ['tumour', 'normal', 'ref', 'contigs', 'length', 'mapq', 'targeted_normal'],
+	'clusters': ['buffer', 'insertion_buffer'],
+	'consensus_breakpoints': ['depth', 'debug'],
+	'local_depths': []
+}
+
+def get_file_signature(filename):
+	""" identify a file by its path, size and modification time """
+	if not filename or not os.path.isfile(filename):
+		return filename
+	stat = os.stat(filename)
+	return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+def get_stage_hashes(args):
+	""" hash the inputs and parameters that each stage depends on """
+	stage_hashes = {}
+	hashed_values = []
+	for stage, arguments in stage_arguments.items():
+		for arg in arguments:
+			value = getattr(args, arg, None)
+			if arg in ('tumour', 'normal', 'ref', 'contigs'):
+				value = get_file_signature(value)
+			elif arg == 'targeted_normal' and value:
+				# the normal is only read around the tumour clusters (found with the buffers)
+				value = [getattr(args, 'buffer', None), getattr(args, 'insertion_buffer', None)]
+			hashed_values.append([arg, value])
+		stage_hashes[stage] = hashlib.sha256(json.dumps(hashed_values).encode()).hexdigest()
+
+	return stage_hashes
+
+def read_manifest(checkpoint_dir):
+	""" return the manifest of stored checkpoints """
+	manifest_file = os.path.join(checkpoint_dir, 'manifest.json')
+	if not os.path.isfile(manifest_file):
+		return {'hashes': {}, 'complete': {}}
+	with open(manifest_file, encoding="utf-8") as f:
+		return json.load(f)
+
+def write_manifest(checkpoint_dir, manifest):
+	""" (atomically) write the manifest of stored checkpoints """
+	manifest_file = os.path.join(checkpoint_dir, 'manifest.json')
+	with open(f'{manifest_file}.tmp', 'w', encoding="utf-8") as f:
+		json.dump(manifest, f, indent=2)
+	os.replace(f'{manifest_file}.tmp', manifest_file)
+
+def clear_stage(checkpoint_dir, stage):
+	""" remove the stored checkpoint(s) of a stage """
+	for path in [os.path.join(checkpoint_dir, stage), os.path.join(checkpoint_dir, f'{stage}.pkl')]:
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		elif os.path.isfile(path):
+			os.remove(path)
+
+def prepare_checkpoint_dir(args):
+	""" create the checkpoint dir, discarding checkpoints which are stale (or all of them if not resuming) """
+	os.makedirs(args.checkpoint_dir, exist_ok=True)
+	manifest = read_manifest(args.checkpoint_dir)
+	stage_hashes = get_stage_hashes(args)
+	stale = not args.resume
+	for stage, stage_hash in stage_hashes.items():
+		# once a stage is stale, so are all the following ones
+		stale = stale or manifest['hashes'].get(stage) != stage_hash
+		if stale:
+			if args.resume and manifest['hashes'].get(stage):
+				print(f'Checkpoint for "{stage}" is stale (inputs or parameters changed) - will be re-run')
+			clear_stage(args.checkpoint_dir, stage)
+			manifest['complete'].pop(stage, None)
+		if stage in ('potential_breakpoints', 'clusters'):
+			os.makedirs(os.path.join(args.checkpoint_dir, stage), exist_ok=True)
+	manifest['hashes'] = stage_hashes
+	manifest['args'] = {arg: getattr(args, arg) for arg in run_arguments}
+	for arg in ('tumour', 'normal', 'ref', 'ref_index', 'contigs'):
+		if manifest['args'][arg]:
+			manifest['args'][arg] = os.path.abspath(manifest['args'][arg])
+	write_manifest(args.checkpoint_dir, manifest)
+
+def load_run_args(checkpoint_dir):
+	""" return the arguments of the run which cached the potential breakpoints (exit if unusable) """
+	manifest = read_manifest(checkpoint_dir)
+	if 'chunks' not in (manifest['complete'].get('potential_breakpoints') or {}):
+		sys.exit(f'No cached potential breakpoints in "{checkpoint_dir}". Run "savana run" with --checkpoint_dir first')
+	run_args = Namespace(**manifest['args'])
+	if get_stage_hashes(run_args)['potential_breakpoints'] != manifest['hashes']['potential_breakpoints']:
+		sys.exit(f'The input files have changed since the potential breakpoints in "{checkpoint_dir}" were cached')
+
+	return run_args
+
+def mark_complete(checkpoint_dir, stage, info=True):
+	""" record that a stage has finished """
+	manifest = read_manifest(checkpoint_dir)
+	manifest['complete'][stage] = info
+	write_manifest(checkpoint_dir, manifest)
+
+def is_complete(checkpoint_dir, stage):
+	""" return the info stored when a stage finished (None if it hasn't) """
+	if not checkpoint_dir:
+		return None
+	return read_manifest(checkpoint_dir)['complete'].get(stage)
+
+def get_chunk_file(checkpoint_dir, label, chrom, start=None, end=None):
+	""" filename of the potential breakpoints of one chunk """
+	chunk = f'{label}_{chrom}' if start is None else f'{label}_{chrom}_{start}_{end}'
+	return os.path.join(checkpoint_dir, 'potential_breakpoints', f'{chunk}.npz')
+
+def save_potential_breakpoints(checkpoint_dir, label, chrom, start, end, potential_breakpoints, read_bounds=None):
+	""" store the potential breakpoints (and read bounds) of a chunk """
+	arrays = potential_breakpoints.to_arrays()
+	if read_bounds is not None:
+		arrays['read_bounds'] = read_bounds
+	chunk_file = get_chunk_file(checkpoint_dir, label, chrom, start, end)
+	with open(f'{chunk_file}.tmp', 'wb') as f:
+		np.savez(f, **arrays)
+	os.replace(f'{chunk_file}.tmp', chunk_file)
+
+def load_potential_breakpoints(checkpoint_dir, label, chrom, start=None, end=None):
+	""" return the stored potential breakpoints and read bounds (if any) of a chunk (None if not stored) """
+	chunk_file = get_chunk_file(checkpoint_dir, label, chrom, start, end)
+	if not os.path.isfile(chunk_file):
+		return None
+	with np.load(chunk_file) as arrays:
+		read_bounds = arrays['read_bounds'] if 'read_bounds' in arrays else None
+		return PotentialBreakpoints.from_arrays(arrays), read_bounds
+
+def load_cached_potential_breakpoints(checkpoint_dir):
+	""" return the potential breakpoints of all chunks (in the order they were identified) """
+	chunks = read_manifest(checkpoint_dir)['complete']['potential_breakpoints']['chunks']
+	stores = [load_potential_breakpoints(checkpoint_dir, *chunk)[0] for chunk in chunks]
+
+	return PotentialBreakpoints.concatenate(stores)
+
+def save_clusters(checkpoint_dir, clusters):
+	""" store the clusters of each chromosome """
+	for chrom, chrom_clusters in clusters.items():
+		save_stage(os.path.join(checkpoint_dir, 'clusters'), chrom, chrom_clusters)
+	mark_complete(checkpoint_dir, 'clusters', list(clusters.keys()))
+
+def load_clusters(checkpoint_dir):
+	""" return the stored clusters of each chromosome (None if the stage didn't finish) """
+	chroms = is_complete(checkpoint_dir, 'clusters')
+	if chroms is None:
+		return None
+	return {chrom: load_stage(os.path.join(checkpoint_dir, 'clusters'), chrom) for chrom in chroms}
+
+def save_stage(checkpoint_dir, stage, result):
+	""" store the result of a stage """
+	stage_file = os.path.join(checkpoint_dir, f'{stage}.pkl')
+	with open(f'{stage_file}.tmp', 'wb') as f:
+		pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(f'{stage_file}.tmp', stage_file)
+
+def load_stage(checkpoint_dir, stage):
+	""" return the stored result of a stage (None if not stored) """
+	stage_file = os.path.join(checkpoint_dir, f'{stage}.pkl')
+	if not checkpoint_dir or not os.path.isfile(stage_file):
+		return None
+	with open(stage_file, 'rb') as f:
+		return pickle.load(f)
+
+if __name__ == "__main__":
+	print("Checkpoint functions for SAVANA")
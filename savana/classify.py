@@ -10,125 +10,98 @@ import os
 
 import pandas as pd
 import numpy as np
-import cyvcf2
 import pickle
 import json
 
 from multiprocessing import Pool
 from functools import partial
-from collections import ChainMap
 
+import savana.helper as helper
 import savana.train as train
-from savana.breakpoints import *
-from savana.clusters import *
-
-def get_info_fields(vcf):
-	""" initialize the data header from INFO fields of sample VCF """
-	fields = []
-	for rec in vcf.header_iter():
-		if rec['HeaderType'] == "INFO":
-			fields.append(rec.info()['ID'])
-
-	return fields
-
-def pool_predict(data_matrix, features_to_drop, model, threads):
-	""" """
-	data_matrices = np.array_split(data_matrix, threads)
-	pool = Pool(threads)
-	results = pool.map(partial(
-		predict,
-		features_to_drop=features_to_drop,
-		model=model
-	), data_matrices)
-	pool.close()
-	pool.join()
-
-	return dict(ChainMap(*results))
+import savana.forest as forest
+from savana.vcf import iter_vcf_batches, read_header, add_header_line, open_vcf_writer, write_record, set_info
+
+# model loaded once per worker process by init_predict_worker
+worker_model = None
+
+def load_model(model_path):
+	""" load a pickled model (or a compact forest exported by train) """
+	if model_path.endswith('.npz'):
+		return forest.load_forest(model_path)
+	with open(model_path, "rb") as model_file:
+		return pickle.load(model_file)
+
+def init_predict_worker(model_path):
+	""" load the model once when a prediction worker starts """
+	global worker_model
+	worker_model = load_model(model_path)
+
+def predict_in_worker(data_matrix, features_to_drop):
+	""" predict using the model loaded by this worker """
+	return predict(data_matrix, features_to_drop, worker_model)
+
+def get_predict_pool(model, model_path, threads):
+	"""
+	set up parallel prediction with the given number of threads:
+	use the estimator's own (threaded) predict if it has one, otherwise a pool of processes that each load the model
+	(e.g. compact forests, which are memory-mapped so shared between workers)
+	"""
+	if hasattr(model, 'get_params') and 'n_jobs' in model.get_params(deep=False):
+		model.set_params(n_jobs=threads)
+		return None
+	if threads <= 1:
+		return None
+	return Pool(threads, initializer=init_predict_worker, initargs=(model_path,))
+
+def pool_predict(data_matrix, features_to_drop, model, threads, pool=None):
+	""" return the predictions of the model (aligned to the rows of the data matrix), split across the pool if provided """
+	if pool is None:
+		return predict(data_matrix, features_to_drop, model)
+	data_matrices = [data_matrix.iloc[indices] for indices in np.array_split(np.arange(len(data_matrix)), threads)]
+	results = pool.map(partial(predict_in_worker, features_to_drop=features_to_drop), data_matrices)
+
+	return np.concatenate(results)
 
 def predict(data_matrix, features_to_drop, model):
 	""" given feautres and a model, return the predictions """
+	if data_matrix.empty:
+		return np.array([], dtype=int)
 	features = data_matrix.drop(features_to_drop, axis=1, errors='ignore')
-	ids = data_matrix['ID']
-	predicted = model.predict(features)
-	prediction_dict = {}
-	for i, value in enumerate(predicted):
-		prediction_dict[ids.iloc[i]] = value
-
-	return prediction_dict
-
-def read_vcf(vcf_path):
-	""" read VCF into a dataframe """
-	data = []
-	input_vcf = cyvcf2.VCF(vcf_path)
-	header = ['ID'] + get_info_fields(input_vcf)
-	for variant in input_vcf:
-		row = [variant.ID]
-		for field in header[1:]:
-			row.append(variant.INFO.get(field))
-		data.append(row)
-	return pd.DataFrame(data, columns = header)
-
-def legacy_pass_strict(variant, event_heuristic):
-	""" apply legacy filter for strict thresholds """
-	if variant['NORMAL_SUPPORT'] > 0:
-		return False
-	if variant['TUMOUR_SUPPORT'] > 7:
-		origin_uncertainty = (variant['ORIGIN_STARTS_STD_DEV']+1) * (variant['ORIGIN_EVENT_SIZE_STD_DEV']+1)
-		end_uncertainty = (variant['END_STARTS_STD_DEV']+1) * (variant['END_EVENT_SIZE_STD_DEV']+1)
-		try:
-			if variant['TUMOUR_SUPPORT'] > 12 and origin_uncertainty <= 15:
-				if event_heuristic <= 0.025:
-					return True
-			elif variant['TUMOUR_SUPPORT'] > 12 and end_uncertainty <= 30:
-				return True
-			elif end_uncertainty <= 10:
-				return True
-		except Exception as e:
-			# in case of None
-			return False
-
-def legacy_pass_lenient(variant, event_heuristic):
-	""" apply legacy filter for lenient thresholds """
-	if variant['TUMOUR_SUPPORT'] == 0:
-		return False
-	elif variant['NORMAL_SUPPORT']/variant['TUMOUR_SUPPORT'] < 0.1:
-		try:
-			if variant['ORIGIN_STARTS_STD_DEV'] < 150 and event_heuristic < 3:
-				if variant['BP_NOTATION'] == "<INS>" and variant['TUMOUR_SUPPORT'] > 25:
-					return True
-				elif variant['BP_NOTATION'] != "<INS>" and variant['TUMOUR_SUPPORT'] > 5:
-					return True
-		except Exception as e:
-			# in case of None for any stat
-			return False
+	if hasattr(model, 'feature_names_in_'):
+		# a batch may not contain every breakpoint notation (one-hot encoded)
+		features = features.reindex(columns=model.feature_names_in_, fill_value=False)
+
+	return model.predict(features)
+
+def legacy_pass_strict(data_matrix, event_heuristic):
+	""" apply legacy filter for strict thresholds, return mask of passing variants """
+	tumour_support = data_matrix['TUMOUR_SUPPORT']
+	origin_uncertainty = (data_matrix['ORIGIN_STARTS_STD_DEV']+1) * (data_matrix['ORIGIN_EVENT_SIZE_STD_DEV']+1)
+	end_uncertainty = (data_matrix['END_STARTS_STD_DEV']+1) * (data_matrix['END_EVENT_SIZE_STD_DEV']+1)
+	# tests are exclusive: a variant meeting the first doesn't fall through to the others
+	first_test = (tumour_support > 12) & (origin_uncertainty <= 15)
+	second_test = ~first_test & (tumour_support > 12) & (end_uncertainty <= 30)
+	third_test = ~first_test & ~second_test & (end_uncertainty <= 10)
+	# missing event heuristic (nan) fails the first test
+	passed = (first_test & (event_heuristic <= 0.025)) | second_test | third_test
+
+	return ~(data_matrix['NORMAL_SUPPORT'] > 0) & (tumour_support > 7) & passed
+
+def legacy_pass_lenient(data_matrix, event_heuristic):
+	""" apply legacy filter for lenient thresholds, return mask of passing variants """
+	tumour_support = data_matrix['TUMOUR_SUPPORT']
+	is_insertion = data_matrix['BP_NOTATION'] == "<INS>"
+	passed = (tumour_support != 0) & (data_matrix['NORMAL_SUPPORT']/tumour_support < 0.1)
+	passed &= (data_matrix['ORIGIN_STARTS_STD_DEV'] < 150) & (event_heuristic < 3)
+	passed &= (is_insertion & (tumour_support > 25)) | (~is_insertion & (tumour_support > 5))
+
+	return passed
 
 def classify_legacy(args, checkpoints, time_str):
 	""" classify using legacy lenient/strict filters """
-	data_matrix = read_vcf(args.vcf)
-	data_matrix = train.format_data(data_matrix)
-	helper.time_function("Loaded raw breakpoints", checkpoints, time_str)
-
-	strict_ids = {}
-	lenient_ids = {}
-	for _, variant in data_matrix.iterrows():
-		if variant['ORIGIN_EVENT_SIZE_MEDIAN'] > 0:
-			event_heuristic = variant['ORIGIN_EVENT_SIZE_STD_DEV']/variant['ORIGIN_EVENT_SIZE_MEDIAN']
-		else:
-			event_heuristic = None
-		# apply filters
-		if legacy_pass_strict(variant, event_heuristic):
-			strict_ids[variant['ID']] = True
-		if legacy_pass_lenient(variant, event_heuristic):
-			lenient_ids[variant['ID']] = True
-
-	input_vcf = cyvcf2.VCF(args.vcf)
+	header = read_header(args.vcf)
 	desc_string = str(f'Variant class prediction from legacy strict/lenient filters {args.model}')
-	input_vcf.add_info_to_header({
-		'ID': 'CLASS',
-		'Type': 'String',
-		'Number': '1',
-		'Description': desc_string
-	})
+	add_header_line(header, f'##INFO=<ID=CLASS,Number=1,Type=String,Description="{desc_string}">')
 	# create filenames based on output
 	if ".vcf" in args.output:
 		strict_vcf_filename = args.output.replace(".vcf", ".strict.vcf")
@@ -136,106 +109,126 @@ def classify_legacy(args, checkpoints, time_str):
 	else:
 		strict_vcf_filename = args.output+".strict.vcf"
 		lenient_vcf_filename = args.output+".lenient.vcf"
-	strict_vcf = cyvcf2.Writer(strict_vcf_filename, input_vcf)
-	lenient_vcf = cyvcf2.Writer(lenient_vcf_filename, input_vcf)
-	for variant in input_vcf:
-		variant_id = variant.ID
-		passed_strict = strict_ids.get(variant_id, None)
-		passed_lenient = lenient_ids.get(variant_id, None)
-		if passed_strict:
-			# update the INFO field if all sanity checks pass
-			variant.INFO['CLASS'] = 'PASSED_SOMATIC_STRICT'
-			# add to the somatic only VCF
-			strict_vcf.write_record(variant)
-		if passed_lenient:
-			# update the INFO field if all sanity checks pass
-			variant.INFO['CLASS'] = 'PASSED_SOMATIC_LENIENT'
-			# add to the somatic only VCF
-			lenient_vcf.write_record(variant)
+	strict_vcf = open_vcf_writer(strict_vcf_filename, header)
+	lenient_vcf = open_vcf_writer(lenient_vcf_filename, header)
+
+	# filter and write the variants a batch at a time
+	for records, data_matrix in iter_vcf_batches(args.vcf):
+		data_matrix = train.format_data(data_matrix)
+		# nan where there is no median event size
+		event_size_median = data_matrix['ORIGIN_EVENT_SIZE_MEDIAN']
+		event_heuristic = data_matrix['ORIGIN_EVENT_SIZE_STD_DEV']/event_size_median.where(event_size_median > 0)
+		# apply filters
+		passed_strict = legacy_pass_strict(data_matrix, event_heuristic).to_numpy()
+		passed_lenient = legacy_pass_lenient(data_matrix, event_heuristic).to_numpy()
+		for record, strict, lenient in zip(records, passed_strict, passed_lenient):
+			if strict:
+				# update the INFO field if all sanity checks pass
+				set_info(record, 'CLASS', 'PASSED_SOMATIC_STRICT')
+				# add to the somatic only VCF
+				write_record(strict_vcf, record)
+			if lenient:
+				# update the INFO field if all sanity checks pass
+				set_info(record, 'CLASS', 'PASSED_SOMATIC_LENIENT')
+				# add to the somatic only VCF
+				write_record(lenient_vcf, record)
 	strict_vcf.close()
 	lenient_vcf.close()
-	input_vcf.close()
 
 	helper.time_function("Output strict/lenient VCFs", checkpoints, time_str)
 
 	return
 
-def filter_with_comparator(variant_value, filter_value, comparator):
-	""" given the variant's value, the filter, and the comparator (min/max), return whether it passes """
-	# cast the filter value to the same type as the variant's value
-	filter_value = type(variant_value)(filter_value)
-	if comparator.upper() == "MAX":
-		if variant_value > filter_value:
-			return False
-	elif comparator.upper() == "MIN":
-		if variant_value < filter_value:
-			return False
-	else:
+def filter_with_comparator(variant_values, filter_value, comparator):
+	""" given the variants' values, the filter, and the comparator (min/max), return mask of those that pass """
+	if comparator.upper() not in ("MAX", "MIN"):
 		raise ValueError(f'Comparator value "{comparator}" unrecognized. Must be one of "MIN" or "MAX"')
-
-	return True
+	if not pd.api.types.is_numeric_dtype(variant_values) or pd.api.types.is_bool_dtype(variant_values):
+		# cast the filter value to the type of each variant's value
+		filter_values = [type(value)(filter_value) for value in variant_values]
+	else:
+		filter_values = float(filter_value)
+	# missing values (nan) never fail
+	if comparator.upper() == "MAX":
+		return ~(variant_values > filter_values)
+	return ~(variant_values < filter_values)
 
 def classify_by_params(args, checkpoints, time_str):
-	#read VCF into a dataframe, classify using a parameter JSON
-	data_matrix = read_vcf(args.vcf)
-	data_matrix = train.format_data(data_matrix)
-	helper.time_function("Loaded raw breakpoints", checkpoints, time_str)
-
+	""" classify using a parameter JSON, filtering and writing the variants a batch at a time """
 	# Read in the if/else statements and apply them
 	filters = None
 	with open(args.custom_params) as json_file:
 		filters = json.load(json_file)
 
-	# create dicts to store the VCF output and passing variants
-	category_dicts = {}
-	input_vcf = cyvcf2.VCF(args.vcf)
+	# create a VCF output for each category
+	category_vcfs = {}
+	header = read_header(args.vcf)
 	desc_string = str(f'Variant class as defined in params JSON {args.custom_params}')
-	input_vcf.add_info_to_header({
-		'ID': 'CLASS',
-		'Type': 'String',
-		'Number': '1',
-		'Description': desc_string
-	})
+	add_header_line(header, f'##INFO=<ID=CLASS,Number=1,Type=String,Description="{desc_string}">')
 	for category in filters.keys():
 		filename = args.output.replace(".vcf", f'.{category}.vcf')
-		category_dicts[category] = {
-			'vcf': cyvcf2.Writer(filename, input_vcf),
-			'passed_ids': {}
-		}
+		category_vcfs[category] = open_vcf_writer(filename, header)
 
-	# use the matrix-representation of the variants to determine which ones pass the filter(s)
-	for i, variant in data_matrix.iterrows():
+	for records, data_matrix in iter_vcf_batches(args.vcf):
+		data_matrix = train.format_data(data_matrix)
+		# use the matrix-representation of the variants to determine which ones pass the filter(s)
+		category_passed = {}
 		for category, filter_dict in filters.items():
-			passed_filters = True
+			passed_filters = pd.Series(True, index=data_matrix.index)
 			for comp_field, filter_value in filter_dict.items():
 				# separate MIN/MAX from field
 				comparator, field = comp_field.split("_", 1)
-				# if fails one filter, set to false
-				passed_filters = False if not filter_with_comparator(variant[field], filter_value, comparator) else passed_filters
-			if passed_filters:
-				category_dicts[category]['passed_ids'][variant['ID']] = True
-
-	# now, write out the vcf(s)
-	for variant in input_vcf:
-		variant_id = variant.ID
-		for category, category_dict in category_dicts.items():
-			if variant_id in category_dict['passed_ids']:
-				variant.INFO['CLASS'] = 'PASSED_'+(category).upper()
-				category_dict['vcf'].write_record(variant)
-
-	for _, category_dict in category_dicts.items():
-		category_dict['vcf'].close()
+				passed_filters &= filter_with_comparator(data_matrix[field], filter_value, comparator)
+			category_passed[category] = passed_filters.to_numpy()
+		# now, write out the batch to the vcf(s)
+		for i, record in enumerate(records):
+			for category, category_vcf in category_vcfs.items():
+				if category_passed[category][i]:
+					set_info(record, 'CLASS', 'PASSED_'+(category).upper())
+					write_record(category_vcf, record)
+
+	for _, category_vcf in category_vcfs.items():
+		category_vcf.close()
 
 	return
 
-def classify_by_model(args, checkpoints, time_str):
-	""" read VCF into a dataframe, classify using a model """
-
-	data_matrix = read_vcf(args.vcf)
-	data_matrix = train.format_data(data_matrix)
-	helper.time_function("Loaded raw breakpoints", checkpoints, time_str)
+def get_model_class(prediction, mate_prediction, tumour_support, normal_support):
+	""" given the model's predictions for a variant and its mate, return its class (after sanity checks) """
+	if prediction == 1 or mate_prediction == 1:
+		# PREDICTED SOMATIC BY MODEL
+		# perform sanity checks
+		if tumour_support < 3:
+			return 'PREDICTED_NOISE'
+		elif tumour_support < normal_support:
+			return 'PREDICTED_NOISE'
+		elif normal_support/tumour_support > 0.1:
+			return 'PREDICTED_NOISE'
+		return 'PREDICTED_SOMATIC'
+	elif prediction == 2 or mate_prediction == 2:
+		# PREDICTED GERMLINE By MODEL
+		# perform sanity checks
+		if (normal_support+tumour_support) <= 3:
+			return 'PREDICTED_NOISE'
+		return 'PREDICTED_GERMLINE'
+
+	return None
+
+def write_model_class(record, variant_class, out_vcf, somatic_vcf=None):
+	""" add the model's class to a record and write it to the output VCF(s) """
+	if variant_class is None:
+		# update the FILTER column
+		record[6] = 'LIKELY_NOISE'
+		variant_class = 'PREDICTED_NOISE'
+	set_info(record, 'CLASS', variant_class)
+	if variant_class == 'PREDICTED_SOMATIC' and somatic_vcf:
+		# add to the somatic only VCF
+		write_record(somatic_vcf, record)
+	write_record(out_vcf, record)
 
-	loaded_model = pickle.load(open(args.model, "rb"))
+def classify_by_model(args, checkpoints, time_str):
+	""" classify using a model, featurising, predicting, and writing the variants a batch at a time """
+	loaded_model = load_model(args.model)
+	pool = get_predict_pool(loaded_model, args.model, args.threads)
 	helper.time_function("Loaded classification model", checkpoints, time_str)
 
 	features_to_drop = [
@@ -244,63 +237,48 @@ def classify_by_model(args, checkpoints, time_str):
 		'ORIGIN_EVENT_SIZE_MEAN', 'ORIGIN_EVENT_SIZE_MEDIAN',
 		'END_EVENT_SIZE_MEAN', 'END_EVENT_SIZE_MEDIAN'
 		]
-	prediction_dict = pool_predict(data_matrix, features_to_drop, loaded_model, 20)
-	helper.time_function("Performed prediction", checkpoints, time_str)
-	# output vcf using modified input_vcf as template
-	input_vcf = cyvcf2.VCF(args.vcf)
+	# output vcf using modified input header as template
+	header = read_header(args.vcf)
 	desc_string = str(f'Variant class prediction from model {args.model}')
-	input_vcf.add_info_to_header({
-		'ID': 'CLASS',
-		'Type': 'String',
-		'Number': '1',
-		'Description': desc_string
-	})
+	add_header_line(header, f'##INFO=<ID=CLASS,Number=1,Type=String,Description="{desc_string}">')
 	desc_string = str(f'Variant filtered as likely noise by model: {args.model}')
-	input_vcf.add_filter_to_header({
-		'ID': 'LIKELY_NOISE',
-		'Description': desc_string
-	})
-	out_vcf = cyvcf2.Writer(args.output, input_vcf)
-	if args.somatic_output:
-		somatic_vcf = cyvcf2.Writer(args.somatic_output, input_vcf)
-	for variant in input_vcf:
-		variant_id = variant.ID
-		variant_prediction = prediction_dict.get(variant_id, None)
-		variant_mate_prediction = prediction_dict.get(variant.INFO.get('MATEID', None), None)
-		if variant_prediction == 1 or variant_mate_prediction == 1:
-			# PREDICTED SOMATIC BY MODEL
-			# perform sanity checks
-			if variant.INFO['TUMOUR_SUPPORT'] < 3:
-				variant.INFO['CLASS'] = 'PREDICTED_NOISE'
-			elif variant.INFO['TUMOUR_SUPPORT'] < variant.INFO['NORMAL_SUPPORT']:
-				variant.INFO['CLASS'] = 'PREDICTED_NOISE'
-			elif variant.INFO['NORMAL_SUPPORT']/variant.INFO['TUMOUR_SUPPORT'] > 0.1:
-				variant.INFO['CLASS'] = 'PREDICTED_NOISE'
-			else:
-				# update the INFO field if all sanity checks pass
-				variant.INFO['CLASS'] = 'PREDICTED_SOMATIC'
-				if args.somatic_output:
-					# add to the somatic only VCF
-					somatic_vcf.write_record(variant)
-		elif variant_prediction == 2 or variant_mate_prediction == 2:
-			# PREDICTED GERMLINE By MODEL
-			# perform sanity checks
-			if (variant.INFO['NORMAL_SUPPORT']+variant.INFO['TUMOUR_SUPPORT']) <= 3:
-				variant.INFO['CLASS'] = 'PREDICTED_NOISE'
-			else:
-				# update the INFO field if sanity check passes
-				variant.INFO['CLASS'] = 'PREDICTED_GERMLINE'
-		else:
-			# update the FILTER column
-			variant.FILTER = 'LIKELY_NOISE'
-			variant.INFO['CLASS'] = 'PREDICTED_NOISE'
-		out_vcf.write_record(variant)
+	add_header_line(header, f'##FILTER=<ID=LIKELY_NOISE,Description="{desc_string}">')
+	out_vcf = open_vcf_writer(args.output, header)
+	somatic_vcf = open_vcf_writer(args.somatic_output, header) if args.somatic_output else None
+
+	# a variant's class can depend on its mate's prediction (which can be in any batch), so write each
+	# batch as it's predicted, only holding the records whose mate hasn't been predicted yet
+	prediction_dict = {}
+	awaiting_mate = {}
+	for records, data_matrix in iter_vcf_batches(args.vcf):
+		data_matrix = train.format_data(data_matrix)
+		predictions = pool_predict(data_matrix, features_to_drop, loaded_model, args.threads, pool)
+		variant_ids = data_matrix['ID'].to_numpy()
+		prediction_dict.update(zip(variant_ids, predictions))
+		# records held for a mate in this batch can now be written
+		for variant_id in variant_ids:
+			for record, awaiting_id, tumour_support, normal_support in awaiting_mate.pop(variant_id, []):
+				variant_class = get_model_class(prediction_dict[awaiting_id], prediction_dict[variant_id], tumour_support, normal_support)
+				write_model_class(record, variant_class, out_vcf, somatic_vcf)
+		for record, variant_id, mate_id, tumour_support, normal_support in zip(records, variant_ids,
+			data_matrix['MATEID'].to_numpy(), data_matrix['TUMOUR_SUPPORT'].to_numpy(), data_matrix['NORMAL_SUPPORT'].to_numpy()):
+			if not pd.isna(mate_id) and mate_id not in prediction_dict:
+				awaiting_mate.setdefault(mate_id, []).append((record, variant_id, tumour_support, normal_support))
+				continue
+			variant_class = get_model_class(prediction_dict[variant_id], prediction_dict.get(mate_id, None), tumour_support, normal_support)
+			write_model_class(record, variant_class, out_vcf, somatic_vcf)
+	if pool:
+		pool.close()
+		pool.join()
+	# mates missing from the VCF
+	for mate_records in awaiting_mate.values():
+		for record, variant_id, tumour_support, normal_support in mate_records:
+			variant_class = get_model_class(prediction_dict[variant_id], None, tumour_support, normal_support)
+			write_model_class(record, variant_class, out_vcf, somatic_vcf)
 	out_vcf.close()
-	if args.somatic_output:
-		# add to the somatic only VCF
+	if somatic_vcf:
 		somatic_vcf.close()
-	input_vcf.close()
-	helper.time_function("Output classified VCF", checkpoints, time_str)
+	helper.time_function("Classified and output VCF", checkpoints, time_str)
 
 	return
 
@@ -13,11 +13,35 @@ from statistics import median, mean
 
 import pysam
 import pybedtools
+import numpy as np
 
-from savana.core import Cluster
+from savana.core import Cluster, PotentialBreakpoints
 
-def cluster_breakpoints(chrom, breakpoints, buffer, ins_buffer):
-	""" given a list of Breakpoints (starting on same chrom) cluster them on location and type """
+def get_reach(potential_breakpoints):
+	""" return how far along the chromosome each potential breakpoint extends a cluster """
+	columns = potential_breakpoints.columns
+	# supp breakpoints are only clustered on their start
+	is_supp = columns['source'] == PotentialBreakpoints.sources.index("SUPP")
+	return np.where(is_supp, columns['start_loc'], columns['end_loc'])
+
+def shard_potential_breakpoints(potential_breakpoints, buffer, ins_buffer, shard_size):
+	""" split PotentialBreakpoints (starting on same chrom) into shards which can be clustered independently """
+	potential_breakpoints.consolidate()
+	if len(potential_breakpoints) <= shard_size:
+		return [potential_breakpoints]
+	rows = np.argsort(potential_breakpoints.columns['start_loc'], kind='stable')
+	starts = potential_breakpoints.columns['start_loc'][rows]
+	max_reach = np.maximum.accumulate(get_reach(potential_breakpoints)[rows])
+	# safe to cut before a breakpoint that starts more than two buffers past all previous ones
+	safe_cuts = np.flatnonzero(starts[1:] > (max_reach[:-1] + 2*max(buffer, ins_buffer))) + 1
+	# cut at the first safe point after each multiple of the shard size
+	targets = np.searchsorted(safe_cuts, np.arange(shard_size, len(rows), shard_size))
+	cuts = np.unique(safe_cuts[targets[targets < len(safe_cuts)]])
+
+	return [potential_breakpoints.select(shard_rows) for shard_rows in np.split(rows, cuts)]
+
+def cluster_breakpoints(chrom, potential_breakpoints, buffer, ins_buffer):
+	""" given PotentialBreakpoints (starting on same chrom) cluster them on location and type """
 	cluster_stacks = {
 		"+-": [],
 		"++": [],
@@ -25,32 +49,37 @@ def cluster_breakpoints(chrom, breakpoints, buffer, ins_buffer):
 		"--": [],
 		"<INS>": []
 	}
-	breakpoints.sort()
-	for bp in breakpoints:
-		bp_notation_type = str(bp.breakpoint_notation)
-		if len(cluster_stacks[bp_notation_type]) == 0:
-			# put a new cluster onto the sv stack
-			new_cluster = Cluster(bp)
-			cluster_stacks[bp_notation_type].append(new_cluster)
-		elif bp_notation_type == "<INS>":
-			if not cluster_stacks[bp_notation_type][-1].overlaps(bp, ins_buffer):
-				# put a new cluster onto the sv stack
-				new_cluster = Cluster(bp)
-				cluster_stacks[bp_notation_type].append(new_cluster)
+	potential_breakpoints.consolidate()
+	columns = potential_breakpoints.columns
+	reach = get_reach(potential_breakpoints)
+	# one id per read name (a read can have several indices once stores are concatenated)
+	read_ids = {}
+	name_index = np.array([read_ids.setdefault(name, len(read_ids)) for name in potential_breakpoints.read_names], dtype=np.int64)
+	num_reads = max(len(read_ids), 1)
+	for bp_notation_type in cluster_stacks.keys():
+		rows = np.flatnonzero(columns['notation'] == PotentialBreakpoints.notations.index(bp_notation_type))
+		if not rows.size:
+			continue
+		# (stable) sort by start location
+		rows = rows[np.argsort(columns['start_loc'][rows], kind='stable')]
+		starts = columns['start_loc'][rows]
+		# a breakpoint overlaps the cluster on top of the stack if it starts within
+		# two buffers of the furthest reach so far (all earlier clusters reach less far)
+		max_reach = np.maximum.accumulate(reach[rows])
+		cluster_buffer = ins_buffer if bp_notation_type == "<INS>" else buffer
+		new_cluster = np.ones(len(rows), dtype=bool)
+		new_cluster[1:] = starts[1:] > (max_reach[:-1] + 2*cluster_buffer)
+		cluster_ids = np.cumsum(new_cluster) - 1
+		# can't cluster with only one read - require two
+		cluster_reads = np.unique(cluster_ids*num_reads + name_index[columns['read_index'][rows]])
+		supporting_reads = np.bincount(cluster_reads // num_reads, minlength=cluster_ids[-1]+1)
+		passed = supporting_reads[cluster_ids] >= 2
+		# only create clusters for the groups that passed
+		for bp, is_new in zip(potential_breakpoints.as_breakpoints(rows[passed]), new_cluster[passed].tolist()):
+			if is_new:
+				cluster_stacks[bp_notation_type].append(Cluster(bp))
 			else:
-				# add to cluster on top of stack
 				cluster_stacks[bp_notation_type][-1].add(bp)
-		elif bp_notation_type != "<INS>" and not cluster_stacks[bp_notation_type][-1].overlaps(bp, buffer):
-			# put a new cluster onto the sv stack
-			new_cluster = Cluster(bp)
-			cluster_stacks[bp_notation_type].append(new_cluster)
-		else:
-			# add to cluster on top of stack
-			cluster_stacks[bp_notation_type][-1].add(bp)
-	for bp_notation_type, stack in cluster_stacks.items():
-		# can't cluster with only one read - require two
-		filtered_cluster_stacks = [c for c in stack if len(c.supporting_reads) >= 2]
-		cluster_stacks[bp_notation_type] = filtered_cluster_stacks
 
 	return chrom, cluster_stacks
 
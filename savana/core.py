@@ -1,5 +1,5 @@
 """
-Class definitions for SAVANA: ConsensusBreakpoint, PotentialBreakpoint, and Cluster
+Class definitions for SAVANA: ConsensusBreakpoint, PotentialBreakpoint, PotentialBreakpoints, and Cluster
 Created: 13/04/2021
 Python 3.9.6
 Hillary Elrick
@@ -12,6 +12,26 @@ import uuid
 from copy import copy
 from statistics import mean, median, pstdev
 
+import numpy as np
+
+# INFO fields written as strings (all others are Floats)
+vcf_string_fields = ['SVTYPE', 'MATEID', 'BP_NOTATION', 'ORIGINATING_CLUSTER', 'END_CLUSTER']
+
+def format_vcf_info(info):
+	""" format an INFO column as htslib writes it (Float values stored as float32 and written as %g, no trailing separator) """
+	fields = []
+	for field in info.split(';'):
+		if not field:
+			continue
+		key, value = field.split('=', 1)
+		if key not in vcf_string_fields:
+			try:
+				value = ','.join([f'{float(np.float32(v)):g}' for v in value.split(',')])
+			except ValueError:
+				pass # leave non-numeric values as they are
+		fields.append(f'{key}={value}')
+	return ';'.join(fields)
+
 def generate_uuid():
 	""" hex representation of a multiprocessing-safe unique id """
 	return uuid.uuid4().hex
@@ -196,17 +216,13 @@ class ConsensusBreakpoint():
 			stats_str+=f'END_{key.upper()}={value};'
 		return stats_str
 
-	def as_vcf(self, ref_fasta):
-		""" return vcf line(s) representation of the breakpoint """
+	def get_ref_positions(self):
+		""" return the (contig, 0-based position) of the reference bases at each edge """
+		return [(self.start_chr, self.start_loc - 1), (self.end_chr, self.end_loc - 1)]
+
+	def as_vcf_records(self, start_base, end_base):
+		""" return the vcf record(s) of the breakpoint as lists of column values given the reference bases """
 		#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT
-		try:
-			start_base = ref_fasta.fetch(self.start_chr, self.start_loc - 1, self.start_loc)
-		except Exception as e:
-			start_base = 'N'
-		try:
-			end_base = ref_fasta.fetch(self.end_chr, self.end_loc - 1, self.end_loc)
-		except Exception as e:
-			end_base = 'N'
 		alts = self.get_alts(start_base, end_base)
 		# construct info column
 		gt_tag = ''
@@ -230,6 +246,7 @@ class ConsensusBreakpoint():
 			info[1] = f'SVTYPE=BND;MATEID=ID_{self.count}_1;' + info[1]
 			info[1]+=f'TUMOUR_DP={",".join(reversed(self.local_depths["tumour"]))};'
 			info[1]+=f'NORMAL_DP={",".join(reversed(self.local_depths["normal"]))};'
+		info = [format_vcf_info(i) for i in info]
 		# put together vcf line(s)
 		vcf_lines = [[
 			self.start_chr,
@@ -256,10 +273,7 @@ class ConsensusBreakpoint():
 				'GT',
 				gt_tag
 			])
-		vcf_string = ''
-		for line in vcf_lines:
-			vcf_string+="\t".join(line)+"\n"
-		return vcf_string
+		return vcf_lines
 
 	# string representation
 	def __str__(self):
@@ -327,6 +341,173 @@ class PotentialBreakpoint():
 		setattr(reversed_breakpoint, 'end_loc', self.start_loc)
 		return reversed_breakpoint
 
+class PotentialBreakpoints():
+	""" columnar store of potential breakpoints (one row per CIGAR indel or split-read edge) """
+	notations = ["+-", "++", "-+", "--", "<INS>"]
+	sources = ["SUPP", "INS", "DEL"]
+	labels = ["tumour", "normal"]
+	column_types = {
+		'start_chr': np.int32,
+		'start_loc': np.int64,
+		'end_chr': np.int32,
+		'end_loc': np.int64,
+		'notation': np.int8,
+		'source': np.int8,
+		'mapq': np.int16,
+		'label': np.int8,
+		'read_index': np.int64,
+		'insert_start': np.int64, # inserted sequence is inserts[insert_start:insert_end]
+		'insert_end': np.int64
+	}
+	max_pending = 65536 # rows to collect before moving into numpy columns
+
+	def __init__(self, contigs, columns=None, read_names=None, inserts=''):
+		self.contigs = list(contigs)
+		self.contig_ids = {contig: i for i, contig in enumerate(self.contigs)}
+		if columns is None:
+			columns = {name: np.empty(0, dtype=dtype) for name, dtype in self.column_types.items()}
+		self.columns = columns
+		self.read_names = read_names if read_names is not None else []
+		self.inserts = inserts
+		self.pending = {name: [] for name in self.column_types}
+		self.pending_inserts = []
+		self.inserts_length = len(inserts)
+
+	def append(self, locations, source, read_name, read_quality, label, breakpoint_notation, insert=None):
+		""" add a breakpoint (takes the same arguments as a PotentialBreakpoint) """
+		if source == 'INS' and not insert:
+			raise AttributeError("Must provide an insert for breakpoint type of 'INS")
+		if not self.read_names or self.read_names[-1] != read_name:
+			# breakpoints from the same read are added consecutively
+			self.read_names.append(read_name)
+		row = self.pending
+		row['start_chr'].append(self.contig_ids[locations[0]['chr']])
+		row['start_loc'].append(int(locations[0]['loc']))
+		row['end_chr'].append(self.contig_ids[locations[1]['chr']])
+		row['end_loc'].append(int(locations[1]['loc']))
+		row['notation'].append(self.notations.index(breakpoint_notation))
+		row['source'].append(self.sources.index(source))
+		row['mapq'].append(read_quality)
+		row['label'].append(self.labels.index(label))
+		row['read_index'].append(len(self.read_names)-1)
+		row['insert_start'].append(self.inserts_length)
+		if insert:
+			self.pending_inserts.append(insert)
+			self.inserts_length += len(insert)
+		row['insert_end'].append(self.inserts_length)
+		if len(row['start_loc']) >= self.max_pending:
+			self.consolidate()
+
+	def consolidate(self):
+		""" move appended rows into the numpy columns """
+		if not self.pending['start_loc']:
+			return
+		for name, dtype in self.column_types.items():
+			self.columns[name] = np.concatenate([self.columns[name], np.array(self.pending[name], dtype=dtype)])
+			self.pending[name] = []
+		self.inserts += ''.join(self.pending_inserts)
+		self.pending_inserts = []
+
+	def select(self, indices):
+		""" return a new store with only the given rows (and the read names/inserts they use) """
+		self.consolidate()
+		columns = {name: values[indices] for name, values in self.columns.items()}
+		# re-index reads so that each read name has one index
+		used_reads, read_index = np.unique(columns['read_index'], return_inverse=True)
+		read_ids = {}
+		name_index = np.array([read_ids.setdefault(self.read_names[i], len(read_ids)) for i in used_reads.tolist()], dtype=np.int64)
+		columns['read_index'] = name_index[read_index.reshape(-1)]
+		read_names = list(read_ids)
+		insert_starts = columns['insert_start'].tolist()
+		insert_ends = columns['insert_end'].tolist()
+		inserts = ''.join(self.inserts[s:e] for s, e in zip(insert_starts, insert_ends) if e > s)
+		insert_lengths = columns['insert_end'] - columns['insert_start']
+		columns['insert_end'] = np.cumsum(insert_lengths)
+		columns['insert_start'] = columns['insert_end'] - insert_lengths
+
+		return PotentialBreakpoints(self.contigs, columns, read_names, inserts)
+
+	@classmethod
+	def concatenate(cls, stores):
+		""" combine stores (sharing the same contigs) into one, keeping the row order """
+		if not stores:
+			raise ValueError("Must provide at least one store of potential breakpoints to concatenate")
+		read_names = []
+		inserts = []
+		columns = {name: [] for name in cls.column_types}
+		read_offset, insert_offset = 0, 0
+		for store in stores:
+			store.consolidate()
+			for name, values in store.columns.items():
+				if name == 'read_index':
+					values = values + read_offset
+				elif name in ('insert_start', 'insert_end'):
+					values = values + insert_offset
+				columns[name].append(values)
+			read_names.extend(store.read_names)
+			inserts.append(store.inserts)
+			read_offset += len(store.read_names)
+			insert_offset += len(store.inserts)
+		columns = {name: np.concatenate(values).astype(cls.column_types[name]) for name, values in columns.items()}
+
+		return cls(stores[0].contigs, columns, read_names, ''.join(inserts))
+
+	def split_by_chrom(self):
+		""" return a dict of stores per start chromosome (in order of first appearance) """
+		self.consolidate()
+		chrom_ids, first_rows = np.unique(self.columns['start_chr'], return_index=True)
+		chrom_stores = {}
+		for chrom_id in chrom_ids[np.argsort(first_rows)].tolist():
+			chrom_stores[self.contigs[chrom_id]] = self.select(np.flatnonzero(self.columns['start_chr'] == chrom_id))
+
+		return chrom_stores
+
+	def to_arrays(self):
+		""" return the store as a dict of numpy arrays (e.g. for np.savez) """
+		self.consolidate()
+		arrays = dict(self.columns)
+		arrays['contigs'] = np.frombuffer("\n".join(self.contigs).encode(), dtype=np.uint8)
+		arrays['read_names'] = np.frombuffer("\n".join(self.read_names).encode(), dtype=np.uint8)
+		arrays['inserts'] = np.frombuffer(self.inserts.encode(), dtype=np.uint8)
+		arrays['num_reads'] = np.array(len(self.read_names))
+
+		return arrays
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		""" create a store from the dict of numpy arrays made by to_arrays """
+		columns = {name: np.asarray(arrays[name], dtype=dtype) for name, dtype in cls.column_types.items()}
+		contigs = bytes(arrays['contigs']).decode().split("\n")
+		read_names = bytes(arrays['read_names']).decode().split("\n") if int(arrays['num_reads']) else []
+		inserts = bytes(arrays['inserts']).decode()
+
+		return cls(contigs, columns, read_names, inserts)
+
+	def as_breakpoints(self, indices=None):
+		""" return (selected) rows as a list of PotentialBreakpoint objects """
+		self.consolidate()
+		rows = {}
+		for name, values in self.columns.items():
+			rows[name] = (values if indices is None else values[indices]).tolist()
+		breakpoints = []
+		for start_chr, start_loc, end_chr, end_loc, notation, source, mapq, label, read_index, insert_start, insert_end in zip(*(rows[name] for name in self.column_types)):
+			source = self.sources[source]
+			breakpoints.append(PotentialBreakpoint([
+					{'chr': self.contigs[start_chr], 'loc': start_loc},
+					{'chr': self.contigs[end_chr], 'loc': end_loc}
+				], source, self.read_names[read_index], mapq, self.labels[label], self.notations[notation],
+				self.inserts[insert_start:insert_end] if source == 'INS' else None))
+
+		return breakpoints
+
+	def __len__(self):
+		return len(self.columns['start_loc']) + len(self.pending['start_loc'])
+
+	def __getstate__(self):
+		# only pickle the consolidated numpy columns
+		self.consolidate()
+		return self.__dict__
+
 class Cluster():
 	""" class for a cluster containing breakpoint objects within a buffer & sharing an SV type """
 	def __init__(self, initial_breakpoint):
@@ -10,43 +10,81 @@ import re
 import os
 import csv
 
-import cyvcf2
+from bisect import bisect_left, bisect_right
+
+import numpy as np
 
 import savana.helper as helper
-from savana.breakpoints import *
-from savana.clusters import *
+from savana.vcf import read_vcf, iter_vcf_batches, read_header, add_header_line, open_vcf_writer, write_record, set_info
+
+def get_field_values(data_matrix, field, convert=None):
+	""" return the values of an INFO field from the loaded matrix as a list (first value if multi-valued, None if missing) """
+	if field not in data_matrix.columns:
+		field = f'{field}_0' if f'{field}_0' in data_matrix.columns else None
+	if field is None:
+		return [None] * len(data_matrix)
+	values = []
+	for value in data_matrix[field].tolist():
+		if value is None or (isinstance(value, float) and np.isnan(value)):
+			values.append(None)
+		else:
+			values.append(convert(value) if convert else value)
+
+	return values
+
+def get_positions(data_matrix):
+	""" return the chromosome (without 'chr'), 0-based start, and ID of each variant in the loaded matrix """
+	chroms = [chrom[3:] if chrom.startswith('chr') else chrom for chrom in data_matrix['CHROM'].tolist()]
+	starts = (data_matrix['POS'] - 1).tolist()
+	ids = [None if variant_id == '.' else variant_id for variant_id in data_matrix['ID'].tolist()]
+
+	return chroms, starts, ids
 
 def create_variant_dicts(vcf_file, label):
 	""" given a vcf file, create a dict representation of relevant attributes for each variant """
 	variant_dicts = []
-	id_count = 0
-	for variant in cyvcf2.VCF(vcf_file):
+	data_matrix = read_vcf(vcf_file, fields=['SVLEN', 'SVTYPE'], columns=['CHROM', 'POS', 'ID'])
+	chroms, starts, ids = get_positions(data_matrix)
+	lengths = get_field_values(data_matrix, 'SVLEN')
+	types = get_field_values(data_matrix, 'SVTYPE')
+	for id_count in range(len(data_matrix)):
 		variant_dict = {
 			'label': label,
 			'id': label+"_"+str(id_count),
-			'start_chr': variant.CHROM[3:] if variant.CHROM.startswith('chr') else variant.CHROM,
-			'start_loc': variant.start,
-			'length': variant.INFO.get('SVLEN'),
-			'type': variant.INFO.get('SVTYPE'),
-			'within_buffer': [],
-			'external_id': variant.ID
+			'start_chr': chroms[id_count],
+			'start_loc': starts[id_count],
+			'length': lengths[id_count],
+			'type': types[id_count],
+			'candidates': [],
+			'external_id': ids[id_count]
 		}
 		variant_dicts.append(variant_dict)
-		id_count += 1
 
 	return variant_dicts
 
-def compute_statistics(args, compare_set, input_set, vcfs_string):
-	""" given a compare set of variants, compute statistics on number of variants identifed """
-	validation_str = []
-	break_str = '----------'
-	validation_str.append(f'Number of INPUT variants found in "{vcfs_string}": {len([x for x in input_set if x["within_buffer"]])}/{len(input_set)}')
-	validation_str.append(f'Number of "SOMATIC" variants found in INPUT {len([x for x in compare_set if (x["label"] == "SOMATIC" and x["within_buffer"])])}/{len([x for x in compare_set if x["label"] == "SOMATIC"])}')
-	if args.germline:
-		validation_str.append(f'Number of "GERMLINE" variants found in INPUT {len([x for x in compare_set if (x["label"] == "GERMLINE" and x["within_buffer"])])}/{len([x for x in compare_set if x["label"] == "GERMLINE"])}')
+def index_compare_set(compare_set):
+	""" index the compare variants by chromosome: their sorted starts and the corresponding position in the compare set """
+	compare_index = {}
+	for order, compare_variant in enumerate(compare_set):
+		compare_index.setdefault(compare_variant['start_chr'], []).append((compare_variant['start_loc'], order))
+	for chrom, entries in compare_index.items():
+		entries.sort()
+		compare_index[chrom] = ([start for start, _ in entries], [order for _, order in entries])
+
+	return compare_index
 
-	used_compare_set_ids = []
-	used_input_set_ids = []
+def get_within_buffer(chrom_index, loc, buffer):
+	""" binary search a chromosome's index for compare variants starting within the buffer of loc, return their order and distance """
+	starts, orders = chrom_index
+	first = bisect_left(starts, loc - buffer)
+	last = bisect_right(starts, loc + buffer)
+
+	return [(orders[j], abs(starts[j] - loc)) for j in range(first, last)]
+
+def validate_variants(compare_set, input_set):
+	""" pair input and compare variants within buffer (closest first, each used once), return the true/false positives and false negatives """
+	used_compare_set_ids = set()
+	used_input_set_ids = set()
 
 	# mark input set
 	for variant in input_set:
@@ -57,7 +95,7 @@ def compute_statistics(args, compare_set, input_set, vcfs_string):
 			compare_variant, distance = within_buffer_sorted[i]
 			if compare_variant['id'] not in used_compare_set_ids:
 				variant['validated'] = (compare_variant, distance)
-				used_compare_set_ids.append(compare_variant['id'])
+				used_compare_set_ids.add(compare_variant['id'])
 			i+=1
 
 	# mark compare sets
@@ -69,7 +107,7 @@ def compute_statistics(args, compare_set, input_set, vcfs_string):
 			input_variant, distance = within_buffer_sorted[i]
 			if input_variant['id'] not in used_input_set_ids:
 				variant['validated'] = (input_variant, distance)
-				used_input_set_ids.append(input_variant['id'])
+				used_input_set_ids.add(input_variant['id'])
 			i+=1
 
 	# SOMATIC CALCULATIONS
@@ -79,6 +117,19 @@ def compute_statistics(args, compare_set, input_set, vcfs_string):
 	fp = [v for v in input_set if not v['validated']]
 	# report missed somatic variants (false negative)
 	fn = [v for v in compare_set if not v['validated'] and v['label'] == 'SOMATIC']
+
+	return tp, fp, fn
+
+def compute_statistics(args, compare_set, input_set, vcfs_string):
+	""" given a compare set of variants, compute statistics on number of variants identifed """
+	validation_str = []
+	break_str = '----------'
+	validation_str.append(f'Number of INPUT variants found in "{vcfs_string}": {len([x for x in input_set if x["within_buffer"]])}/{len(input_set)}')
+	validation_str.append(f'Number of "SOMATIC" variants found in INPUT {len([x for x in compare_set if (x["label"] == "SOMATIC" and x["within_buffer"])])}/{len([x for x in compare_set if x["label"] == "SOMATIC"])}')
+	if args.germline:
+		validation_str.append(f'Number of "GERMLINE" variants found in INPUT {len([x for x in compare_set if (x["label"] == "GERMLINE" and x["within_buffer"])])}/{len([x for x in compare_set if x["label"] == "GERMLINE"])}')
+
+	tp, fp, fn = validate_variants(compare_set, input_set)
 	validation_str.append(f'\nSTATISTICS FOR SOMATIC VARIANTS')
 	validation_str.append('(Not allowing for two variants to be validated by the same event)')
 	validation_str.append(break_str)
@@ -113,45 +164,52 @@ def compute_statistics(args, compare_set, input_set, vcfs_string):
 
 	return
 
-def evaluate_vcf(args, checkpoints, time_str):
-	""" given the input, somatic, and germline VCFs, label the input VCF"""
-	# create the comparison set from somatic & germline VCFs
-	compare_set = create_variant_dicts(args.somatic, 'SOMATIC')
-	vcfs_string=f'{args.somatic}'
-	if args.germline:
-		vcfs_string+=f' and {args.germline}'
-		compare_set.extend(create_variant_dicts(args.germline, 'GERMLINE'))
+def compute_buffer_statistics(buffer, compare_set, input_set, input_variant_labels):
+	""" summarise the labels and somatic statistics of one buffer as a row of the sweep table """
+	tp, fp, fn = validate_variants(compare_set, input_set)
+	labels = list(input_variant_labels.values())
+	row = {
+		'overlap_buffer': buffer,
+		'input_found': len([x for x in input_set if x['within_buffer']]),
+		'input_total': len(input_set),
+		'somatic_found': len([x for x in compare_set if (x['label'] == 'SOMATIC' and x['within_buffer'])]),
+		'somatic_total': len([x for x in compare_set if x['label'] == 'SOMATIC']),
+		'germline_found': len([x for x in compare_set if (x['label'] == 'GERMLINE' and x['within_buffer'])]),
+		'germline_total': len([x for x in compare_set if x['label'] == 'GERMLINE']),
+		'labelled_somatic': labels.count('SOMATIC'),
+		'labelled_germline': labels.count('GERMLINE'),
+		'true_positives': len(tp),
+		'false_positives': len(fp),
+		'false_negatives': len(fn),
+		'precision': 'NA',
+		'recall': 'NA',
+		'f_measure': 'NA'
+	}
+	try:
+		precision = len(tp)/(len(tp)+len(fp))
+		recall = len(tp)/(len(tp)+len(fn))
+		row['f_measure'] = round((2*precision*recall)/(precision+recall), 3)
+		row['precision'] = round(precision, 3)
+		row['recall'] = round(recall, 3)
+	except ZeroDivisionError as e:
+		print(f'WARNING: Unable to calculate validation statistics for buffer {buffer} due to divide by zero exception')
 
-	# read in input vcf, iterate through compare variants, store those that are within buffer
-	input_vcf = cyvcf2.VCF(args.input)
-	input_variants = []
-	for variant in input_vcf:
-		variant_chrom = variant.CHROM[3:] if variant.CHROM.startswith('chr') else variant.CHROM
-		input_variants.append({
-			'label': 'INPUT',
-			'id': variant.ID,
-			'start_chr': variant.CHROM[3:] if variant.CHROM.startswith('chr') else variant.CHROM,
-			'start_loc': variant.start,
-			'end_loc': variant.INFO.get('END'), #only for cuteSV
-			'length': variant.INFO.get('SVLEN'),
-			'type': variant.INFO.get('SVTYPE'),
-			'within_buffer': []})
-		if args.by_support:
-			input_variants[-1]['tumour_support'] = int(variant.INFO.get('TUMOUR_SUPPORT'))
-			input_variants[-1]['normal_support'] = int(variant.INFO.get('NORMAL_SUPPORT'))
-		for compare_variant in compare_set:
-			if compare_variant['start_chr'] == variant_chrom:
-				distance = abs(compare_variant['start_loc'] - input_variants[-1]['start_loc'])
-				if distance <= args.overlap_buffer:
-					compare_variant['within_buffer'].append((input_variants[-1], distance))
-					input_variants[-1]['within_buffer'].append((compare_variant, distance))
-				if input_variants[-1]['end_loc']:
-					distance = abs(compare_variant['start_loc'] - input_variants[-1]['end_loc'])
-					if distance <= args.overlap_buffer:
-						compare_variant['within_buffer'].append((input_variants[-1], distance))
-						input_variants[-1]['within_buffer'].append((compare_variant, distance))
-
-	# assign matched within buffer variants a label
+	return row
+
+def write_buffer_statistics(stats_path, rows):
+	""" write the sweep table, one row per buffer """
+	with open(stats_path, "w") as stats_file:
+		writer = csv.DictWriter(stats_file, fieldnames=list(rows[0].keys()), delimiter='\t', lineterminator='\n')
+		writer.writeheader()
+		writer.writerows(rows)
+
+def set_buffer(variants, buffer):
+	""" restrict the variants' within buffer lists to the candidates within the buffer (keeping their order) """
+	for variant in variants:
+		variant['within_buffer'] = [(other, distance) for other, distance in variant['candidates'] if distance <= buffer]
+
+def assign_labels(args, compare_set):
+	""" assign matched within buffer variants a label, return the label of each labelled input variant by id """
 	input_variant_labels = {}
 	for variant in compare_set:
 		variant['validated'] = False
@@ -177,26 +235,85 @@ def evaluate_vcf(args, checkpoints, time_str):
 			# match with the input variant with highest 'label' support
 			input_variant_labels[closest_variant] = variant['label']
 
-	# edit input_vcf to include LABEL in header
-	input_vcf = cyvcf2.VCF(args.input)
+	return input_variant_labels
+
+def evaluate_vcf(args, checkpoints, time_str):
+	""" given the input, somatic, and germline VCFs, label the input VCF (using the first buffer if several are given)"""
+	buffers = args.overlap_buffer if isinstance(args.overlap_buffer, list) else [args.overlap_buffer]
+	# create the comparison set from somatic & germline VCFs
+	compare_set = create_variant_dicts(args.somatic, 'SOMATIC')
+	vcfs_string=f'{args.somatic}'
+	if args.germline:
+		vcfs_string+=f' and {args.germline}'
+		compare_set.extend(create_variant_dicts(args.germline, 'GERMLINE'))
+
+	# read in input vcf a batch at a time, iterate through compare variants, store those that are within the largest buffer
+	# (keeping the records to label them without reading the VCF again)
+	fields = ['SVLEN', 'SVTYPE', 'END'] + (['TUMOUR_SUPPORT', 'NORMAL_SUPPORT'] if args.by_support else [])
+	compare_index = index_compare_set(compare_set)
+	max_buffer = max(buffers)
+	input_records = []
+	input_variants = []
+	for records, data_matrix in iter_vcf_batches(args.input, fields=fields, columns=['CHROM', 'POS', 'ID']):
+		input_records.extend(records)
+		chroms, starts, ids = get_positions(data_matrix)
+		end_locs = get_field_values(data_matrix, 'END', int) #only for cuteSV
+		lengths = get_field_values(data_matrix, 'SVLEN')
+		types = get_field_values(data_matrix, 'SVTYPE')
+		if args.by_support:
+			tumour_supports = get_field_values(data_matrix, 'TUMOUR_SUPPORT', int)
+			normal_supports = get_field_values(data_matrix, 'NORMAL_SUPPORT', int)
+		for i, variant_chrom in enumerate(chroms):
+			input_variants.append({
+				'label': 'INPUT',
+				'id': ids[i],
+				'start_chr': variant_chrom,
+				'start_loc': starts[i],
+				'end_loc': end_locs[i],
+				'length': lengths[i],
+				'type': types[i],
+				'candidates': []})
+			if args.by_support:
+				input_variants[-1]['tumour_support'] = tumour_supports[i]
+				input_variants[-1]['normal_support'] = normal_supports[i]
+			if variant_chrom not in compare_index:
+				continue
+			# compare variants starting within the buffer of the start (and end), in compare set order
+			matches = [(order, 0, distance) for order, distance in get_within_buffer(compare_index[variant_chrom], starts[i], max_buffer)]
+			if input_variants[-1]['end_loc']:
+				matches.extend([(order, 1, distance) for order, distance in get_within_buffer(compare_index[variant_chrom], end_locs[i], max_buffer)])
+			for order, _, distance in sorted(matches):
+				compare_set[order]['candidates'].append((input_variants[-1], distance))
+				input_variants[-1]['candidates'].append((compare_set[order], distance))
+
+	# label and compute statistics for each buffer from the shared candidates
+	buffer_rows = []
+	for buffer in buffers:
+		set_buffer(compare_set, buffer)
+		set_buffer(input_variants, buffer)
+		labels = assign_labels(args, compare_set)
+		if buffer == buffers[0]:
+			input_variant_labels = labels
+			if args.stats and len(buffers) == 1:
+				compute_statistics(args, compare_set, input_variants, vcfs_string)
+		if args.stats and len(buffers) > 1:
+			buffer_rows.append(compute_buffer_statistics(buffer, compare_set, input_variants, labels))
+
+	# edit input header to include LABEL
+	header = read_header(args.input)
 	labels_list = ['SOMATIC', 'GERMLINE', 'NOT_IN_COMPARISON']
 	desc_string = str(f'One of \'{"|".join(labels_list)}\' evaluating against {vcfs_string}')
-	input_vcf.add_info_to_header({
-		'ID': 'LABEL',
-		'Type': 'String',
-		'Number': '1',
-		'Description': desc_string
-	})
-	out_vcf = cyvcf2.Writer(args.output, input_vcf)
-	for variant in input_vcf:
-		variant.INFO['LABEL'] = input_variant_labels.get(variant.ID, 'NOT_IN_COMPARISON')
-		out_vcf.write_record(variant)
+	add_header_line(header, f'##INFO=<ID=LABEL,Number=1,Type=String,Description="{desc_string}">')
+	out_vcf = open_vcf_writer(args.output, header)
+	for record, variant in zip(input_records, input_variants):
+		set_info(record, 'LABEL', input_variant_labels.get(variant['id'], 'NOT_IN_COMPARISON'))
+		write_record(out_vcf, record)
 	out_vcf.close()
-	input_vcf.close()
 	helper.time_function("Output labelled VCF", checkpoints, time_str)
 
+	if buffer_rows:
+		write_buffer_statistics(args.stats, buffer_rows)
 	if args.stats:
-		compute_statistics(args, compare_set, input_variants, vcfs_string)
 		helper.time_function("Wrote statistics file", checkpoints, time_str)
 
 	return
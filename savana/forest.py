@@ -0,0 +1,132 @@
+"""
+Module containing a compact (flat NumPy array) format for random forest models and its evaluator
+"""
+#!/usr/bin/env python3
+
+import struct
+import zipfile
+
+import numpy as np
+
+def export_forest(model, forest_path):
+	""" write the trees of a fitted (single output) random forest classifier as flat node arrays """
+	features, thresholds, children_list, values, missing_left = [], [], [], [], []
+	tree_offsets = []
+	offset = 0
+	for estimator in model.estimators_:
+		tree = estimator.tree_
+		leaf = tree.children_left == -1
+		tree_offsets.append(offset)
+		# children as indices into the flattened arrays (leaves point to themselves and split on feature 0)
+		children = np.where(leaf[:, np.newaxis], np.arange(tree.node_count)[:, np.newaxis],
+			np.stack([tree.children_left, tree.children_right], axis=1))
+		children_list.append(children.astype(np.int32) + offset)
+		features.append(np.where(leaf, 0, tree.feature).astype(np.int32))
+		thresholds.append(tree.threshold.astype(np.float64))
+		value = tree.value[:, 0, :model.n_classes_].astype(np.float64)
+		normalizer = value.sum(axis=1)
+		if not np.allclose(normalizer[leaf], 1.0):
+			# older versions of sklearn store class counts rather than fractions
+			normalizer[normalizer == 0.0] = 1.0
+			value = value / normalizer[:, np.newaxis]
+		values.append(value)
+		if hasattr(tree, 'missing_go_to_left'):
+			missing_left.append(tree.missing_go_to_left.astype(bool))
+		else:
+			missing_left.append(np.zeros(tree.node_count, dtype=bool))
+		offset += tree.node_count
+	feature_names = getattr(model, 'feature_names_in_', np.array([], dtype=str))
+	# uncompressed so that the arrays can be memory-mapped when loading
+	with open(forest_path, 'wb') as forest_file:
+		np.savez(forest_file,
+			feature=np.concatenate(features),
+			threshold=np.concatenate(thresholds),
+			children=np.concatenate(children_list),
+			value=np.concatenate(values),
+			missing_left=np.concatenate(missing_left),
+			tree_offsets=np.array(tree_offsets, dtype=np.int32),
+			classes=np.asarray(model.classes_),
+			feature_names=np.asarray(feature_names, dtype=str))
+
+def memmap_npz(npz_path):
+	""" memory-map each array of an uncompressed .npz file """
+	arrays = {}
+	with zipfile.ZipFile(npz_path) as npz_file, open(npz_path, 'rb') as raw_file:
+		for info in npz_file.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				raise ValueError(f'Unable to memory-map compressed array "{info.filename}" in {npz_path}')
+			# skip the local file header to reach the .npy data
+			raw_file.seek(info.header_offset + 26)
+			name_length, extra_length = struct.unpack('<HH', raw_file.read(4))
+			raw_file.seek(info.header_offset + 30 + name_length + extra_length)
+			version = np.lib.format.read_magic(raw_file)
+			if version == (1, 0):
+				shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw_file)
+			else:
+				shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw_file)
+			name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+			if not shape or 0 in shape:
+				arrays[name] = np.zeros(shape, dtype=dtype)
+			else:
+				arrays[name] = np.memmap(npz_path, dtype=dtype, mode='r', offset=raw_file.tell(),
+					shape=shape, order='F' if fortran_order else 'C')
+
+	return arrays
+
+class CompactForest():
+	""" random forest classifier stored as flat node arrays - predicts like the sklearn model it was exported from """
+	def __init__(self, forest_path):
+		arrays = memmap_npz(forest_path)
+		self.feature = arrays['feature']
+		self.threshold = arrays['threshold']
+		self.children = arrays['children'].reshape(-1) # left and right child of each node, interleaved
+		self.value = arrays['value']
+		self.missing_left = arrays['missing_left']
+		self.tree_offsets = np.asarray(arrays['tree_offsets'])
+		self.classes_ = np.asarray(arrays['classes'])
+		self.is_leaf = self.children[::2] == np.arange(len(self.feature))
+		if len(arrays['feature_names']):
+			self.feature_names_in_ = np.asarray(arrays['feature_names'], dtype=object)
+
+	def apply_tree(self, X_columns, num_samples, tree, has_missing):
+		""" return the leaf each sample reaches in a tree (X_columns is the feature matrix flattened column by column) """
+		nodes = np.full(num_samples, self.tree_offsets[tree], dtype=np.int64)
+		# only step the samples which have yet to reach a leaf
+		active = np.arange(num_samples) if not self.is_leaf[nodes[0]] else np.array([], dtype=np.int64)
+		while len(active):
+			active_nodes = nodes[active]
+			sample_values = X_columns[self.feature[active_nodes] * num_samples + active]
+			go_right = ~(sample_values <= self.threshold[active_nodes])
+			if has_missing:
+				missing = np.isnan(sample_values)
+				go_right[missing] = ~self.missing_left[active_nodes[missing]]
+			active_nodes = self.children[active_nodes * 2 + go_right]
+			nodes[active] = active_nodes
+			active = active[~self.is_leaf[active_nodes]]
+
+		return nodes
+
+	def predict_proba(self, X):
+		""" return the mean class probabilities across the trees """
+		X = np.asarray(X, dtype=np.float32) # as sklearn compares features
+		num_samples = X.shape[0]
+		X_columns = np.ascontiguousarray(X.T).ravel()
+		has_missing = np.isnan(X).any()
+		proba = np.zeros((num_samples, self.value.shape[1]), dtype=np.float64)
+		# one tree at a time (keeps its nodes in cache) and accumulated in the same order as sklearn
+		for tree in range(len(self.tree_offsets)):
+			proba += self.value[self.apply_tree(X_columns, num_samples, tree, has_missing)]
+		proba /= len(self.tree_offsets)
+
+		return proba
+
+	def predict(self, X):
+		""" return the predicted class of each sample """
+		return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+def load_forest(forest_path):
+	""" load an exported forest """
+	return CompactForest(forest_path)
+
+if __name__ == "__main__":
+	print("Compact forest functions for SAVANA")
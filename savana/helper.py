@@ -10,6 +10,8 @@ import re
 import os
 import csv
 import sys
+import json
+import hashlib
 
 from time import time
 from datetime import datetime
@@ -253,11 +255,98 @@ def get_contig_lengths(ref_index):
 
 	return contig_lengths
 
+def get_reference_bases(ref_fasta, positions, max_gap=100000):
+	""" return the reference base at each (contig, 0-based position), reading merged spans of each contig """
+	bases = {}
+	positions_by_contig = {}
+	for contig, pos in positions:
+		positions_by_contig.setdefault(contig, set()).add(pos)
+	for contig, contig_positions in positions_by_contig.items():
+		contig_positions = sorted(contig_positions)
+		if contig not in ref_fasta.references:
+			bases.update({(contig, pos): 'N' for pos in contig_positions})
+			continue
+		# merge positions within max_gap of each other into spans
+		spans = []
+		for pos in contig_positions:
+			if pos < 0:
+				bases[(contig, pos)] = 'N'
+			elif spans and pos - spans[-1][-1] <= max_gap:
+				spans[-1].append(pos)
+			else:
+				spans.append([pos])
+		for span in spans:
+			sequence = ref_fasta.fetch(contig, span[0], span[-1] + 1)
+			for pos in span:
+				# positions past the end of the contig are empty (as with fetch)
+				bases[(contig, pos)] = sequence[pos - span[0]:pos - span[0] + 1]
+
+	return bases
+
+def populate_ref_cache(ref, cache_dir, aln_files, contigs, block_size=10000000):
+	"""
+	write the reference sequences of the contigs considered to a cache named by their MD5 (as REF_CACHE) so that htslib
+	memory-maps one shared copy rather than each decoder loading the fasta - returns False if unusable
+	(contigs checked against an unchanged reference by a previous run are re-used without reading the fasta)
+	"""
+	md5s = {}
+	for aln_file in aln_files.values():
+		for sequence in aln_file.header.to_dict().get('SQ', []):
+			if sequence['SN'] not in contigs:
+				continue
+			if 'M5' not in sequence:
+				return False # htslib can't look up the sequence without its MD5
+			md5s[sequence['SN']] = sequence['M5'].lower()
+	# contigs already written from (or matched against) this version of the reference
+	stat = os.stat(ref)
+	signature = [os.path.abspath(ref), stat.st_size, stat.st_mtime_ns]
+	signature_file = os.path.join(cache_dir, 'reference.json')
+	cached = {}
+	if os.path.isfile(signature_file):
+		with open(signature_file) as f:
+			cached = json.load(f)
+	cached_md5s = cached.get('md5s', {}) if cached.get('signature') == signature else {}
+	import pysam
+	os.makedirs(cache_dir, exist_ok=True)
+	with pysam.FastaFile(ref) as ref_fasta:
+		for contig, md5 in md5s.items():
+			cache_file = os.path.join(cache_dir, md5[:2], md5[2:4], md5[4:])
+			if cached_md5s.get(contig) == md5 and os.path.isfile(cache_file):
+				continue
+			if contig not in ref_fasta.references:
+				return False
+			os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+			# htslib expects the upper-case sequence without line breaks
+			sequence_md5 = hashlib.md5()
+			with open(f'{cache_file}.tmp', 'wb') as f:
+				contig_length = ref_fasta.get_reference_length(contig)
+				for block_start in range(0, contig_length, block_size):
+					block = ref_fasta.fetch(contig, block_start, min(block_start + block_size, contig_length)).upper().encode()
+					sequence_md5.update(block)
+					f.write(block)
+			if sequence_md5.hexdigest() != md5:
+				# the files weren't written against this reference (keep decoding them with the fasta)
+				os.remove(f'{cache_file}.tmp')
+				return False
+			os.replace(f'{cache_file}.tmp', cache_file)
+			cached_md5s[contig] = md5
+	with open(f'{signature_file}.tmp', 'w') as f:
+		json.dump({'signature': signature, 'md5s': cached_md5s}, f)
+	os.replace(f'{signature_file}.tmp', signature_file)
+
+	return True
+
+def use_ref_cache(cache_dir):
+	""" decode CRAMs opened without a reference filename from the cache (in this process only, never downloading the sequences) """
+	os.environ['REF_CACHE'] = os.path.join(cache_dir, '%2s', '%2s', '%s')
+	os.environ['REF_PATH'] = os.environ['REF_CACHE']
+
 def generate_vcf_header(args, example_breakpoint):
 	""" given a fasta file, index, and example breakpoint generate the VCF header """
 	vcf_header_str = []
 	vcf_header_str.extend([
 		"##fileformat=VCFv4.2",
+		'##FILTER=<ID=PASS,Description="All filters passed">',
 		f'##fileDate={datetime.now().strftime("%Y%m%d")}',
 		f'##source=SAVANAv{__version__}'
 	])
@@ -315,13 +404,13 @@ def time_function(desc, checkpoints, time_str, final=False):
 	print(formatted_time)
 	return
 
-def check_outdir(args_outdir):
+def check_outdir(args_outdir, allow_existing=False):
 	# create output dir if it doesn't exist
 	outdir = os.path.join(os.getcwd(), args_outdir)
 	if not os.path.exists(outdir):
 		print(f'Creating directory {outdir} to store results')
 		os.mkdir(outdir)
-	elif os.listdir(outdir):
+	elif os.listdir(outdir) and not allow_existing:
 		sys.exit(f'Output directory "{outdir}" already exists and contains files. Please remove the files or supply a different directory name.')
 
 	return outdir
@@ -0,0 +1,108 @@
+"""
+Module containing functions to estimate how alignments are spread along the genome from their BAI/CRAI index
+"""
+#!/usr/bin/env python3
+
+import os
+import gzip
+import struct
+
+import numpy as np
+
+# size of the windows in the BAI linear index
+bai_window_size = 16384
+# bin holding the metadata of a reference (rather than alignments) in a BAI
+bai_metadata_bin = 37450
+
+def find_index(aln_filename, is_cram):
+	""" return the path of the index of an alignment file (None if not found) """
+	aln_filename = os.fsdecode(aln_filename)
+	extension = '.crai' if is_cram else '.bai'
+	for index_filename in [f'{aln_filename}{extension}', f'{os.path.splitext(aln_filename)[0]}{extension}']:
+		if os.path.isfile(index_filename):
+			return index_filename
+
+	return None
+
+def read_bai_windows(bai_filename, references):
+	""" return the start and compressed bytes of each window of the linear index, for each reference """
+	windows = {}
+	with open(bai_filename, 'rb') as f:
+		if f.read(4) != b'BAI\1':
+			raise ValueError(f'{bai_filename} is not a BAI index')
+		num_refs = struct.unpack('<i', f.read(4))[0]
+		for ref_id in range(num_refs):
+			data_start, data_end = None, 0
+			num_bins = struct.unpack('<i', f.read(4))[0]
+			for _ in range(num_bins):
+				bin_id, num_chunks = struct.unpack('<Ii', f.read(8))
+				chunks = np.frombuffer(f.read(16*num_chunks), dtype='<u8').reshape(-1, 2)
+				if bin_id == bai_metadata_bin:
+					# (start, end) offsets of the reference's alignments, then the number of (un)mapped reads
+					data_start, data_end = int(chunks[0, 0]) >> 16, max(data_end, int(chunks[0, 1]) >> 16)
+				elif num_chunks:
+					data_end = max(data_end, int(chunks[:, 1].max()) >> 16)
+			num_intervals = struct.unpack('<i', f.read(4))[0]
+			# compressed (block) offset of the first alignment overlapping each window
+			offsets = np.frombuffer(f.read(8*num_intervals), dtype='<u8') >> 16
+			if ref_id >= len(references) or not num_intervals:
+				continue
+			# (windows before the first alignment have no offset)
+			offsets = offsets.astype(np.int64)
+			if data_start is None:
+				data_start = int(offsets[offsets > 0].min()) if (offsets > 0).any() else 0
+			offsets = np.maximum.accumulate(np.maximum(offsets, data_start))
+			window_bytes = np.diff(np.append(offsets, max(data_end, int(offsets[-1]))))
+			windows[references[ref_id]] = (np.arange(num_intervals, dtype=np.int64) * bai_window_size, window_bytes)
+
+	return windows
+
+def read_crai_windows(crai_filename, references):
+	""" return the start and compressed bytes of each slice in the CRAI, for each reference """
+	slices = {}
+	with gzip.open(crai_filename, 'rt') as f:
+		for line in f:
+			ref_id, alignment_start, _, _, _, slice_size = [int(value) for value in line.split('\t')[:6]]
+			if ref_id < 0 or ref_id >= len(references):
+				continue # unmapped or multi-reference slice
+			slices.setdefault(references[ref_id], []).append((max(alignment_start - 1, 0), slice_size))
+	windows = {}
+	for reference, reference_slices in slices.items():
+		reference_slices.sort()
+		windows[reference] = (
+			np.array([start for start, _ in reference_slices], dtype=np.int64),
+			np.array([size for _, size in reference_slices], dtype=np.int64)
+		)
+
+	return windows
+
+def read_index_windows(aln_filename, references, is_cram):
+	""" return the genomic windows and compressed bytes of each reference from the index (None if unreadable) """
+	index_filename = find_index(aln_filename, is_cram)
+	if not index_filename:
+		return None
+	try:
+		if is_cram:
+			return read_crai_windows(index_filename, references)
+		return read_bai_windows(index_filename, references)
+	except (OSError, ValueError, struct.error):
+		return None
+
+def split_by_bytes(window_starts, window_bytes, length, target_bytes):
+	""" cut a reference into (start, end, bytes) chunks of roughly the target compressed bytes, at window starts """
+	chunks = []
+	chunk_start = 0
+	chunk_bytes = 0
+	for window_start, num_bytes in zip(window_starts.tolist(), window_bytes.tolist()):
+		if chunk_bytes >= target_bytes and window_start > chunk_start:
+			chunks.append((chunk_start, window_start, chunk_bytes))
+			chunk_start = window_start
+			chunk_bytes = 0
+		chunk_bytes += num_bytes
+	if chunk_start < length:
+		chunks.append((chunk_start, length, chunk_bytes))
+
+	return chunks
+
+if __name__ == "__main__":
+	print("Alignment index functions for SAVANA")
@@ -7,17 +7,28 @@ Hillary Elrick
 #!/usr/bin/env python3
 
 import os
+import sys
+import queue
+import shutil
 
+from copy import copy
+from bisect import bisect_left, bisect_right
+from time import time
 from math import ceil, floor
-from multiprocessing import Pool
+from statistics import median
+from itertools import product, count
+from multiprocessing import Pool, Value
 
 import pysam
-import pysam.bcftools as bcftools
 import pybedtools
+import numpy as np
 
 import savana.helper as helper
-from savana.breakpoints import get_potential_breakpoints, call_breakpoints, add_local_depth
-from savana.clusters import cluster_breakpoints, output_clusters
+import savana.checkpoint as checkpoint
+from savana.breakpoints import get_potential_breakpoints, get_split_read_loci, call_breakpoints, add_local_depth, merge_read_bounds, load_chunk_read_bounds, has_read_bounds, init_alignment_worker
+from savana.clusters import cluster_breakpoints, shard_potential_breakpoints, output_clusters, get_reach
+from savana.core import PotentialBreakpoints
+from savana.index import read_index_windows, split_by_bytes
 
 # developer dependencies
 """
@@ -27,20 +38,82 @@ import objgraph
 """
 
 
-def pool_get_potential_breakpoints(aln_files, args):
-	""" split the genome into chunks and identify PotentialBreakpoints """
-	pool_potential = Pool(processes=args.threads)
-	pool_potential_args = []
-	contigs_to_consider = helper.get_contigs(args.contigs, args.ref_index)
-	if not args.is_cram:
-		# calculate how to split contigs based on total mapped reads
+# number of chunks to split the genome into per worker thread (smaller chunks balance uneven depth better)
+chunks_per_thread = 8
+# never hand the rest of a chunk to idle workers before it has run this many seconds
+min_split_seconds = 5
+
+# scheduling state shared with the extraction workers (set by init_extraction_worker)
+worker_queued_tasks = None # chunks submitted but not yet started by a worker
+worker_split_after = None # seconds a chunk runs before the rest of it can go to idle workers (median chunk time)
+
+def init_extraction_worker(aln_filenames, is_cram, ref, ref_cache, queued_tasks, split_after):
+	""" open the alignment files and keep the shared scheduling state when an extraction worker starts """
+	global worker_queued_tasks, worker_split_after
+	init_alignment_worker(aln_filenames, is_cram, ref, ref_cache)
+	worker_queued_tasks, worker_split_after = queued_tasks, split_after
+
+def chunk_can_split(elapsed):
+	""" whether a running chunk should stop and leave the rest of its reads to idle workers """
+	return elapsed > worker_split_after.value and worker_queued_tasks.value == 0
+
+def get_chunk_potential_breakpoints(task_id, chunk_args, checkpoint_chunk):
+	""" identify the PotentialBreakpoints of a chunk, returning them with the task, where it was split (if it was) and its duration """
+	with worker_queued_tasks.get_lock():
+		worker_queued_tasks.value -= 1
+	start_time = time()
+	potential_breakpoints, split_at = get_potential_breakpoints(*chunk_args, can_split=chunk_can_split, checkpoint_chunk=checkpoint_chunk)
+
+	return task_id, potential_breakpoints, split_at, time() - start_time
+
+def split_chunk(chunk, num_pieces):
+	""" split a chunk (only reads starting in each piece are considered by it) into roughly equal lengths """
+	order, label, aln_filename, chrom, start, end, _, owned_until, _ = chunk
+	piece_size = max(ceil((end - start)/num_pieces), 1)
+	pieces = []
+	for piece_start in range(start, end, piece_size):
+		piece_end = min(piece_start + piece_size, end)
+		pieces.append((order, label, aln_filename, chrom, piece_start, piece_end, piece_start, owned_until, piece_end - piece_start))
+
+	return pieces
+
+def plan_chunks(aln_files, args, contigs_to_consider):
+	"""
+	split the genome into chunks of roughly equal work, as (order, label, filename, chrom, start, end, owned_from, owned_until, size estimate)
+	(each read is only considered by the chunk its primary alignment starts in, however many chunks it overlaps)
+	"""
+	chunks = []
+	num_chunks_total = args.threads * chunks_per_thread
+	index_windows = {label: read_index_windows(aln_file.filename, aln_file.references, args.is_cram) for label, aln_file in aln_files.items()}
+	if all(windows is not None for windows in index_windows.values()):
+		# balance the compressed bytes of alignments per chunk (from the BAI linear index or CRAI slices)
+		total_bytes = 0
+		for windows in index_windows.values():
+			total_bytes += sum([int(window_bytes.sum()) for contig, (_, window_bytes) in windows.items() if contig in contigs_to_consider])
+		target_bytes = max(ceil(total_bytes/num_chunks_total), 1)
+		for label, aln_file in aln_files.items():
+			for contig, (window_starts, window_bytes) in index_windows[label].items():
+				if contig not in contigs_to_consider:
+					if args.debug:
+						print(f'Skipping reads aligned to {contig} - not in contigs file')
+					continue
+				chrom_length = int(aln_file.get_reference_length(contig))
+				contig_chunks = split_by_bytes(window_starts, window_bytes, chrom_length, target_bytes)
+				if len(contig_chunks) > 1:
+					for start_pos, end_pos, chunk_bytes in contig_chunks:
+						chunks.append((len(chunks), label, aln_file.filename, contig, start_pos, end_pos, start_pos, None, max(chunk_bytes, 1)))
+				else:
+					# (reads of small contigs can share a compressed block with others)
+					chunks.append((len(chunks), label, aln_file.filename, contig, None, None, None, None, max(int(window_bytes.sum()), 1)))
+	elif not args.is_cram:
+		# no index to read - calculate how to split contigs based on total mapped reads
 		total_num_mapped_reads = 0
 		for label, aln_file in aln_files.items():
 			for contig in aln_file.get_index_statistics():
 				if contig.contig in contigs_to_consider:
 					total_num_mapped_reads+=contig.mapped
-		ideal_reads_per_thread = ceil(total_num_mapped_reads/args.threads)
-		# balance approx. number of reads per worker thread
+		ideal_reads_per_chunk = ceil(total_num_mapped_reads/num_chunks_total)
+		# balance approx. number of reads per chunk
 		for label, aln_file in aln_files.items():
 			for contig in aln_file.get_index_statistics():
 				if contig.contig not in contigs_to_consider:
@@ -51,21 +124,22 @@ def pool_get_potential_breakpoints(aln_files, args):
 					continue
 				mapped_reads = contig.mapped
 				chrom_length = int(aln_file.get_reference_length(contig.contig))
-				num_chunks = max(floor(mapped_reads/ideal_reads_per_thread), 1)
+				num_chunks = max(floor(mapped_reads/ideal_reads_per_chunk), 1)
 				if num_chunks > 1:
 					start_pos = 0
 					chunk_size = ceil(chrom_length/num_chunks)
 					for i in range(1, num_chunks+1):
 						end_pos = start_pos + chunk_size
 						end_pos = chrom_length if end_pos > chrom_length else end_pos # don't extend past end
-						pool_potential_args.append((aln_file.filename, args, label, contigs_to_consider, contig.contig, start_pos, end_pos))
-						start_pos = end_pos + 1
+						chunks.append((len(chunks), label, aln_file.filename, contig.contig, start_pos, end_pos, start_pos, None, mapped_reads/num_chunks))
+						start_pos = end_pos
 				else:
-					pool_potential_args.append((aln_file.filename, args, label, contigs_to_consider, contig.contig))
+					chunks.append((len(chunks), label, aln_file.filename, contig.contig, None, None, None, None, mapped_reads))
 	else:
-		# parallelize by contig (unable to see num. mapped reads per contig with cram)
-		chunk_size = 60000000 # 60 million
+		# parallelize by length (unable to see num. mapped reads per contig with cram and no index)
 		contig_lengths = helper.get_contig_lengths(args.ref_index)
+		total_length = sum([length for contig, length in contig_lengths.items() if contig in contigs_to_consider]) * len(aln_files)
+		chunk_size = min(ceil(total_length/num_chunks_total), 60000000) # at most 60 million
 		for label, aln_file in aln_files.items():
 			for contig, contig_length in contig_lengths.items():
 				if contig not in contigs_to_consider:
@@ -77,24 +151,265 @@ def pool_get_potential_breakpoints(aln_files, args):
 					for i in range(1, num_intervals):
 						end_pos = start_pos + chunk_size
 						end_pos = contig_length if end_pos > contig_length else end_pos # don't extend past end
-						pool_potential_args.append((aln_file.filename, args, label, contigs_to_consider, contig, start_pos, end_pos))
-						start_pos = end_pos + 1
+						chunks.append((len(chunks), label, aln_file.filename, contig, start_pos, end_pos, start_pos, None, end_pos - start_pos))
+						start_pos = end_pos
 				else:
-					pool_potential_args.append((aln_file.filename, args, label, contigs_to_consider, contig))
+					chunks.append((len(chunks), label, aln_file.filename, contig, None, None, None, None, contig_length))
 
-	print(f'Submitting {len(pool_potential_args)} "get_potential_breakpoints" tasks to {args.threads} worker threads')
+	return chunks
 
-	potential_breakpoints_results = pool_potential.starmap(get_potential_breakpoints, pool_potential_args)
+def get_candidate_regions(args, potential_breakpoints_results, contigs_to_consider, contig_lengths):
+	""" return the merged regions (by chrom) spanned by the clusters of tumour evidence and around the other ends of their breakpoints """
+	chrom_potential_breakpoints = PotentialBreakpoints.concatenate(potential_breakpoints_results).split_by_chrom()
+	clusters = pool_cluster_breakpoints(args.threads, args.buffer, args.insertion_buffer, chrom_potential_breakpoints)
+	intervals = {}
+	for chrom_clusters in clusters.values():
+		for bp_type, stack in chrom_clusters.items():
+			# evidence within two buffers of a cluster could be clustered with it
+			padding = 2*(args.insertion_buffer if bp_type == "<INS>" else args.buffer)
+			for cluster in stack:
+				intervals.setdefault(cluster.chr, []).append((cluster.start - padding, cluster.end + padding + 1))
+				for bp in cluster.breakpoints:
+					intervals.setdefault(bp.end_chr, []).append((bp.end_loc - padding, bp.end_loc + padding + 1))
+
+	return clip_regions(intervals, contigs_to_consider, contig_lengths)
+
+def get_linked_regions(args, potential_breakpoints, regions, contigs_to_consider, contig_lengths):
+	""" return the regions (by chrom) outside of those given which the evidence starting in them could be clustered with """
+	potential_breakpoints.consolidate()
+	columns = potential_breakpoints.columns
+	# evidence is clustered with what starts within two buffers of how far it reaches
+	is_insertion = columns['notation'] == PotentialBreakpoints.notations.index("<INS>")
+	padding = np.where(is_insertion, 2*args.insertion_buffer, 2*args.buffer)
+	reach = get_reach(potential_breakpoints)
+	intervals = {}
+	for chrom, chrom_regions in regions.items():
+		if chrom not in potential_breakpoints.contig_ids:
+			continue
+		rows = np.flatnonzero(columns['start_chr'] == potential_breakpoints.contig_ids[chrom])
+		starts = columns['start_loc'][rows]
+		region_starts = np.array([region_start for region_start, _ in chrom_regions], dtype=np.int64)
+		region_ends = np.array([region_end for _, region_end in chrom_regions], dtype=np.int64)
+		i = np.searchsorted(region_starts, starts, side='right') - 1
+		rows = rows[(i >= 0) & (starts < region_ends[np.maximum(i, 0)])]
+		intervals[chrom] = list(zip((columns['start_loc'][rows] - padding[rows]).tolist(), (reach[rows] + padding[rows] + 1).tolist()))
+	linked_regions = {}
+	for chrom, chrom_regions in clip_regions(intervals, contigs_to_consider, contig_lengths).items():
+		chrom_regions = subtract_intervals(chrom_regions, regions.get(chrom, []))
+		if chrom_regions:
+			linked_regions[chrom] = chrom_regions
+
+	return linked_regions
+
+def clip_regions(intervals, contigs_to_consider, contig_lengths):
+	""" merge the (start, end) intervals of the contigs considered (by chrom), clipped to their lengths """
+	regions = {}
+	for chrom, chrom_intervals in intervals.items():
+		if chrom not in contigs_to_consider or chrom not in contig_lengths:
+			continue
+		chrom_intervals = [(max(start, 0), min(end, contig_lengths[chrom])) for start, end in chrom_intervals]
+		chrom_intervals = merge_intervals([(start, end) for start, end in chrom_intervals if start < end])
+		if chrom_intervals:
+			regions[chrom] = chrom_intervals
+
+	return regions
+
+def merge_intervals(intervals):
+	""" merge overlapping (start, end) intervals """
+	merged = []
+	for start, end in sorted(intervals):
+		if merged and start <= merged[-1][1]:
+			merged[-1][1] = max(merged[-1][1], end)
+		else:
+			merged.append([start, end])
+
+	return [tuple(interval) for interval in merged]
+
+def subtract_intervals(intervals, removed):
+	""" return the parts of merged (start, end) intervals which aren't covered by the merged removed ones """
+	remaining = []
+	i = 0
+	for start, end in intervals:
+		while i < len(removed) and removed[i][1] <= start:
+			i += 1
+		j = i
+		while start < end and j < len(removed) and removed[j][0] < end:
+			if removed[j][0] > start:
+				remaining.append((start, removed[j][0]))
+			start = max(start, removed[j][1])
+			j += 1
+		if start < end:
+			remaining.append((start, end))
+
+	return remaining
+
+def plan_region_chunks(label, aln_filename, regions, first_order, read_regions=None):
+	""" one chunk per region (each read is only considered by the first region it overlaps, unless it overlaps one already read) """
+	chunks = []
+	for chrom, chrom_regions in regions.items():
+		chrom_read_regions = read_regions.get(chrom, []) if read_regions else []
+		read_starts = [read_start for read_start, _ in chrom_read_regions]
+		read_ends = [read_end for _, read_end in chrom_read_regions]
+		previous_end = None
+		for start, end in chrom_regions:
+			# reads starting before the end of the previous region (or of one already read) overlap it
+			i = bisect_right(read_ends, start)
+			owned_from = max([position for position in (previous_end, read_ends[i-1] if i else None) if position is not None], default=None)
+			# as do those ending after the start of the next region already read
+			j = bisect_left(read_starts, end)
+			owned_until = read_starts[j] if j < len(read_starts) else None
+			chunks.append((first_order + len(chunks), label, aln_filename, chrom, start, end, owned_from, owned_until, end - start))
+			previous_end = end
+
+	return chunks
+
+def run_targeted_normal(pool_potential, aln_files, args, contigs_to_consider, tumour_results, first_order, queued_tasks, split_after):
+	"""
+	identify the PotentialBreakpoints of the normal around the clusters of tumour evidence, returning them with their chunks -
+	the regions are extended (in rounds) to the evidence clustered with them and to the other alignments of reads split across them
+	"""
+	contig_lengths = {contig: aln_files['normal'].get_reference_length(contig) for contig in aln_files['normal'].references}
+	total_length = sum([length for contig, length in contig_lengths.items() if contig in contigs_to_consider])
+	normal_filename = aln_files['normal'].filename
+	# (normal depth is read around each breakpoint rather than from a coverage store)
+	normal_args = copy(args)
+	normal_args.coverage_dir = None
+	candidate_regions, read_regions = {}, {}
+	new_regions = get_candidate_regions(args, tumour_results, contigs_to_consider, contig_lengths)
+	completed_chunks, results = [], []
+	while new_regions:
+		# reads split across the regions are only considered from their primary alignment
+		split_read_loci = pool_potential.starmap(get_split_read_loci, [(normal_filename, normal_args, chrom, start, end) for chrom, chrom_regions in new_regions.items() for start, end in chrom_regions])
+		intervals = {chrom: list(chrom_regions) for chrom, chrom_regions in new_regions.items()}
+		for chrom, position in set([locus for loci in split_read_loci for locus in loci]):
+			intervals.setdefault(chrom, []).append((position, position + 1))
+		regions = {}
+		for chrom, chrom_regions in clip_regions(intervals, contigs_to_consider, contig_lengths).items():
+			chrom_regions = subtract_intervals(chrom_regions, read_regions.get(chrom, []))
+			if chrom_regions:
+				regions[chrom] = chrom_regions
+		chunks = plan_region_chunks('normal', normal_filename, regions, first_order + len(completed_chunks), read_regions)
+		round_chunks, round_results = run_chunks(pool_potential, chunks, aln_files, normal_args, contigs_to_consider, queued_tasks, split_after)
+		completed_chunks.extend(round_chunks)
+		results.extend(round_results)
+		read_regions = {chrom: merge_intervals(read_regions.get(chrom, []) + regions.get(chrom, [])) for chrom in set(read_regions) | set(regions)}
+		candidate_regions = {chrom: merge_intervals(candidate_regions.get(chrom, []) + new_regions.get(chrom, [])) for chrom in set(candidate_regions) | set(new_regions)}
+		# evidence in the normal can extend the clusters
+		new_regions = get_linked_regions(args, PotentialBreakpoints.concatenate(tumour_results + results), candidate_regions, contigs_to_consider, contig_lengths)
+	region_length = sum([end - start for chrom_regions in read_regions.values() for start, end in chrom_regions])
+	print(f'Read the normal in {sum([len(r) for r in read_regions.values()])} regions ({region_length} bp, {100*region_length/max(total_length, 1):.2f}% of contigs considered)')
+
+	return completed_chunks, results
+
+def run_chunks(pool_potential, chunks, aln_files, args, contigs_to_consider, queued_tasks, split_after):
+	"""
+	identify the PotentialBreakpoints of the planned chunks, returning them in order (as (order, label, chrom, start, end)) with
+	their results - once no chunks are waiting, the rest of any running longer than usual is split between the idle workers
+	"""
+	finished = queue.Queue()
+	running = {}
+	task_ids = count()
+	pieces = {chunk[0]: [] for chunk in chunks}
+	def submit(chunk, is_piece):
+		task_id = next(task_ids)
+		running[task_id] = chunk
+		_, label, aln_filename, chrom, start, end, owned_from, owned_until, _ = chunk
+		with queued_tasks.get_lock():
+			queued_tasks.value += 1
+		pool_potential.apply_async(get_chunk_potential_breakpoints,
+			(task_id, (aln_filename, args, label, contigs_to_consider, chrom, start, end, owned_from, owned_until), not is_piece),
+			callback=finished.put, error_callback=finished.put)
+
+	# dispatch the biggest chunks first and collect them as they finish
+	planned_chunks = {chunk[0]: chunk for chunk in chunks}
+	print(f'Submitting {len(chunks)} "get_potential_breakpoints" tasks to {args.threads} worker threads')
+	for chunk in sorted(chunks, key=lambda chunk: chunk[8], reverse=True):
+		submit(chunk, False)
+	durations = []
+	results = {}
+	while running:
+		result = finished.get()
+		if isinstance(result, BaseException):
+			raise result
+		task_id, potential_breakpoints, split_at, duration = result
+		order, label, aln_filename, chrom, start, end, owned_from, owned_until, size = running.pop(task_id)
+		durations.append(duration)
+		split_after.value = max(median(durations), min_split_seconds)
+		if split_at is not None:
+			if end is None:
+				end = aln_files[label].get_reference_length(chrom)
+			# hand the rest to the workers that are idle (and the one that just finished)
+			num_idle = args.threads - (len(running) - queued_tasks.value)
+			remainder = (order, label, aln_filename, chrom, split_at, end, split_at, owned_until, size*(end - split_at)/(end - (start if start else 0)))
+			for piece in split_chunk(remainder, max(num_idle, 1)):
+				submit(piece, True)
+			start, end = (start if start else 0), split_at
+		pieces[order].append((start, end, potential_breakpoints))
+		if any(chunk[0] == order for chunk in running.values()):
+			continue # other pieces of the planned chunk are still running
+		results[order] = combine_pieces(args, planned_chunks[order], pieces.pop(order))
+	completed_chunks = [(order, label, chrom, start, end) for order, label, _, chrom, start, end, _, _, _ in sorted(planned_chunks.values())]
+
+	return completed_chunks, [results[chunk[0]] for chunk in completed_chunks]
+
+def combine_pieces(args, chunk, pieces):
+	""" return the PotentialBreakpoints of a planned chunk from those of its pieces (storing them as one chunk in the checkpoint) """
+	if len(pieces) == 1:
+		return pieces[0][2]
+	_, label, _, chrom, start, end, _, _, _ = chunk
+	pieces.sort(key=lambda piece: piece[0])
+	potential_breakpoints = PotentialBreakpoints.concatenate([piece[2] for piece in pieces])
+	if args.checkpoint_dir:
+		read_bounds = load_chunk_read_bounds(args.coverage_dir, label, chrom, [piece[0] for piece in pieces]) if args.coverage_dir else None
+		checkpoint.save_potential_breakpoints(args.checkpoint_dir, label, chrom, start, end, potential_breakpoints, read_bounds)
+
+	return potential_breakpoints
+
+def pool_get_potential_breakpoints(aln_files, args):
+	""" split the genome into chunks and identify PotentialBreakpoints """
+	# each worker opens the alignment files once and fetches every chunk it is given from them
+	aln_filenames = [aln_file.filename for aln_file in aln_files.values()]
+	queued_tasks, split_after = Value('i', 0), Value('d', float(min_split_seconds))
+	pool_potential = Pool(processes=args.threads, initializer=init_extraction_worker,
+		initargs=(aln_filenames, args.is_cram, None if args.ref_cache else args.ref, args.ref_cache, queued_tasks, split_after))
+	contigs_to_consider = helper.get_contigs(args.contigs, args.ref_index)
+	if args.targeted_normal:
+		# identify the tumour evidence first
+		chunks = plan_chunks({'tumour': aln_files['tumour']}, args, contigs_to_consider)
+		completed_chunks, results = run_chunks(pool_potential, chunks, aln_files, args, contigs_to_consider, queued_tasks, split_after)
+		# and only read the normal around where it clusters
+		normal_completed_chunks, normal_results = run_targeted_normal(pool_potential, aln_files, args, contigs_to_consider, results, len(completed_chunks), queued_tasks, split_after)
+		completed_chunks.extend(normal_completed_chunks)
+		results.extend(normal_results)
+	else:
+		chunks = plan_chunks(aln_files, args, contigs_to_consider)
+		completed_chunks, results = run_chunks(pool_potential, chunks, aln_files, args, contigs_to_consider, queued_tasks, split_after)
 	pool_potential.close()
 	pool_potential.join()
+	# in the order they were planned
+	sorted_indices = sorted(range(len(completed_chunks)), key=lambda i: (completed_chunks[i][0], completed_chunks[i][3] or 0))
+	potential_breakpoints_results = [results[i] for i in sorted_indices]
+	if args.coverage_dir:
+		merge_read_bounds(args.coverage_dir)
+	if args.checkpoint_dir:
+		# record the order of the chunks so their potential breakpoints can be re-loaded (label, chrom, [start, end])
+		chunks = []
+		for i in sorted_indices:
+			_, label, chrom, start, end = completed_chunks[i]
+			chunks.append([label, chrom] if start is None else [label, chrom, start, end])
+		checkpoint.mark_complete(args.checkpoint_dir, 'potential_breakpoints', {'coverage': bool(args.coverage_dir), 'chunks': chunks})
 	return potential_breakpoints_results
 
 def pool_cluster_breakpoints(threads, buffer, ins_buffer, chrom_potential_breakpoints):
 	""" perform initial clustering of Potential Breakpoints """
 	pool_clustering = Pool(processes=threads)
 	pool_clustering_args = []
+	# split chromosomes into shards that can be clustered independently
+	total_breakpoints = sum(len(breakpoints) for breakpoints in chrom_potential_breakpoints.values())
+	shard_size = max(ceil(total_breakpoints/threads), 1)
 	for chrom, breakpoints in chrom_potential_breakpoints.items():
-		pool_clustering_args.append((chrom, breakpoints, buffer, ins_buffer))
+		for shard in shard_potential_breakpoints(breakpoints, buffer, ins_buffer, shard_size):
+			pool_clustering_args.append((chrom, shard, buffer, ins_buffer))
 	clustering_results = pool_clustering.starmap(cluster_breakpoints, pool_clustering_args)
 	pool_clustering.close()
 	pool_clustering.join()
@@ -112,6 +427,10 @@ def pool_cluster_breakpoints(threads, buffer, ins_buffer, chrom_potential_breakp
 	for chrom, result in clustering_results:
 		if chrom not in clusters:
 			clusters[chrom] = result
+		else:
+			# stitch shards back together (in order)
+			for bp_type, stack in result.items():
+				clusters[chrom][bp_type].extend(stack)
 
 	return clusters
 
@@ -128,7 +447,7 @@ def pool_output_clusters(args, clusters, outdir):
 	pool_output.close()
 	pool_output.join()
 
-def pool_add_local_depth(threads, sorted_bed, breakpoint_dict_chrom, aln_files, is_cram=False, ref=False):
+def pool_add_local_depth(threads, sorted_bed, breakpoint_dict_chrom, aln_files, is_cram=False, ref=False, coverage_dir=None, ref_cache=None):
 	""" """
 	from itertools import groupby
 
@@ -161,13 +480,14 @@ def pool_add_local_depth(threads, sorted_bed, breakpoint_dict_chrom, aln_files,
 	max_tasks = floor(max_total_intervals_per_child/max_bin)
 	print(f'Setting maxtasksperchild to {max_tasks}')
 
-	pool_local_depth = Pool(processes=threads, maxtasksperchild=max_tasks)
-	pool_local_depth_args = []
 	# convert aln_files into filenames (rather than objects - breaks parallelization)
-	for label in aln_files.keys():
-		aln_files[label] = aln_files[label].filename
+	aln_filenames = {label: aln_file.filename for label, aln_file in aln_files.items()}
+	# open them once per worker (unless reading their depths from the coverage store)
+	pool_local_depth = Pool(processes=threads, maxtasksperchild=max_tasks, initializer=init_alignment_worker,
+		initargs=([aln_filename for label, aln_filename in aln_filenames.items() if not has_read_bounds(coverage_dir, label)], is_cram, ref, ref_cache))
+	pool_local_depth_args = []
 	for chrom_split in redistributed_intervals:
-		pool_local_depth_args.append((chrom_split, aln_files, is_cram, ref))
+		pool_local_depth_args.append((chrom_split, aln_filenames, is_cram, ref, coverage_dir))
 	local_depth_results = pool_local_depth.starmap(add_local_depth, pool_local_depth_args)
 
 	uid_dp_dict = {}
@@ -204,17 +524,33 @@ def pool_call_breakpoints(threads, buffer, length, depth, clusters, debug):
 	""" parallelise the identification of consensus breakpoints """
 	pool_calling = Pool(processes=threads)
 	pool_calling_args = []
-
+	# clusters are called independently so split them into shards of similar numbers of breakpoints
+	total_breakpoints = 0
+	for chrom_clusters in clusters.values():
+		for bp_type_clusters in chrom_clusters.values():
+			total_breakpoints += sum(len(cluster.breakpoints) for cluster in bp_type_clusters)
+	shard_size = max(ceil(total_breakpoints/threads), 1)
 	for chrom, chrom_clusters in clusters.items():
-		pool_calling_args.append((chrom_clusters, buffer, length, depth, chrom))
+		for bp_type, bp_type_clusters in chrom_clusters.items():
+			shard, shard_breakpoints = [], 0
+			for cluster in bp_type_clusters:
+				shard.append(cluster)
+				shard_breakpoints += len(cluster.breakpoints)
+				if shard_breakpoints >= shard_size:
+					pool_calling_args.append(({bp_type: shard}, buffer, length, depth, chrom))
+					shard, shard_breakpoints = [], 0
+			if shard:
+				pool_calling_args.append(({bp_type: shard}, buffer, length, depth, chrom))
 	calling_results = pool_calling.starmap(call_breakpoints, pool_calling_args)
+	pool_calling.close()
+	pool_calling.join()
 
-	breakpoint_dict_chrom = {}
+	breakpoint_dict_chrom = {chrom: [] for chrom in clusters.keys()}
 	seen_cluster_uids = {}
 	pruned_clusters = {} if debug else None
 	for result_breakpoints, result_pruned_clusters, result_chrom in calling_results:
-		# collect breakpoint calling results
-		breakpoint_dict_chrom[result_chrom] = result_breakpoints
+		# collect breakpoint calling results (shards are in order)
+		breakpoint_dict_chrom[result_chrom].extend(result_breakpoints)
 		if debug:
 			for bp_type in result_pruned_clusters.keys():
 				for cluster in result_pruned_clusters[bp_type]:
@@ -224,39 +560,8 @@ def pool_call_breakpoints(threads, buffer, length, depth, clusters, debug):
 
 	return breakpoint_dict_chrom, pruned_clusters
 
-def spawn_processes(args, aln_files, checkpoints, time_str, outdir):
-	""" run main algorithm steps in parallel processes """
-	print(f'Using multiprocessing with {args.threads} threads\n')
-	# 1) GET POTENTIAL BREAKPOINTS
-	potential_breakpoints_results = pool_get_potential_breakpoints(aln_files, args)
-	helper.time_function("Identified potential breakpoints", checkpoints, time_str)
-	# collect results per chrom
-	chrom_potential_breakpoints = {}
-	for result in potential_breakpoints_results:
-		for chrom, potential_breakpoints in result.items():
-			chrom_potential_breakpoints.setdefault(chrom,[]).extend(potential_breakpoints)
-
-	# 2) CLUSTER POTENTIAL BREAKPOINTS
-	clusters = pool_cluster_breakpoints(args.threads, args.buffer, args.insertion_buffer, chrom_potential_breakpoints)
-	helper.time_function("Clustered potential breakpoints", checkpoints, time_str)
-
-	# 3) CALL BREAKPOINTS FROM CLUSTERS
-	breakpoint_dict_chrom, pruned_clusters = pool_call_breakpoints(args.threads, args.buffer, args.length, args.depth, clusters, args.debug)
-	helper.time_function("Called consensus breakpoints", checkpoints, time_str)
-
-	total_breakpoints = 0
-	for c, b in breakpoint_dict_chrom.items():
-		total_breakpoints+=len(b)
-	print(f'Length after: {total_breakpoints}')
-
-	if args.debug:
-		# 3.1) OUTPUT CLUSTERS
-		for bp_type in ["+-", "++", "-+", "--", "<INS>"]:
-			if bp_type in pruned_clusters:
-				pool_output_clusters(args, pruned_clusters[bp_type], outdir)
-		helper.time_function("Output pruned clusters", checkpoints, time_str)
-
-	# 4) ADD LOCAL DEPTH
+def add_breakpoint_depths(args, breakpoint_dict_chrom, aln_files):
+	""" calculate the local depth of the tumour and normal files around each breakpoint """
 	# generate interval files
 	bed_string = ''
 	total_num_breakpoints = 0
@@ -270,37 +575,201 @@ def spawn_processes(args, aln_files, checkpoints, time_str, outdir):
 			bed_string += bp.as_bed(contig_lengths)
 	sorted_bed = pybedtools.BedTool(bed_string, from_string=True).sort(faidx=args.ref_index)
 	print(f'Total breakpoints: {total_num_breakpoints} ({total_num_insertions} insertions)')
-	pool_add_local_depth(args.threads, sorted_bed, breakpoint_dict_chrom, aln_files, args.is_cram, args.ref)
-	helper.time_function("Added local depth to breakpoints", checkpoints, time_str)
-
-	# 5) OUTPUT BREAKPOINTS
+	pool_add_local_depth(args.threads, sorted_bed, breakpoint_dict_chrom, aln_files, args.is_cram, None if args.ref_cache else args.ref, args.coverage_dir, args.ref_cache)
+
+def get_sorted_vcf_lines(contig_breakpoints, contig_order, ref_bases):
+	""" yield the vcf lines of the breakpoints a contig at a time, only holding the mates on later contigs """
+	mate_records = {}
+	for contig_index in range(len(contig_order)):
+		records = mate_records.pop(contig_index, [])
+		for bp in contig_breakpoints.pop(contig_index, []):
+			start_position, end_position = bp.get_ref_positions()
+			for record in bp.as_vcf_records(ref_bases[start_position], ref_bases[end_position]):
+				record_index = contig_order[record[0]]
+				if record_index == contig_index:
+					records.append(record)
+				else:
+					mate_records.setdefault(record_index, []).append(record)
+		# sort by position and then (case-insensitive) alleles
+		records.sort(key=lambda record: (int(record[1]), record[3].lower(), record[4].lower()))
+		for record in records:
+			yield "\t".join(record)+"\n"
+
+def output_breakpoints(args, breakpoint_dict_chrom, outdir):
+	""" write the breakpoints to BEDPE and read support TSV files and a coordinate-sorted VCF in the outdir """
 	# define filenames
 	vcf_file = os.path.join(outdir, f'{args.sample}.sv_breakpoints.vcf')
 	bedpe_file = os.path.join(outdir, f'{args.sample}.sv_breakpoints.bedpe')
 	tsv_file = os.path.join(outdir, f'{args.sample}.sv_breakpoints_read_support.tsv')
-	# build strings
 	ref_fasta = pysam.FastaFile(args.ref)
-	bedpe_string = ''
-	vcf_string = helper.generate_vcf_header(args, breakpoint_dict_chrom[list(breakpoint_dict_chrom.keys())[0]][0])
-	read_support_string = 'VARIANT_ID\tTUMOUR_SUPPORTING_READS\tNORMAL_SUPPORTING_READS\n'
+	contig_order = {contig: i for i, contig in enumerate(helper.get_contig_lengths(args.ref_index))}
+	vcf_header = helper.generate_vcf_header(args, breakpoint_dict_chrom[list(breakpoint_dict_chrom.keys())[0]][0])
+	# look up the reference bases of all breakpoints at once
+	ref_bases = helper.get_reference_bases(ref_fasta, (position for chrom_breakpoints in breakpoint_dict_chrom.values() for bp in chrom_breakpoints for position in bp.get_ref_positions()))
+	# stream the bedpe and read support, keeping the breakpoints by the first contig (in reference order) they're on
+	contig_breakpoints = {}
 	count = 0
-	for chrom, chrom_breakpoints in breakpoint_dict_chrom.items():
-		for bp in chrom_breakpoints:
-			bedpe_string += bp.as_bedpe(count)
-			vcf_string += bp.as_vcf(ref_fasta)
-			read_support_string += bp.as_read_support(count)
-			count+=1
-	# write output files
-	with open(vcf_file, 'w') as output:
-		output.write(vcf_string)
-	with open(bedpe_file, 'w') as output:
-		output.write(bedpe_string)
-	with open(tsv_file, 'w') as output:
-		output.write(read_support_string)
-	# sort vcf
-	bcftools.sort('-o', vcf_file, vcf_file, catch_stdout=False)
+	with open(bedpe_file, 'w') as bedpe_output, open(tsv_file, 'w') as tsv_output:
+		tsv_output.write('VARIANT_ID\tTUMOUR_SUPPORTING_READS\tNORMAL_SUPPORTING_READS\n')
+		for chrom, chrom_breakpoints in breakpoint_dict_chrom.items():
+			for bp in chrom_breakpoints:
+				bedpe_output.write(bp.as_bedpe(count))
+				tsv_output.write(bp.as_read_support(count))
+				contig_breakpoints.setdefault(min(contig_order[bp.start_chr], contig_order[bp.end_chr]), []).append(bp)
+				count+=1
+	vcf_lines = get_sorted_vcf_lines(contig_breakpoints, contig_order, ref_bases)
+	if args.bgzip:
+		# compress and index with tabix
+		with pysam.BGZFile(f'{vcf_file}.gz', 'wb') as output:
+			output.write(vcf_header.encode())
+			for line in vcf_lines:
+				output.write(line.encode())
+		pysam.tabix_index(f'{vcf_file}.gz', preset='vcf', force=True)
+	else:
+		with open(vcf_file, 'w') as output:
+			output.write(vcf_header)
+			output.writelines(vcf_lines)
+
+def spawn_processes(args, aln_files, checkpoints, time_str, outdir):
+	""" run main algorithm steps in parallel processes """
+	print(f'Using multiprocessing with {args.threads} threads\n')
+	# store read coverage while extracting breakpoints to avoid re-reading alignments for depth
+	args.coverage_dir = os.path.join(outdir, 'coverage') if args.single_pass else None
+	if args.checkpoint_dir:
+		# discard stale checkpoints and keep coverage alongside the potential breakpoints it was recorded with
+		checkpoint.prepare_checkpoint_dir(args)
+		if args.single_pass:
+			args.coverage_dir = os.path.join(args.checkpoint_dir, 'potential_breakpoints', 'coverage')
+	# share one cached copy of the reference between the CRAM decoders of all workers (kept if given or checkpointing)
+	temporary_ref_cache = args.is_cram and not args.ref_cache and not args.checkpoint_dir
+	if not args.is_cram:
+		args.ref_cache = None
+	elif not args.ref_cache:
+		args.ref_cache = os.path.join(args.checkpoint_dir if args.checkpoint_dir else outdir, 'ref_cache')
+	if args.ref_cache:
+		if helper.populate_ref_cache(args.ref, args.ref_cache, aln_files, helper.get_contigs(args.contigs, args.ref_index)):
+			helper.time_function("Populated reference cache", checkpoints, time_str)
+		else:
+			print('Unable to cache the reference sequences of the CRAM files (missing or mismatched MD5s) - decoding from the fasta')
+			if temporary_ref_cache:
+				shutil.rmtree(args.ref_cache, ignore_errors=True)
+			args.ref_cache = None
+	consensus = checkpoint.load_stage(args.checkpoint_dir, 'consensus_breakpoints') if checkpoint.is_complete(args.checkpoint_dir, 'consensus_breakpoints') else None
+	if consensus:
+		breakpoint_dict_chrom, pruned_clusters = consensus
+		helper.time_function("Loaded breakpoints from checkpoint", checkpoints, time_str)
+	else:
+		clusters = checkpoint.load_clusters(args.checkpoint_dir)
+		if clusters is not None:
+			helper.time_function("Loaded clusters from checkpoint", checkpoints, time_str)
+		else:
+			# 1) GET POTENTIAL BREAKPOINTS
+			if checkpoint.is_complete(args.checkpoint_dir, 'potential_breakpoints'):
+				# (whatever chunks they were identified in)
+				chrom_potential_breakpoints = checkpoint.load_cached_potential_breakpoints(args.checkpoint_dir).split_by_chrom()
+				helper.time_function("Loaded cached potential breakpoints", checkpoints, time_str)
+			else:
+				if args.coverage_dir and os.path.isdir(args.coverage_dir):
+					shutil.rmtree(args.coverage_dir)
+				potential_breakpoints_results = pool_get_potential_breakpoints(aln_files, args)
+				helper.time_function("Identified potential breakpoints", checkpoints, time_str)
+				# collect results per chrom
+				chrom_potential_breakpoints = PotentialBreakpoints.concatenate(potential_breakpoints_results).split_by_chrom()
+				del potential_breakpoints_results
+
+			# 2) CLUSTER POTENTIAL BREAKPOINTS
+			clusters = pool_cluster_breakpoints(args.threads, args.buffer, args.insertion_buffer, chrom_potential_breakpoints)
+			if args.checkpoint_dir:
+				checkpoint.save_clusters(args.checkpoint_dir, clusters)
+			helper.time_function("Clustered potential breakpoints", checkpoints, time_str)
+
+		# 3) CALL BREAKPOINTS FROM CLUSTERS
+		breakpoint_dict_chrom, pruned_clusters = pool_call_breakpoints(args.threads, args.buffer, args.length, args.depth, clusters, args.debug)
+		if args.checkpoint_dir:
+			checkpoint.save_stage(args.checkpoint_dir, 'consensus_breakpoints', (breakpoint_dict_chrom, pruned_clusters))
+			checkpoint.mark_complete(args.checkpoint_dir, 'consensus_breakpoints')
+		helper.time_function("Called consensus breakpoints", checkpoints, time_str)
+
+	total_breakpoints = 0
+	for c, b in breakpoint_dict_chrom.items():
+		total_breakpoints+=len(b)
+	print(f'Length after: {total_breakpoints}')
+
+	if args.debug:
+		# 3.1) OUTPUT CLUSTERS
+		for bp_type in ["+-", "++", "-+", "--", "<INS>"]:
+			if bp_type in pruned_clusters:
+				pool_output_clusters(args, pruned_clusters[bp_type], outdir)
+		helper.time_function("Output pruned clusters", checkpoints, time_str)
+
+	# 4) ADD LOCAL DEPTH
+	local_depths = checkpoint.load_stage(args.checkpoint_dir, 'local_depths') if checkpoint.is_complete(args.checkpoint_dir, 'local_depths') else None
+	if local_depths:
+		for chrom_breakpoints in breakpoint_dict_chrom.values():
+			for bp in chrom_breakpoints:
+				bp.local_depths = local_depths[bp.uid]
+		helper.time_function("Loaded local depth from checkpoint", checkpoints, time_str)
+	else:
+		if args.coverage_dir and args.checkpoint_dir and not (checkpoint.is_complete(args.checkpoint_dir, 'potential_breakpoints') or {}).get('coverage'):
+			# coverage wasn't recorded by the run which identified the potential breakpoints
+			print('No read coverage stored in checkpoint - reading alignments for local depth')
+			args.coverage_dir = None
+		add_breakpoint_depths(args, breakpoint_dict_chrom, aln_files)
+		if args.checkpoint_dir:
+			local_depths = {bp.uid: bp.local_depths for chrom_breakpoints in breakpoint_dict_chrom.values() for bp in chrom_breakpoints}
+			checkpoint.save_stage(args.checkpoint_dir, 'local_depths', local_depths)
+			checkpoint.mark_complete(args.checkpoint_dir, 'local_depths')
+		helper.time_function("Added local depth to breakpoints", checkpoints, time_str)
 
+	# 5) OUTPUT BREAKPOINTS
+	output_breakpoints(args, breakpoint_dict_chrom, outdir)
 	helper.time_function("Output consensus breakpoints", checkpoints, time_str)
+	if args.ref_cache and temporary_ref_cache:
+		shutil.rmtree(args.ref_cache)
+
+	return checkpoints, time_str
+
+def recall_breakpoints(args, checkpoints, time_str, outdir):
+	""" re-cluster and call breakpoints from cached potential breakpoints for each combination of parameters """
+	run_args = checkpoint.load_run_args(args.checkpoint_dir)
+	if min(args.length) < run_args.length:
+		sys.exit(f'Unable to re-call with a --length below {run_args.length} (the length used when the potential breakpoints were cached)')
+	run_args.threads = args.threads
+	run_args.debug = args.debug
+	run_args.bgzip = args.bgzip
+	stage_info = checkpoint.is_complete(args.checkpoint_dir, 'potential_breakpoints')
+	run_args.coverage_dir = os.path.join(args.checkpoint_dir, 'potential_breakpoints', 'coverage') if stage_info['coverage'] else None
+	run_args.ref_cache = None
+	run_args.targeted_normal = getattr(run_args, 'targeted_normal', False)
+	if run_args.targeted_normal and max(args.buffer + args.insertion_buffer) > max(run_args.buffer, run_args.insertion_buffer):
+		print(f'WARNING: the normal was only read within {2*max(run_args.buffer, run_args.insertion_buffer)}bp of the tumour clusters (--targeted_normal) - normal evidence may be missing with larger buffers')
+	chrom_potential_breakpoints = checkpoint.load_cached_potential_breakpoints(args.checkpoint_dir).split_by_chrom()
+	helper.time_function("Loaded cached potential breakpoints", checkpoints, time_str)
+
+	parameter_sets = list(product(args.buffer, args.insertion_buffer, args.length, args.depth))
+	print(f'Re-calling breakpoints for {len(parameter_sets)} parameter combination(s)')
+	aln_mode = "rc" if run_args.is_cram else "rb"
+	aln_files = {
+		'tumour': pysam.AlignmentFile(run_args.tumour, aln_mode, reference_filename=run_args.ref),
+		'normal': pysam.AlignmentFile(run_args.normal, aln_mode, reference_filename=run_args.ref)
+	}
+	for buffer, insertion_buffer, length, depth in parameter_sets:
+		call_args = copy(run_args)
+		call_args.buffer, call_args.insertion_buffer, call_args.length, call_args.depth = buffer, insertion_buffer, length, depth
+		call_outdir = os.path.join(outdir, f'buffer{buffer}_insertion_buffer{insertion_buffer}_length{length}_depth{depth}')
+		os.mkdir(call_outdir)
+		print(f'Re-calling breakpoints into {call_outdir}')
+		clusters = pool_cluster_breakpoints(call_args.threads, buffer, insertion_buffer, chrom_potential_breakpoints)
+		breakpoint_dict_chrom, pruned_clusters = pool_call_breakpoints(call_args.threads, buffer, length, depth, clusters, call_args.debug)
+		if call_args.debug:
+			for bp_type in ["+-", "++", "-+", "--", "<INS>"]:
+				if bp_type in pruned_clusters:
+					pool_output_clusters(call_args, pruned_clusters[bp_type], call_outdir)
+		add_breakpoint_depths(call_args, breakpoint_dict_chrom, aln_files)
+		output_breakpoints(call_args, breakpoint_dict_chrom, call_outdir)
+		helper.time_function("Re-called breakpoints", checkpoints, time_str)
+	for aln_file in aln_files.values():
+		aln_file.close()
 
 	return checkpoints, time_str
 
@@ -13,13 +13,8 @@ import argparse
 from time import time
 from multiprocessing import cpu_count
 
-import pysam
-
-import savana.run as run
-import savana.evaluate as evaluate
-import savana.train as train
-import savana.classify as classify
 import savana.helper as helper
+# sub-command modules (and their heavy dependencies) are imported by the functions which run them
 
 logo = """
 ███████  █████  ██    ██  █████  ███    ██  █████
@@ -31,11 +26,15 @@ logo = """
 
 def savana_run(args):
 	""" main function for SAVANA """
+	import pysam
+	import savana.run as run
 	if not args.sample:
 		# set sample name to default if req.
 		args.sample = os.path.splitext(os.path.basename(args.tumour))[0]
 	print(f'Running as sample {args.sample}')
-	outdir = helper.check_outdir(args.outdir)
+	if args.resume and not args.checkpoint_dir:
+		sys.exit('The --resume flag requires a --checkpoint_dir to resume from')
+	outdir = helper.check_outdir(args.outdir, allow_existing=args.resume)
 	# set number of threads to cpu count if none set
 	if not args.threads:
 		args.threads = cpu_count()
@@ -75,11 +74,30 @@ def savana_run(args):
 	# finish timing
 	helper.time_function("Total time to call raw variants", checkpoints, time_str, final=True)
 
+def savana_recall(args):
+	""" main function for savana recall """
+	import savana.run as run
+	outdir = helper.check_outdir(args.outdir)
+	# set number of threads to cpu count if none set
+	if not args.threads:
+		args.threads = cpu_count()
+	# initialize timing
+	checkpoints = [time()]
+	time_str = []
+	# re-call breakpoints for each combination of parameters
+	checkpoints, time_str = run.recall_breakpoints(args, checkpoints, time_str, outdir)
+	# finish timing
+	helper.time_function("Total time to re-call raw variants", checkpoints, time_str, final=True)
+
 def savana_classify(args):
 	""" main function for savana classify """
+	import savana.classify as classify
 	# initialize timing
 	checkpoints = [time()]
 	time_str = []
+	# set number of threads to cpu count if none set
+	if not args.threads:
+		args.threads = cpu_count()
 	if args.legacy:
 		classify.classify_legacy(args, checkpoints, time_str)
 	elif args.custom_params:
@@ -121,6 +139,7 @@ def savana_classify(args):
 
 def savana_evaluate(args):
 	""" main function for savana evaluate """
+	import savana.evaluate as evaluate
 	# check input VCFs
 	vcf_string = ''
 	if not os.path.exists(args.input):
@@ -145,7 +164,11 @@ def savana_evaluate(args):
 
 def savana_train(args):
 	""" main function for savana train """
+	import savana.train as train
 	outdir = helper.check_outdir(args.outdir)
+	# set number of threads to cpu count if none set
+	if not args.threads:
+		args.threads = cpu_count()
 	data_matrix = None
 	if args.vcfs:
 		# read in and create matrix from VCF files
@@ -154,15 +177,15 @@ def savana_train(args):
 		# load data matrix from pickle file
 		data_matrix = train.load_matrix(args)
 	features, target = train.prepare_data(data_matrix, germline_class=args.germline_class)
-	classifier = train.fit_classifier(features, target, outdir, args.test_split, args.downsample, args.hyper, args.germline_class)
-	train.save_model(args, classifier, outdir)
+	classifier, compact_classifier = train.fit_classifier(features, target, outdir, args.test_split, args.downsample, args.hyper, args.germline_class, args.threads, args.halving, args.compact)
+	train.save_model(args, classifier, outdir, compact_classifier)
 
 def savana_main(args):
 	""" default workflow for savana: savana_run, savana_classify, savana_evaluate """
 	# call raw breakpoints
 	savana_run(args)
 	# set the input VCF for classification
-	args.vcf=os.path.join(args.outdir,f'{args.sample}.sv_breakpoints.vcf')
+	args.vcf=os.path.join(args.outdir,f'{args.sample}.sv_breakpoints.vcf.gz' if args.bgzip else f'{args.sample}.sv_breakpoints.vcf')
 	if not args.model and not args.custom_params and not args.legacy and not args.ont_noisy and not args.predict_germline:
 		args.ont = True
 		print(f'Using ONT somatic only model to classify variants')
@@ -176,7 +199,7 @@ def savana_main(args):
 		# evaluate against somatic/germline VCFs
 		if args.legacy or args.custom_params:
 			# need reset output as the raw sv breakpoints since it's the only one that contains all variants
-			args.output = os.path.join(args.outdir, f'{args.sample}.sv_breakpoints.vcf')
+			args.output = args.vcf
 		# set the input vcf as previous output
 		args.input = args.output
 		args.output = os.path.join(args.outdir,f'{args.sample}.evaluation.sv_breakpoints.vcf')
@@ -206,9 +229,28 @@ def main():
 	run_parser.add_argument('--threads', nargs='?', type=int, const=0, help='Number of threads to use (default=max)')
 	run_parser.add_argument('--outdir', nargs='?', required=True, help='Output directory (can exist but must be empty)')
 	run_parser.add_argument('--sample', nargs='?', type=str, help="Name to prepend to output files (default=tumour BAM filename without extension)")
+	run_parser.add_argument('--bgzip', action='store_true', help='Compress the raw breakpoints VCF with bgzip and index it with tabix')
+	run_parser.add_argument('--single_pass', action='store_true', help='Record read coverage while identifying breakpoints and use it for local depth (alignment files are only read once)')
+	run_parser.add_argument('--targeted_normal', action='store_true', help='Only read the normal around candidate tumour clusters (breakpoints supported by the normal alone are not called)')
+	run_parser.add_argument('--checkpoint_dir', nargs='?', type=str, required=False, help='Directory to store the results of each stage in (allows an interrupted run to be resumed)')
+	run_parser.add_argument('--resume', action='store_true', help='Resume from the results stored in the checkpoint_dir (stages with changed inputs or parameters are re-run)')
+	run_parser.add_argument('--ref_cache', nargs='?', type=str, required=False, help='Folder to cache the reference sequences of CRAM files in (kept between runs and re-used while the reference is unchanged)')
 	run_parser.add_argument('--debug', action='store_true', help='Output extra debugging info and files')
 	run_parser.set_defaults(func=savana_run)
 
+	# savana recall
+	recall_parser = subparsers.add_parser("recall", help="re-cluster and call breakpoints from the potential breakpoints cached by 'savana run --checkpoint_dir' for one or more parameter sets")
+	recall_parser.add_argument('--checkpoint_dir', nargs='?', type=str, required=True, help='Checkpoint directory of a previous "savana run"')
+	recall_parser.add_argument('--buffer', nargs='+', type=int, default=[10], help='Buffer(s) when clustering adjacent potential breakpoints, excepting insertions (default=10)')
+	recall_parser.add_argument('--insertion_buffer', nargs='+', type=int, default=[100], help='Buffer(s) when clustering adjacent potential insertion breakpoints (default=100)')
+	recall_parser.add_argument('--length', nargs='+', type=int, default=[30], help='Minimum length(s) SV to call - must be at least the length of the cached run (default=30)')
+	recall_parser.add_argument('--depth', nargs='+', type=int, default=[3], help='Minumum number(s) of supporting reads from tumour OR normal to consider variant (default=3)')
+	recall_parser.add_argument('--threads', nargs='?', type=int, const=0, help='Number of threads to use (default=max)')
+	recall_parser.add_argument('--outdir', nargs='?', required=True, help='Output directory (can exist but must be empty) - one sub-directory per parameter combination')
+	recall_parser.add_argument('--bgzip', action='store_true', help='Compress the raw breakpoints VCFs with bgzip and index them with tabix')
+	recall_parser.add_argument('--debug', action='store_true', help='Output extra debugging info and files')
+	recall_parser.set_defaults(func=savana_recall)
+
 	# savana classify
 	classify_parser = subparsers.add_parser("classify", help="classify VCF using model")
 	classify_parser.add_argument('--vcf', nargs='?', type=str, required=True, help='VCF file to classify')
@@ -217,11 +259,12 @@ def main():
 	group.add_argument('--ont_noisy', action='store_true', help='Use a model trained on ONT data with relatively more noise')
 	# whether to use a germline-trained model
 	classify_parser.add_argument('--predict_germline', action='store_true', help='Use a model that also predicts germline events')
-	group.add_argument('--model', nargs='?', type=str, required=False, help='Pickle file of machine-learning model')
+	group.add_argument('--model', nargs='?', type=str, required=False, help='Pickle file of machine-learning model (or compact .npz forest exported by train)')
 	group.add_argument('--custom_params', nargs='?', type=str, required=False, help='JSON file of custom filtering parameters')
 	group.add_argument('--legacy', action='store_true', help='Legacy lenient/strict filtering')
 	classify_parser.add_argument('--output', nargs='?', type=str, required=True, help='Output VCF with PASS columns and CLASS added to INFO')
 	classify_parser.add_argument('--somatic_output', nargs='?', type=str, required=False, help='VCF with only PASS somatic variants')
+	classify_parser.add_argument('--threads', nargs='?', type=int, const=0, help='Number of threads to use for model prediction (default=max)')
 	classify_parser.set_defaults(func=savana_classify)
 
 	# savana evaluate
@@ -229,7 +272,7 @@ def main():
 	evaluate_parser.add_argument('--input', nargs='?', type=str, required=True, help='VCF file to evaluate')
 	evaluate_parser.add_argument('--somatic', nargs='?', type=str, required=True, help='Somatic VCF file to evaluate against')
 	evaluate_parser.add_argument('--germline', nargs='?', type=str, required=False, help='Germline VCF file to evaluate against (optional)')
-	evaluate_parser.add_argument('--overlap_buffer', nargs='?', type=int, default=100, help='Buffer for considering an overlap (default=100)')
+	evaluate_parser.add_argument('--overlap_buffer', nargs='+', type=int, default=[100], help='Buffer(s) for considering an overlap - several values write one statistics table row per buffer, labelling with the first (default=100)')
 	evaluate_parser.add_argument('--output', nargs='?', type=str, required=True, help='Output VCF with LABEL added to INFO')
 	evaluate_parser.add_argument('--stats', nargs='?', type=str, required=False, help='Output file for statistics on comparison if desired')
 	group = evaluate_parser.add_mutually_exclusive_group()
@@ -242,12 +285,16 @@ def main():
 	group = train_parser.add_mutually_exclusive_group()
 	group.add_argument('--vcfs', nargs='?', type=str, required=False, help='Folder of labelled VCF files to read in')
 	train_parser.add_argument('--recursive', action='store_true', help='Search recursively through input folder for input VCFs (default only one-level deep)')
-	group.add_argument('--load_matrix', nargs='?', type=str, required=False, help='Pre-loaded pickle file of VCFs')
+	group.add_argument('--load_matrix', nargs='?', type=str, required=False, help='Pre-loaded pickle file of VCFs (or folder of cached matrices from --matrix_cache)')
 	train_parser.add_argument('--save_matrix', nargs='?', type=str, required=False, help='Output pickle file for data matrix of VCFs')
+	train_parser.add_argument('--matrix_cache', nargs='?', type=str, required=False, help='Folder to cache the matrix of each VCF in (only new or changed VCFs are re-read)')
+	train_parser.add_argument('--threads', nargs='?', type=int, const=0, help='Number of threads to use to read the VCFs and fit the model (default=max)')
 	train_parser.add_argument('--downsample', nargs='?', type=float, default=0.1, help='Fraction to downsample majority class by (default=0.1)')
 	train_parser.add_argument('--test_split', nargs='?', type=float, default=0.2, help='Fraction of data to use for test (default=0.2)')
 	train_parser.add_argument('--germline_class', action='store_true', help='Train the model to predict germline and somatic variants (GERMLINE label must be present)')
 	train_parser.add_argument('--hyper', action='store_true', help='Perform a randomised search on hyper parameters and use best')
+	train_parser.add_argument('--halving', action='store_true', help='Perform the hyper parameter search by successive halving (faster on large matrices)')
+	train_parser.add_argument('--compact', nargs='?', type=float, const=0.01, help='Also save the smallest forest (fewer trees, shallower, or distilled) whose macro F-score on the test set is within this tolerance of the full model (default=0.01)')
 	train_parser.add_argument('--outdir', nargs='?', required=True, help='Output directory (can exist but must be empty)')
 	train_parser.set_defaults(func=savana_train)
 
@@ -272,6 +319,12 @@ def main():
 		global_parser.add_argument('--threads', nargs='?', type=int, const=0, help='Number of threads to use (default=max)')
 		global_parser.add_argument('--outdir', nargs='?', required=True, help='Output directory (can exist but must be empty)')
 		global_parser.add_argument('--sample', nargs='?', type=str, help='Name to prepend to output files (default=tumour BAM filename without extension)')
+		global_parser.add_argument('--bgzip', action='store_true', help='Compress the raw breakpoints VCF with bgzip and index it with tabix')
+		global_parser.add_argument('--single_pass', action='store_true', help='Record read coverage while identifying breakpoints and use it for local depth (alignment files are only read once)')
+		global_parser.add_argument('--targeted_normal', action='store_true', help='Only read the normal around candidate tumour clusters (breakpoints supported by the normal alone are not called)')
+		global_parser.add_argument('--checkpoint_dir', nargs='?', type=str, required=False, help='Directory to store the results of each stage in (allows an interrupted run to be resumed)')
+		global_parser.add_argument('--resume', action='store_true', help='Resume from the results stored in the checkpoint_dir (stages with changed inputs or parameters are re-run)')
+		global_parser.add_argument('--ref_cache', nargs='?', type=str, required=False, help='Folder to cache the reference sequences of CRAM files in (kept between runs and re-used while the reference is unchanged)')
 		global_parser.add_argument('--debug', action='store_true', help='Output extra debugging info and files')
 		# classify args
 		classify_group = global_parser.add_mutually_exclusive_group()
@@ -279,14 +332,14 @@ def main():
 		classify_group.add_argument('--ont_noisy', action='store_true', help='Use a model trained on ONT data with relatively more noise')
 		# whether to use a germline-trained model
 		global_parser.add_argument('--predict_germline', action='store_true', help='Use a model that also predicts germline events')
-		classify_group.add_argument('--model', nargs='?', type=str, required=False, help='Pickle file of machine-learning model')
+		classify_group.add_argument('--model', nargs='?', type=str, required=False, help='Pickle file of machine-learning model (or compact .npz forest exported by train)')
 		classify_group.add_argument('--custom_params', nargs='?', type=str, required=False, help='JSON file of custom filtering parameters')
 		classify_group.add_argument('--legacy', action='store_true', help='Use legacy lenient/strict filtering')
 		global_parser.add_argument('--somatic_output', nargs='?', type=str, required=False, help='Output a VCF with only PASS somatic variants')
 		# evaluate args
 		global_parser.add_argument('--somatic', nargs='?', type=str, required=False, help='Somatic VCF file to evaluate against')
 		global_parser.add_argument('--germline', nargs='?', type=str, required=False, help='Germline VCF file to evaluate against (optional)')
-		global_parser.add_argument('--overlap_buffer', nargs='?', type=int, default=100, required=False, help='Buffer for considering an overlap (default=100)')
+		global_parser.add_argument('--overlap_buffer', nargs='+', type=int, default=[100], required=False, help='Buffer(s) for considering an overlap - several values write one statistics table row per buffer, labelling with the first (default=100)')
 		evaluate_group = global_parser.add_mutually_exclusive_group()
 		evaluate_group.add_argument('--by_support', action='store_true', help='Comparison method: tie-break by read support')
 		evaluate_group.add_argument('--by_distance', action='store_true', default=True, help='Comparison method: tie-break by min. distance (default)')
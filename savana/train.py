@@ -7,20 +7,18 @@ Hillary Elrick
 #!/usr/bin/env python3
 
 import os
+import copy
+import time
+import hashlib
 
 import pandas as pd
 import numpy as np
-import cyvcf2
 import pickle
 
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import *
-from sklearn.model_selection import RandomizedSearchCV, train_test_split
-from scipy.stats import randint
-from sklearn.utils.class_weight import *
+from multiprocessing import Pool
 
-# for plotting confusion matrix
-import matplotlib.pyplot as plt
+import savana.forest as forest
+from savana.vcf import read_vcf, get_info_definitions
 
 label_encoding = {
 	'NOT_IN_COMPARISON': 0,
@@ -33,9 +31,15 @@ encoded_labels = {v: k for k, v in label_encoding.items()}
 
 def format_data(data_matrix):
 	""" parse columns, do conversions, one-hot-encoding """
-	# split the DP tuples
-	data_matrix[['TUMOUR_DP_0', 'TUMOUR_DP_1']] = data_matrix['TUMOUR_DP'].apply(pd.Series)
-	data_matrix[['NORMAL_DP_0', 'NORMAL_DP_1']] = data_matrix['NORMAL_DP'].apply(pd.Series)
+	depth_columns = ['TUMOUR_DP_0', 'TUMOUR_DP_1', 'NORMAL_DP_0', 'NORMAL_DP_1']
+	if 'TUMOUR_DP' in data_matrix.columns:
+		# split the DP tuples (matrices saved before the columnar loader)
+		data_matrix[['TUMOUR_DP_0', 'TUMOUR_DP_1']] = data_matrix['TUMOUR_DP'].apply(pd.Series)
+		data_matrix[['NORMAL_DP_0', 'NORMAL_DP_1']] = data_matrix['NORMAL_DP'].apply(pd.Series)
+	else:
+		# already split by the loader, move to the end to keep the feature order
+		depths = data_matrix.reindex(columns=depth_columns)
+		data_matrix = data_matrix.drop(depth_columns, axis=1, errors='ignore').join(depths)
 	# when nothing in second depth column (insertions), replace with value in first
 	data_matrix['TUMOUR_DP_1'] = data_matrix['TUMOUR_DP_1'].fillna(data_matrix['TUMOUR_DP_0'])
 	data_matrix['NORMAL_DP_1'] = data_matrix['NORMAL_DP_1'].fillna(data_matrix['NORMAL_DP_0'])
@@ -106,8 +110,16 @@ def format_value_counts(value_counts):
 		print(f'{round(counts[i], 4)} - {encoded_labels[values[i]]}')
 
 
-def fit_classifier(X, y, outdir, split, downsample, hyperparameter, germline_class):
-	""" given the features (X) and target (y), split into test/train and fit the model """
+def fit_classifier(X, y, outdir, split, downsample, hyperparameter, germline_class, threads=16, halving=False, compact_tolerance=None):
+	""" given the features (X) and target (y), split into test/train and fit the model (and a compact one if a tolerance is given) """
+	# imported here so that loading this module (e.g. for format_data in classify) doesn't pull in sklearn/matplotlib
+	from sklearn.ensemble import RandomForestClassifier
+	from sklearn.metrics import precision_score, recall_score, f1_score, confusion_matrix, ConfusionMatrixDisplay, classification_report
+	from sklearn.model_selection import RandomizedSearchCV, train_test_split
+	from scipy.stats import randint
+	# for plotting confusion matrix
+	import matplotlib.pyplot as plt
+
 	# split into train/test
 	X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=split)
 
@@ -132,23 +144,43 @@ def fit_classifier(X, y, outdir, split, downsample, hyperparameter, germline_cla
 
 	# fit the random forest
 	random_forest = None
-	if hyperparameter:
+	if hyperparameter or halving:
 		# hyper-parameter testing
 		param_dist = {'n_estimators': randint(400,500), 'max_depth': randint(10,20)}
-		rf = RandomForestClassifier(n_jobs=16)
-		rand_search = RandomizedSearchCV(rf,
-					param_distributions=param_dist,
-					n_iter=5,
-					cv=5,
-					scoring='f1_macro')
+		# parallelise across the folds and candidates rather than within each forest
+		rf = RandomForestClassifier(n_jobs=1)
+		if halving:
+			# successive halving: compare candidates on a subset of rows, keep the best third on three times as many
+			# (up to a third of the training rows, the best is then fit on all of them)
+			from sklearn.experimental import enable_halving_search_cv
+			from sklearn.model_selection import HalvingRandomSearchCV
+			rand_search = HalvingRandomSearchCV(rf,
+						param_distributions=param_dist,
+						n_candidates=9,
+						factor=3,
+						min_resources='exhaust',
+						max_resources=len(X_train)//3,
+						cv=5,
+						scoring='f1_macro',
+						refit=False,
+						n_jobs=threads)
+		else:
+			rand_search = RandomizedSearchCV(rf,
+						param_distributions=param_dist,
+						n_iter=5,
+						cv=5,
+						scoring='f1_macro',
+						refit=False,
+						n_jobs=threads)
 		rand_search.fit(X_train, y_train)
 		print('Using Best Hyperparameters:')
 		print(', '.join(f'{key}: {value}' for key, value in rand_search.best_params_.items()))
-		# store the best model
-		random_forest = rand_search.best_estimator_
+		# refit the best model on all of the training data (using all threads for the forest)
+		random_forest = RandomForestClassifier(**rand_search.best_params_, n_jobs=threads)
+		random_forest.fit(X_train, y_train)
 	else:
 		# use default pre-deteremined hyperparameters
-		random_forest = RandomForestClassifier(max_depth=20, n_estimators=400, n_jobs=16)
+		random_forest = RandomForestClassifier(max_depth=20, n_estimators=400, n_jobs=threads)
 		random_forest.fit(X_train, y_train)
 	y_pred = random_forest.predict(X_test)
 
@@ -191,6 +223,10 @@ def fit_classifier(X, y, outdir, split, downsample, hyperparameter, germline_cla
 	with open(os.path.join(outdir, 'model_stats.txt'), 'w') as f:
 		f.write(report)
 
+	compact_forest = None
+	if compact_tolerance is not None:
+		compact_forest = compact_classifier(random_forest, X_train, y_train, X_test, y_test, compact_tolerance, outdir, threads)
+
 	# export y_test and pred
 	test_matrix = X_test
 	test_matrix['TRUE_LABEL'] = y_test
@@ -202,14 +238,85 @@ def fit_classifier(X, y, outdir, split, downsample, hyperparameter, germline_cla
 	test_matrix = test_matrix[test_matrix['TRUE_LABEL'] == test_matrix['PREDICTED_LABEL']]
 	test_matrix.to_csv(os.path.join(outdir, 'test_set_correct.tsv'), sep="\t")
 
-	return random_forest
+	return random_forest, compact_forest
+
+def get_forest_size(model):
+	""" return the total number of nodes in a fitted forest """
+	return sum(estimator.tree_.node_count for estimator in model.estimators_)
+
+def subset_forest(model, num_trees):
+	""" return a copy of a fitted forest which only uses its first trees """
+	subset = copy.copy(model)
+	subset.estimators_ = model.estimators_[:num_trees]
+	subset.n_estimators = num_trees
+
+	return subset
+
+def compact_classifier(model, X_train, y_train, X_test, y_test, tolerance, outdir, threads=16):
+	""" search for the smallest forest within the F1 tolerance of the model on the test set: fewer trees, shallower, or distilled """
+	from sklearn.ensemble import RandomForestClassifier
+	from sklearn.metrics import f1_score
+
+	print(f'\n>SEARCHING FOR COMPACT CLASSIFIER (MACRO F-SCORE TOLERANCE {tolerance})')
+	# the full model's predictions as the targets to distill
+	y_distilled = model.predict(X_train)
+	candidates = [('full', model)]
+	for num_trees in [25, 50, 100, 200]:
+		if num_trees < len(model.estimators_):
+			candidates.append((f'first {num_trees} trees', subset_forest(model, num_trees)))
+	for max_depth in [8, 12, 16]:
+		for num_trees in [50, 100]:
+			for method, target in [('shallow', y_train), ('distilled', y_distilled)]:
+				candidate = RandomForestClassifier(max_depth=max_depth, n_estimators=num_trees, n_jobs=threads)
+				candidate.fit(X_train, target)
+				candidates.append((f'{method} {num_trees} trees depth {max_depth}', candidate))
+
+	# measure each candidate's size, prediction time, and accuracy
+	rows = []
+	for name, candidate in candidates:
+		start = time.perf_counter()
+		y_pred = candidate.predict(X_test)
+		predict_time = time.perf_counter() - start
+		rows.append({
+			'model': name,
+			'trees': len(candidate.estimators_),
+			'max_depth': max(estimator.tree_.max_depth for estimator in candidate.estimators_),
+			'nodes': get_forest_size(candidate),
+			'predict_seconds': predict_time,
+			'f_score': round(f1_score(y_test, y_pred, average='macro'), 4)
+		})
+	compaction = pd.DataFrame(rows)
+	full_f_score = compaction['f_score'].iloc[0]
+	compaction['speedup'] = (compaction['predict_seconds'].iloc[0]/compaction['predict_seconds']).round(2)
+	compaction['predict_seconds'] = compaction['predict_seconds'].round(4)
+	compaction['within_tolerance'] = compaction['f_score'] >= full_f_score - tolerance
+	print(compaction.to_string(index=False))
+	compaction.to_csv(os.path.join(outdir, 'compaction_stats.tsv'), sep="\t", index=False)
+
+	# smallest candidate within the tolerance
+	within_tolerance = compaction[compaction['within_tolerance']].iloc[1:]
+	if within_tolerance.empty:
+		print('No smaller forest is within the tolerance of the full model')
+		return None
+	best = within_tolerance.sort_values('nodes').index[0]
+	print(f'Using compact classifier: {compaction["model"].iloc[best]} ({compaction["nodes"].iloc[best]} nodes, F-score {compaction["f_score"].iloc[best]} vs {full_f_score})')
+
+	return candidates[best][1]
 
-def save_model(args, model, outdir):
-	""" save model and its info to pickle file """
-	model_path = os.path.join(outdir, 'random_forest_model.pkl')
+def save_forest(model, model_path):
+	""" save a model to a pickle file and export it as flat node arrays (.npz) for fast loading in classify """
 	print(f'Saving classifier to {model_path}')
 	model.set_params(n_jobs=1) # reset jobs before saving
 	pickle.dump(model, open(model_path, "wb"))
+	forest_path = os.path.splitext(model_path)[0]+'.npz'
+	print(f'Exporting classifier as flat node arrays to {forest_path}')
+	forest.export_forest(model, forest_path)
+
+def save_model(args, model, outdir, compact_model=None):
+	""" save model (and compact model if any) and its info to pickle file """
+	save_forest(model, os.path.join(outdir, 'random_forest_model.pkl'))
+	if compact_model is not None:
+		save_forest(compact_model, os.path.join(outdir, 'random_forest_model.compact.pkl'))
 	# also save arguments used to create model
 	cmd_string = 'savana train'
 	for arg, value in vars(args).items():
@@ -219,39 +326,107 @@ def save_model(args, model, outdir):
 	with open(os.path.join(outdir, 'model_arguments.txt'), 'w') as f:
 		f.write(cmd_string)
 
+def get_cache_path(cache_dir, vcf_path):
+	""" return the path of the cached feature matrix of a VCF (named by its absolute path) """
+	digest = hashlib.sha1(os.path.abspath(vcf_path).encode()).hexdigest()
+	return os.path.join(cache_dir, f'{digest}.npz')
+
+def get_cache_key(vcf_path, fields):
+	""" return what a cached feature matrix must match to be reused: the VCF's path, size, mtime, and the fields loaded """
+	stat = os.stat(vcf_path)
+	return np.array([os.path.abspath(vcf_path), str(stat.st_size), str(stat.st_mtime_ns)] + list(fields), dtype=str)
+
+def save_matrix_cache(cache_path, data_matrix, key):
+	""" write a feature matrix as one uncompressed array per column (strings with a mask of missing values) """
+	arrays = {'key': key, 'columns': np.array(data_matrix.columns, dtype=str)}
+	for i, column in enumerate(data_matrix.columns):
+		values = data_matrix[column].to_numpy()
+		if values.dtype.kind not in 'biuf':
+			missing = pd.isna(values)
+			arrays[f'missing_{i}'] = missing
+			values = np.where(missing, '', values).astype(str)
+		arrays[f'column_{i}'] = values
+	# write then move so that an interrupted run doesn't leave a partial cache
+	temp_path = f'{cache_path}.{os.getpid()}.tmp'
+	with open(temp_path, 'wb') as cache_file:
+		np.savez(cache_file, **arrays)
+	os.replace(temp_path, cache_path)
+
+def load_matrix_cache(cache_path, columns=None):
+	""" read a cached feature matrix, only loading the requested columns (default all) """
+	with np.load(cache_path) as cache:
+		cached_columns = cache['columns'].tolist()
+		columns = cached_columns if columns is None else [column for column in columns if column in cached_columns]
+		data = {}
+		for column in columns:
+			i = cached_columns.index(column)
+			values = cache[f'column_{i}']
+			if f'missing_{i}' in cache.files:
+				values = values.astype(object)
+				values[cache[f'missing_{i}']] = None
+			data[column] = values
+
+	return pd.DataFrame(data)
+
+def read_cache_key(cache_path):
+	""" return the key of a cached feature matrix (None if missing or unreadable) """
+	try:
+		with np.load(cache_path) as cache:
+			return cache['key']
+	except (OSError, ValueError, KeyError):
+		return None
+
+def read_vcf_features(vcf_path, fields, cache_dir=None):
+	""" load the feature rows of a labelled VCF, reusing its cached matrix if the VCF is unchanged, return them and whether the VCF was parsed """
+	if cache_dir:
+		cache_path = get_cache_path(cache_dir, vcf_path)
+		key = get_cache_key(vcf_path, fields)
+		cached_key = read_cache_key(cache_path)
+		if cached_key is not None and np.array_equal(cached_key, key):
+			return load_matrix_cache(cache_path), False
+	data_matrix = read_vcf(vcf_path, fields=fields, columns=[])
+	if cache_dir:
+		save_matrix_cache(cache_path, data_matrix, key)
+
+	return data_matrix, True
+
 def load_matrix(args):
-	"""  read in dataframe from pickle file """
+	""" read in dataframe from pickle file or folder of cached matrices """
 	print(f'Loading data matrix from {args.load_matrix}')
+	if os.path.isdir(args.load_matrix):
+		cache_paths = [os.path.join(args.load_matrix, f) for f in os.listdir(args.load_matrix) if f.endswith('.npz')]
+		# in the order of their VCFs' paths
+		cache_paths = sorted([path for path in cache_paths if read_cache_key(path) is not None], key=lambda path: read_cache_key(path)[0])
+		data_matrices = [load_matrix_cache(path) for path in cache_paths]
+		return pd.concat(data_matrices, ignore_index=True) if data_matrices else pd.DataFrame()
 	df = pd.read_pickle(args.load_matrix)
 	return df
 
-def get_info_fields(vcf):
-	""" initialize the data header from INFO fields of sample VCF """
-	fields = []
-	for rec in vcf.header_iter():
-		if rec['HeaderType'] == "INFO":
-			fields.append(rec.info()['ID'])
-
-	return fields
-
 def read_vcfs(args):
 	""" given the folder of labelled input VCFs, return an output dataframe """
-	header = []
-	data = []
+	vcf_paths = []
 	for root, _, file_names in os.walk(args.vcfs):
 		for file in file_names:
 			f = os.path.join(root, file)
 			if os.path.isfile(f) and file.endswith('.vcf'):
-				print(f'Loading {f} into matrix')
-				input_vcf = cyvcf2.VCF(f)
-				if not header:
-					header = get_info_fields(input_vcf)
-				for variant in input_vcf:
-					row = []
-					for field in header:
-						row.append(variant.INFO.get(field))
-					data.append(row)
-	df = pd.DataFrame(data, columns = header)
+				vcf_paths.append(f)
+	fields = list(get_info_definitions(vcf_paths[0])[0].keys()) if vcf_paths else []
+	cache_dir = getattr(args, 'matrix_cache', None)
+	if cache_dir:
+		os.makedirs(cache_dir, exist_ok=True)
+	threads = min(getattr(args, 'threads', None) or 1, len(vcf_paths))
+	read_args = [(f, fields, cache_dir) for f in vcf_paths]
+	if threads > 1:
+		# parse the VCFs in parallel (keeping their order)
+		with Pool(threads) as pool:
+			results = pool.starmap(read_vcf_features, read_args)
+	else:
+		results = [read_vcf_features(*arguments) for arguments in read_args]
+	data_matrices = []
+	for f, (data_matrix, parsed) in zip(vcf_paths, results):
+		print(f'Loaded {f} into matrix' if parsed else f'Loaded {f} into matrix (cached)')
+		data_matrices.append(data_matrix)
+	df = pd.concat(data_matrices, ignore_index=True) if data_matrices else pd.DataFrame()
 	if args.save_matrix:
 		print(f'Saving data matrix to pickle file {args.save_matrix}')
 		df.to_pickle(args.save_matrix)
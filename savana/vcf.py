@@ -0,0 +1,212 @@
+"""
+Module containing a columnar VCF loader shared by the classify, train, and evaluate sub-commands
+"""
+#!/usr/bin/env python3
+
+import re
+import csv
+import gzip
+
+import numpy as np
+import pandas as pd
+import pysam
+
+# number of records to featurise, classify, and write at a time
+default_batch_size = 50000
+
+def open_vcf(vcf_path):
+	""" open a plain or (b)gzipped VCF for reading """
+	if vcf_path.endswith('.gz'):
+		return gzip.open(vcf_path, 'rt')
+	return open(vcf_path, encoding="utf-8")
+
+def get_info_definitions(vcf_path):
+	""" return the Number and Type of each INFO field in the header (in header order) and the number of header lines """
+	info_definitions = {}
+	num_header_lines = 0
+	with open_vcf(vcf_path) as f:
+		for line in f:
+			if not line.startswith('#'):
+				break
+			num_header_lines += 1
+			match = re.match(r'##INFO=<ID=([^,>]+),Number=([^,>]+),Type=([^,>]+)', line)
+			if match:
+				info_definitions[match.group(1)] = {'Number': match.group(2), 'Type': match.group(3)}
+
+	return info_definitions, num_header_lines
+
+def parse_region(region):
+	""" split a 'chrom[:start-end]' region (1-based, inclusive) into its parts """
+	chrom, _, span = region.partition(':')
+	if not span:
+		return chrom, None, None
+	start, _, end = span.replace(',', '').partition('-')
+	return chrom, int(start), int(end) if end else None
+
+def read_records(vcf_path, num_header_lines, region=None):
+	""" return the CHROM, POS, ID and INFO columns of the records (in the region if provided) """
+	column_names = ['CHROM', 'POS', 'ID', 'INFO']
+	column_types = {'CHROM': str, 'POS': np.int64, 'ID': str, 'INFO': str}
+	if region and vcf_path.endswith('.gz'):
+		try:
+			tabix_file = pysam.TabixFile(vcf_path)
+		except (OSError, ValueError):
+			tabix_file = None # no index, filter after reading
+		if tabix_file:
+			chrom, start, end = parse_region(region)
+			rows = []
+			if chrom in tabix_file.contigs:
+				for line in tabix_file.fetch(chrom, start - 1 if start else None, end):
+					fields = line.split('\t', 8)
+					rows.append((fields[0], fields[1], fields[2], fields[7]))
+			tabix_file.close()
+			return pd.DataFrame(rows, columns=column_names).astype(column_types)
+	try:
+		records = pd.read_csv(vcf_path, sep='\t', header=None, skiprows=num_header_lines, usecols=[0, 1, 2, 7],
+			names=column_names, dtype=column_types, na_filter=False, quoting=csv.QUOTE_NONE)
+	except pd.errors.EmptyDataError:
+		records = pd.DataFrame({column: pd.Series(dtype=column_type) for column, column_type in column_types.items()})
+	if region:
+		chrom, start, end = parse_region(region)
+		in_region = records['CHROM'] == chrom
+		if start:
+			in_region &= records['POS'] >= start
+		if end:
+			in_region &= records['POS'] <= end
+		records = records[in_region].reset_index(drop=True)
+
+	return records
+
+def to_numeric(values):
+	""" convert a list of strings to floats (missing or non-numeric values as nan) """
+	try:
+		return np.array(values, dtype=np.float64)
+	except ValueError:
+		return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+def parse_records(records, info_definitions, fields=None, columns=None):
+	"""
+	convert records (with CHROM, POS, ID, and INFO columns) into a dataframe with one typed column per INFO field
+	- fields: INFO fields to load (default all in header, in header order)
+	- columns: fixed VCF columns to load before the INFO fields (default ['ID']). POS is 1-based
+	INFO fields that are Float/Integer become float columns (nan when missing); Strings are objects (None when missing);
+	Flags are booleans. Numeric fields with more than one value per record are split into FIELD_0, FIELD_1, etc.
+	"""
+	fields = list(info_definitions.keys()) if fields is None else fields
+	columns = ['ID'] if columns is None else columns
+	num_records = len(records)
+
+	# collect the raw value of each field from the INFO column
+	field_types = {}
+	raw_values = {}
+	for field in fields:
+		definition = info_definitions.get(field, {'Number': '1', 'Type': 'String'})
+		if definition['Type'] == 'Flag':
+			field_types[field] = 'Flag'
+		elif definition['Type'] in ('Float', 'Integer'):
+			field_types[field] = 'Numeric' if definition['Number'] == '1' else 'MultiNumeric'
+		else:
+			field_types[field] = 'String'
+		raw_values[field] = [None] * num_records if field_types[field] != 'Numeric' else ['nan'] * num_records
+	for i, info in enumerate(records['INFO']):
+		for item in info.split(';'):
+			key, _, value = item.partition('=')
+			values = raw_values.get(key)
+			if values is not None:
+				values[i] = value
+
+	# convert them into typed columns
+	data = {}
+	for column in columns:
+		data[column] = records[column].to_numpy()
+	for field in fields:
+		values = raw_values.pop(field)
+		if field_types[field] == 'Flag':
+			data[field] = np.array([value is not None for value in values], dtype=bool)
+		elif field_types[field] == 'Numeric':
+			data[field] = to_numeric(values)
+		elif field_types[field] == 'MultiNumeric':
+			split_values = [value.split(',') if value is not None else [] for value in values]
+			width = max([len(value) for value in split_values], default=1)
+			for j in range(max(width, 1)):
+				data[f'{field}_{j}'] = to_numeric([value[j] if j < len(value) else 'nan' for value in split_values])
+		else:
+			data[field] = np.array(values, dtype=object)
+
+	return pd.DataFrame(data)
+
+def read_vcf(vcf_path, fields=None, columns=None, region=None):
+	""" read a VCF into a dataframe with one typed column per INFO field (see parse_records), optionally only in a region """
+	info_definitions, num_header_lines = get_info_definitions(vcf_path)
+	records = read_records(vcf_path, num_header_lines, region)
+
+	return parse_records(records, info_definitions, fields, columns)
+
+def iter_vcf_batches(vcf_path, fields=None, columns=None, batch_size=default_batch_size):
+	""" read a VCF in batches, yielding the records (as lists of their columns) and their typed dataframe """
+	info_definitions, _ = get_info_definitions(vcf_path)
+	with open_vcf(vcf_path) as f:
+		batch = []
+		for line in f:
+			if line.startswith('#'):
+				continue
+			batch.append(line.rstrip('\n').split('\t'))
+			if len(batch) == batch_size:
+				yield batch, parse_records(records_to_frame(batch), info_definitions, fields, columns)
+				batch = []
+		if batch:
+			yield batch, parse_records(records_to_frame(batch), info_definitions, fields, columns)
+
+def records_to_frame(batch):
+	""" convert records (as lists of their columns) into a dataframe of their CHROM, POS, ID, and INFO """
+	return pd.DataFrame({
+		'CHROM': [record[0] for record in batch],
+		'POS': np.array([record[1] for record in batch], dtype=np.int64),
+		'ID': [record[2] for record in batch],
+		'INFO': [record[7] for record in batch]
+	})
+
+def read_header(vcf_path):
+	""" return the header lines of a VCF """
+	header = []
+	with open_vcf(vcf_path) as f:
+		for line in f:
+			if not line.startswith('#'):
+				break
+			header.append(line.rstrip('\n'))
+
+	return header
+
+def add_header_line(header, line):
+	""" add a meta-information line before the column header (unless one with the same type and ID exists) """
+	header_type, header_id = re.match(r'##([^=]+)=<ID=([^,>]+)', line).groups()
+	if not any(existing.startswith(f'##{header_type}=<ID={header_id},') for existing in header):
+		header.insert(len(header) - 1, line)
+
+def open_vcf_writer(vcf_path, header):
+	""" open a VCF for writing and output its header (adding the PASS filter if missing) """
+	header = list(header)
+	if not any(line.startswith('##FILTER=<ID=PASS,') for line in header):
+		header.insert(1, '##FILTER=<ID=PASS,Description="All filters passed">')
+	vcf_file = open(vcf_path, "w", encoding="utf-8")
+	vcf_file.write('\n'.join(header)+'\n')
+
+	return vcf_file
+
+def write_record(vcf_file, record):
+	""" write a record (list of its columns) to an open VCF """
+	vcf_file.write('\t'.join(record)+'\n')
+
+def set_info(record, key, value):
+	""" set the value of an INFO field of a record (list of its columns), replacing it if present """
+	items = [] if record[7] == '.' else record[7].split(';')
+	for i, item in enumerate(items):
+		if item.partition('=')[0] == key:
+			items[i] = f'{key}={value}'
+			break
+	else:
+		items.append(f'{key}={value}')
+	record[7] = ';'.join(items)
+
+if __name__ == "__main__":
+	print("VCF loading functions for SAVANA")
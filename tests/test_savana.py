@@ -19,3 +19,482 @@ def test_install():
     _, err = p.communicate()
     if p.returncode != 0:
         raise RuntimeError(f"FAILED: {cmd}\n{err}")
+
+def test_startup_imports():
+    """ benchmark CLI start-up: --help and the run sub-command mustn't import the classify/train dependencies (nor --help pysam) """
+    import sys
+    heavy_modules = ['sklearn', 'scipy', 'matplotlib', 'pandas']
+    for command, statement, command_heavy_modules in [('--help', 'import savana.savana', heavy_modules + ['pysam']), ('run', 'import savana.savana, savana.run', heavy_modules)]:
+        code = (f'import sys, time; start = time.perf_counter(); {statement}; '
+            f'print(time.perf_counter() - start); print(",".join(m for m in {command_heavy_modules} if m in sys.modules))')
+        p = subprocess.run([sys.executable, '-c', code], cwd=ROOTDIR, capture_output=True, text=True, check=True)
+        import_time, imported = p.stdout.split('\n')[:2]
+        print(f'savana {command} import time: {float(import_time):.3f}s')
+        assert not imported, f'savana {command} imports {imported} at start-up'
+
+def test_count_overlapping_reads():
+    """ test sorted-array local depth matches a brute-force overlap count """
+    import numpy as np
+    from savana.breakpoints import count_overlapping_reads
+    rng = np.random.default_rng(0)
+    starts = rng.integers(0, 10000, 500)
+    ends = starts + rng.integers(1, 2000, 500)
+    interval_starts = rng.integers(0, 12000, 200)
+    interval_ends = interval_starts + 1
+    depths = count_overlapping_reads(np.sort(starts), np.sort(ends), interval_starts, interval_ends)
+    for i_start, i_end, dp in zip(interval_starts, interval_ends, depths):
+        assert dp == sum(1 for s, e in zip(starts, ends) if i_start <= e and s <= i_end)
+
+def test_potential_breakpoints_store():
+    """ test the columnar potential breakpoint store keeps rows, read names and inserts through concatenation """
+    from savana.core import PotentialBreakpoints
+    contigs = ['chr1', 'chr2']
+    first = PotentialBreakpoints(contigs)
+    first.append([{'chr': 'chr2', 'loc': 50}, {'chr': 'chr2', 'loc': 50}], "INS", 'read_a', 60, 'tumour', "<INS>", 'ACGT')
+    first.append([{'chr': 'chr1', 'loc': 10}, {'chr': 'chr2', 'loc': 20}], "SUPP", 'read_a', 60, 'tumour', "+-")
+    second = PotentialBreakpoints(contigs)
+    second.append([{'chr': 'chr2', 'loc': 5}, {'chr': 'chr2', 'loc': 105}], "DEL", 'read_b', 20, 'normal', "+-")
+    second.append([{'chr': 'chr2', 'loc': 7}, {'chr': 'chr2', 'loc': 7}], "INS", 'read_c', 30, 'normal', "<INS>", 'TTTTT')
+    chrom_stores = PotentialBreakpoints.concatenate([first, second]).split_by_chrom()
+    assert list(chrom_stores.keys()) == ['chr2', 'chr1']
+    chr2 = [bp.as_dict() for bp in chrom_stores['chr2'].as_breakpoints()]
+    assert [(bp['start_loc'], bp['read_name'], bp['label'], bp['inserted_sequence']) for bp in chr2] == [
+        (50, 'read_a', 'tumour', 'ACGT'), (5, 'read_b', 'normal', None), (7, 'read_c', 'normal', 'TTTTT')]
+    chr1 = chrom_stores['chr1'].as_breakpoints()[0]
+    assert (chr1.end_chr, chr1.end_loc, chr1.source, chr1.breakpoint_notation) == ('chr2', 20, 'SUPP', '+-')
+
+def test_checkpointed_potential_breakpoints(tmp_path):
+    """ test the potential breakpoints of a chunk are restored unchanged from a checkpoint """
+    import numpy as np
+    from savana.core import PotentialBreakpoints
+    from savana.checkpoint import save_potential_breakpoints, load_potential_breakpoints
+    (tmp_path / 'potential_breakpoints').mkdir()
+    store = PotentialBreakpoints(['chr1', 'chr2'])
+    store.append([{'chr': 'chr2', 'loc': 50}, {'chr': 'chr2', 'loc': 50}], "INS", 'read_a', 60, 'tumour', "<INS>", 'ACGT')
+    store.append([{'chr': 'chr1', 'loc': 10}, {'chr': 'chr2', 'loc': 20}], "SUPP", 'read_b', 60, 'normal', "--")
+    save_potential_breakpoints(str(tmp_path), 'tumour', 'chr1', 0, 1000, store, np.array([[1, 2], [3, 4]]))
+    assert load_potential_breakpoints(str(tmp_path), 'tumour', 'chr1', 1000, 2000) is None
+    loaded, read_bounds = load_potential_breakpoints(str(tmp_path), 'tumour', 'chr1', 0, 1000)
+    assert [bp.as_dict() for bp in loaded.as_breakpoints()] == [bp.as_dict() for bp in store.as_breakpoints()]
+    assert read_bounds.tolist() == [[1, 2], [3, 4]]
+
+def test_format_vcf_info():
+    """ test INFO columns are written the way htslib normalises them """
+    from savana.core import format_vcf_info
+    info = 'SVTYPE=BND;MATEID=ID_0_2;SVLEN=1234567;ORIGINATING_CLUSTER=1e5;ORIGIN_EVENT_SIZE_MEDIAN=495.0;TUMOUR_DP=16,0;'
+    assert format_vcf_info(info) == 'SVTYPE=BND;MATEID=ID_0_2;SVLEN=1.23457e+06;ORIGINATING_CLUSTER=1e5;ORIGIN_EVENT_SIZE_MEDIAN=495;TUMOUR_DP=16,0'
+    # rounded as float32 first (as bcftools prints them)
+    assert format_vcf_info('ORIGIN_STARTS_STD_DEV=0.1234565,12345.65,99999.95') == 'ORIGIN_STARTS_STD_DEV=0.123457,12345.7,100000'
+
+def test_sorted_vcf_lines():
+    """ test the vcf lines are written sorted a contig at a time, including mates on earlier contigs """
+    from savana.run import get_sorted_vcf_lines
+    class StubBreakpoint():
+        def __init__(self, start, end):
+            self.start, self.end = start, end
+        def get_ref_positions(self):
+            return [self.start, self.end]
+        def as_vcf_records(self, start_base, end_base):
+            return [[*self.start, '.', start_base, '<INS>'], [*self.end, '.', end_base, '<INS>']]
+    contig_order = {'chr1': 0, 'chr2': 1, 'chr3': 2}
+    breakpoints = [StubBreakpoint(('chr3', '50'), ('chr1', '70')), StubBreakpoint(('chr1', '100'), ('chr2', '10')), StubBreakpoint(('chr1', '20'), ('chr1', '60'))]
+    contig_breakpoints = {}
+    for bp in breakpoints:
+        contig_breakpoints.setdefault(min(contig_order[bp.start[0]], contig_order[bp.end[0]]), []).append(bp)
+    ref_bases = {position: 'A' for bp in breakpoints for position in bp.get_ref_positions()}
+    lines = list(get_sorted_vcf_lines(contig_breakpoints, contig_order, ref_bases))
+    assert [line.split('\t')[:2] for line in lines] == [['chr1', '20'], ['chr1', '60'], ['chr1', '70'], ['chr1', '100'], ['chr2', '10'], ['chr3', '50']]
+
+def test_get_reference_bases(tmp_path):
+    """ test bulk reference lookups match single-base fetches (including out of range positions) """
+    import pysam
+    from savana.helper import get_reference_bases
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1\nACGTACGTAC\n>chr2\nGGCCTTAA\n')
+    pysam.faidx(str(fasta))
+    ref_fasta = pysam.FastaFile(str(fasta))
+    positions = [('chr1', 0), ('chr1', 9), ('chr1', 3), ('chr2', 5), ('chr2', 8), ('chr1', -1), ('chrX', 2)]
+    bases = get_reference_bases(ref_fasta, positions, max_gap=2)
+    assert [bases[p] for p in positions] == ['A', 'C', 'T', 'T', '', 'N', 'N']
+
+def test_read_vcf(tmp_path):
+    """ test the columnar VCF loader types INFO fields, splits multi-valued fields, and filters by region """
+    import numpy as np
+    from savana.vcf import read_vcf
+    vcf = tmp_path / 'test.vcf'
+    vcf.write_text('\n'.join([
+        '##fileformat=VCFv4.2',
+        '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="type">',
+        '##INFO=<ID=TUMOUR_SUPPORT,Number=1,Type=Integer,Description="support">',
+        '##INFO=<ID=TUMOUR_DP,Number=.,Type=Float,Description="depth">',
+        '##INFO=<ID=IMPRECISE,Number=0,Type=Flag,Description="flag">',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO',
+        'chr1\t100\tID_1\tA\t<INS>\t.\tPASS\tSVTYPE=INS;TUMOUR_SUPPORT=5;TUMOUR_DP=10',
+        'chr1\t200\tID_2\tA\tN]chr2:50]\t.\tPASS\tSVTYPE=BND;TUMOUR_DP=8,12;IMPRECISE',
+        'chr2\t50\tID_3\tC\tC[chr1:200[\t.\tPASS\tSVTYPE=BND;TUMOUR_SUPPORT=3',
+    ]) + '\n')
+    df = read_vcf(str(vcf))
+    assert list(df.columns) == ['ID', 'SVTYPE', 'TUMOUR_SUPPORT', 'TUMOUR_DP_0', 'TUMOUR_DP_1', 'IMPRECISE']
+    assert df['SVTYPE'].tolist() == ['INS', 'BND', 'BND']
+    assert np.allclose(df['TUMOUR_SUPPORT'], [5, np.nan, 3], equal_nan=True)
+    assert np.allclose(df['TUMOUR_DP_1'], [np.nan, 12, np.nan], equal_nan=True)
+    assert df['IMPRECISE'].tolist() == [False, True, False]
+    df = read_vcf(str(vcf), fields=['TUMOUR_SUPPORT', 'MISSING'], columns=['CHROM', 'POS'], region='chr1:150-250')
+    assert df['POS'].tolist() == [200] and df['MISSING'].tolist() == [None]
+
+def test_set_info():
+    """ test INFO values are replaced in place or appended (as htslib does when writing) """
+    from savana.vcf import set_info, add_header_line
+    record = ['chr1', '10', 'ID_1', 'A', '<INS>', '.', 'PASS', 'SVTYPE=INS;CLASS=OLD']
+    set_info(record, 'CLASS', 'NEW')
+    set_info(record, 'LABEL', 'SOMATIC')
+    assert record[7] == 'SVTYPE=INS;CLASS=NEW;LABEL=SOMATIC'
+    record[7] = '.'
+    set_info(record, 'CLASS', 'NEW')
+    assert record[7] == 'CLASS=NEW'
+    header = ['##fileformat=VCFv4.2', '##INFO=<ID=CLASS,Number=1,Type=String,Description="old">', '#CHROM']
+    add_header_line(header, '##INFO=<ID=CLASS,Number=1,Type=String,Description="new">')
+    add_header_line(header, '##FILTER=<ID=LIKELY_NOISE,Description="noise">')
+    assert header[1:] == ['##INFO=<ID=CLASS,Number=1,Type=String,Description="old">', '##FILTER=<ID=LIKELY_NOISE,Description="noise">', '#CHROM']
+
+def test_filter_with_comparator():
+    """ test the vectorized MIN/MAX filters (missing values pass, as they did row-wise) """
+    import numpy as np
+    import pandas as pd
+    from savana.classify import filter_with_comparator
+    values = pd.Series([0.0, 5.0, 10.0, np.nan])
+    assert filter_with_comparator(values, 5, 'MAX').tolist() == [True, True, False, True]
+    assert filter_with_comparator(values, '5', 'min').tolist() == [False, True, True, True]
+
+def test_classify_mate_in_later_batch(tmp_path, monkeypatch):
+    """ test a breakend is classified with its mate's prediction when the mate is on a later contig, reading the VCF once """
+    import argparse
+    import numpy as np
+    import savana.classify as classify
+    from time import time
+    from savana.vcf import iter_vcf_batches, write_record
+    info = 'SVTYPE={};MATEID={};BP_NOTATION={};TUMOUR_SUPPORT={};NORMAL_SUPPORT=0;TUMOUR_DP=20,20;NORMAL_DP=20,20;ORIGIN_STARTS_STD_DEV=1;ORIGIN_EVENT_SIZE_MEAN=1;END_STARTS_STD_DEV=1;END_EVENT_SIZE_MEAN=1'
+    fields = [('SVTYPE', 'String'), ('MATEID', 'String'), ('BP_NOTATION', 'String'), ('TUMOUR_SUPPORT', 'Float'), ('NORMAL_SUPPORT', 'Float'),
+        ('TUMOUR_DP', 'Float'), ('NORMAL_DP', 'Float'), ('ORIGIN_STARTS_STD_DEV', 'Float'), ('ORIGIN_EVENT_SIZE_MEAN', 'Float'),
+        ('END_STARTS_STD_DEV', 'Float'), ('END_EVENT_SIZE_MEAN', 'Float')]
+    lines = ['##fileformat=VCFv4.2'] + [f'##INFO=<ID={f},Number={"." if f.endswith("_DP") else 1},Type={t},Description="{f}">' for f, t in fields]
+    lines.append('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO')
+    # the translocation's first breakend is only somatic because of its mate (on the last contig)
+    lines.append('chr1\t100\tID_0_1\tA\tA[chr3:50[\t.\tPASS\t' + info.format('BND', 'ID_0_2', '+-', 5))
+    for i in range(1, 7):
+        lines.append(f'chr2\t{i*100}\tID_{i}_1\tA\t<INS>\t.\tPASS\t' + info.format('INS', '.', '<INS>', 4).replace('MATEID=.;', ''))
+    lines.append('chr3\t50\tID_0_2\tC\t]chr1:100]C\t.\tPASS\t' + info.format('BND', 'ID_0_1', '+-', 20))
+    vcf = tmp_path / 'raw.vcf'
+    vcf.write_text('\n'.join(lines) + '\n')
+
+    class SupportModel():
+        def predict(self, features):
+            return np.where(features['TUMOUR_SUPPORT'] > 10, 1, 0)
+    passes, written = [], []
+    def small_batches(vcf_path, fields=None, columns=None):
+        # records read but not yet written as each batch is read (in a pass over the VCF)
+        pending = []
+        passes.append(pending)
+        num_read, num_written = 0, len(written)
+        for records, data_matrix in iter_vcf_batches(vcf_path, fields, columns, batch_size=2):
+            num_read += len(records)
+            pending.append(num_read - (len(written) - num_written))
+            yield records, data_matrix
+        pending.append(num_read - (len(written) - num_written))
+    def logged_write(vcf_file, record):
+        written.append(record[2])
+        write_record(vcf_file, record)
+    monkeypatch.setattr(classify, 'load_model', lambda model_path: SupportModel())
+    monkeypatch.setattr(classify, 'iter_vcf_batches', small_batches)
+    monkeypatch.setattr(classify, 'write_record', logged_write)
+    args = argparse.Namespace(vcf=str(vcf), model='model.pkl', threads=1, output=str(tmp_path / 'classified.vcf'), somatic_output=None)
+    classify.classify_by_model(args, [time()], [])
+    # the first breakend is written once its mate's batch is predicted
+    assert written == [f'ID_{i}_1' for i in range(1, 6)] + ['ID_0_1', 'ID_6_1', 'ID_0_2']
+    # in a single pass, holding at most the batch just read and the breakend awaiting its mate
+    assert len(passes) == 1 and max(passes[0]) <= 3 and passes[0][-1] == 0
+    classes = {line.split('\t')[2]: line.split('CLASS=')[1].strip() for line in open(args.output) if not line.startswith('#')}
+    assert classes['ID_0_1'] == classes['ID_0_2'] == 'PREDICTED_SOMATIC'
+    assert classes['ID_1_1'] == 'PREDICTED_NOISE'
+
+def test_compact_forest(tmp_path):
+    """ test the exported compact forest predicts the same as the sklearn model (including missing values) """
+    import numpy as np
+    from sklearn.ensemble import RandomForestClassifier
+    from savana.forest import export_forest, load_forest
+    rng = np.random.default_rng(0)
+    X = rng.random((2000, 5))
+    y = (X[:, 0] + X[:, 1] > 1).astype(int) + (X[:, 2] > 0.8)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    model = RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0).fit(X, y)
+    export_forest(model, str(tmp_path / 'model.npz'))
+    compact = load_forest(str(tmp_path / 'model.npz'))
+    X_test = rng.random((500, 5))
+    X_test[rng.random(X_test.shape) < 0.05] = np.nan
+    assert np.array_equal(compact.predict_proba(X_test), model.predict_proba(X_test))
+    assert np.array_equal(compact.predict(X_test), model.predict(X_test))
+
+def test_populate_ref_cache(tmp_path, monkeypatch):
+    """ test only the contigs considered are cached, the environment is left alone, and an unchanged reference is re-used """
+    import os
+    import types
+    import hashlib
+    import pysam
+    from savana.helper import populate_ref_cache
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1\nACGTACGTAC\n>chr2\nggcctTAA\n')
+    pysam.faidx(str(fasta))
+    md5s = {contig: hashlib.md5(sequence.encode()).hexdigest() for contig, sequence in [('chr1', 'ACGTACGTAC'), ('chr2', 'GGCCTTAA')]}
+    header = pysam.AlignmentHeader.from_dict({'SQ': [{'SN': contig, 'LN': 10, 'M5': md5} for contig, md5 in md5s.items()]})
+    aln_files = {'tumour': types.SimpleNamespace(header=header)}
+    monkeypatch.delenv('REF_CACHE', raising=False)
+    cache_dir = tmp_path / 'cache'
+    assert populate_ref_cache(str(fasta), str(cache_dir), aln_files, ['chr2'])
+    assert (cache_dir / md5s['chr2'][:2] / md5s['chr2'][2:4] / md5s['chr2'][4:]).read_text() == 'GGCCTTAA'
+    assert not (cache_dir / md5s['chr1'][:2]).exists() and 'REF_CACHE' not in os.environ
+    # cached contigs of an unchanged reference are not read again (but are once it changes)
+    mtime = os.stat(fasta).st_mtime_ns
+    fasta.write_text('>chr1\nACGTACGTAC\n>chr2\nggcctTAT\n')
+    os.utime(fasta, ns=(mtime, mtime))
+    assert populate_ref_cache(str(fasta), str(cache_dir), aln_files, ['chr2'])
+    os.utime(fasta, ns=(0, 0))
+    assert not populate_ref_cache(str(fasta), str(cache_dir), aln_files, ['chr2'])
+
+def test_matrix_cache(tmp_path):
+    """ test cached VCF matrices load the same as parsing, with projection, and are refreshed when the VCF changes """
+    import os
+    import argparse
+    import pandas as pd
+    from savana.train import read_vcfs, load_matrix_cache, get_cache_path
+    (tmp_path / 'vcfs').mkdir()
+    vcf = tmp_path / 'vcfs' / 'test.vcf'
+    lines = [
+        '##fileformat=VCFv4.2',
+        '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="type">',
+        '##INFO=<ID=TUMOUR_DP,Number=.,Type=Float,Description="depth">',
+        '##INFO=<ID=LABEL,Number=1,Type=String,Description="label">',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO',
+        'chr1\t100\tID_1\tA\t<INS>\t.\tPASS\tSVTYPE=INS;TUMOUR_DP=10;LABEL=SOMATIC',
+        'chr1\t200\tID_2\tA\tN]chr2:50]\t.\tPASS\tTUMOUR_DP=8,12;LABEL=',
+    ]
+    vcf.write_text('\n'.join(lines) + '\n')
+    args = argparse.Namespace(vcfs=str(tmp_path / 'vcfs'), matrix_cache=str(tmp_path / 'cache'), threads=1, save_matrix=None)
+    parsed = read_vcfs(args)
+    cached = read_vcfs(args)
+    pd.testing.assert_frame_equal(parsed, cached)
+    assert cached['SVTYPE'].isna().tolist() == [False, True] and cached['LABEL'].tolist() == ['SOMATIC', '']
+    cache_path = get_cache_path(args.matrix_cache, str(vcf))
+    assert list(load_matrix_cache(cache_path, columns=['LABEL', 'TUMOUR_DP_1']).columns) == ['LABEL', 'TUMOUR_DP_1']
+    vcf.write_text('\n'.join(lines[:-1]) + '\n')
+    os.utime(vcf, ns=(0, 0))
+    assert len(read_vcfs(args)) == 1
+
+def test_get_within_buffer():
+    """ test the indexed compare set finds the same variants as a linear scan """
+    import random
+    from savana.evaluate import index_compare_set, get_within_buffer
+    random.seed(2)
+    compare_set = [{'start_chr': random.choice(['1', '2']), 'start_loc': random.randint(0, 5000)} for _ in range(300)]
+    compare_index = index_compare_set(compare_set)
+    for _ in range(200):
+        chrom, loc = random.choice(['1', '2']), random.randint(0, 5000)
+        expected = [(i, abs(v['start_loc'] - loc)) for i, v in enumerate(compare_set) if v['start_chr'] == chrom and abs(v['start_loc'] - loc) <= 100]
+        assert sorted(get_within_buffer(compare_index[chrom], loc, 100)) == expected
+
+def test_buffer_sweep():
+    """ test restricting the candidates of the largest buffer gives the same labels as matching with each buffer """
+    import random
+    from argparse import Namespace
+    from savana.evaluate import index_compare_set, get_within_buffer, set_buffer, assign_labels
+    random.seed(3)
+    args = Namespace(by_support=False, by_distance=True)
+    compare_set = [{'label': random.choice(['SOMATIC', 'GERMLINE']), 'id': f'C{i}', 'start_chr': '1', 'start_loc': random.randint(0, 5000)} for i in range(100)]
+    input_set = [{'id': f'I{i}', 'start_loc': random.randint(0, 5000)} for i in range(200)]
+    compare_index = index_compare_set(compare_set)
+    def match(buffer, key):
+        for variant in compare_set + input_set:
+            variant[key] = []
+        for input_variant in input_set:
+            for order, distance in sorted(get_within_buffer(compare_index['1'], input_variant['start_loc'], buffer)):
+                compare_set[order][key].append((input_variant, distance))
+                input_variant[key].append((compare_set[order], distance))
+    match(200, 'candidates')
+    for buffer in [10, 50, 200]:
+        set_buffer(compare_set + input_set, buffer)
+        swept_labels = assign_labels(args, compare_set)
+        match(buffer, 'within_buffer')
+        assert swept_labels == assign_labels(args, compare_set)
+
+def test_cluster_breakpoints_matches_sequential():
+    """ test the sweep-line clustering gives the same clusters as adding breakpoints one at a time """
+    import random
+    from savana.core import Cluster, PotentialBreakpoints
+    from savana.clusters import cluster_breakpoints
+    random.seed(0)
+    stores = [PotentialBreakpoints(['chr1', 'chr2']) for _ in range(3)]
+    for i in range(3000):
+        start = random.randint(0, 100000)
+        read_name = f'read_{random.randint(0, 1500)}'
+        store = random.choice(stores) # so read names repeat non-consecutively once concatenated
+        source = random.choice(["SUPP", "INS", "DEL"])
+        if source == "INS":
+            store.append([{'chr': 'chr1', 'loc': start}, {'chr': 'chr1', 'loc': start}], source, read_name, 60, 'tumour', "<INS>", 'A'*random.randint(1, 50))
+        elif source == "DEL":
+            store.append([{'chr': 'chr1', 'loc': start}, {'chr': 'chr1', 'loc': start+random.randint(1, 300)}], source, read_name, 60, 'normal', "+-")
+        else:
+            notation = random.choice(["+-", "++", "-+", "--"])
+            store.append([{'chr': 'chr1', 'loc': start}, {'chr': 'chr2', 'loc': random.randint(0, 20000)}], source, read_name, 60, 'tumour', notation)
+    # the same read twice (in different stores) isn't enough support for a cluster
+    for store in stores[:2]:
+        store.append([{'chr': 'chr1', 'loc': 200000}, {'chr': 'chr1', 'loc': 200100}], "DEL", 'read_twice', 60, 'tumour', "+-")
+    store = PotentialBreakpoints.concatenate(stores)
+    assert len(store.read_names) > len(set(store.read_names))
+    _, clusters = cluster_breakpoints('chr1', store, 10, 100)
+    # reference: one breakpoint at a time onto per-notation stacks
+    expected = {notation: [] for notation in clusters}
+    breakpoints = store.as_breakpoints()
+    breakpoints.sort()
+    for bp in breakpoints:
+        stack = expected[bp.breakpoint_notation]
+        if stack and stack[-1].overlaps(bp, 100 if bp.breakpoint_notation == "<INS>" else 10):
+            stack[-1].add(bp)
+        else:
+            stack.append(Cluster(bp))
+    for notation, stack in expected.items():
+        stack = [c for c in stack if len(c.supporting_reads) >= 2]
+        assert [(c.start, c.end, [str(bp) for bp in c.breakpoints]) for c in stack] == \
+            [(c.start, c.end, [str(bp) for bp in c.breakpoints]) for c in clusters[notation]]
+        assert [len(c.supporting_reads) for c in stack] == [len(c.supporting_reads) for c in clusters[notation]]
+    assert not any(c.start == 200000 for c in clusters["+-"])
+
+def test_sharded_clustering_matches_whole_chromosome():
+    """ test clustering shards split at safe gaps gives the same clusters as the whole chromosome """
+    import random
+    from savana.core import PotentialBreakpoints
+    from savana.clusters import cluster_breakpoints, shard_potential_breakpoints
+    random.seed(1)
+    store = PotentialBreakpoints(['chr1'])
+    for i in range(2000):
+        start = random.randint(0, 200000)
+        if random.random() < 0.5:
+            store.append([{'chr': 'chr1', 'loc': start}, {'chr': 'chr1', 'loc': start}], "INS", f'read_{i%700}', 60, 'tumour', "<INS>", 'ACGT')
+        else:
+            store.append([{'chr': 'chr1', 'loc': start}, {'chr': 'chr1', 'loc': start+random.randint(1, 200)}], "DEL", f'read_{i%700}', 60, 'tumour', "+-")
+    store.consolidate()
+    shards = shard_potential_breakpoints(store, 10, 100, 100)
+    assert len(shards) > 1
+    _, whole = cluster_breakpoints('chr1', store, 10, 100)
+    stitched = {notation: [] for notation in whole}
+    for shard in shards:
+        _, shard_clusters = cluster_breakpoints('chr1', shard, 10, 100)
+        for notation, stack in shard_clusters.items():
+            stitched[notation].extend(stack)
+    for notation, stack in whole.items():
+        assert [str(c) for c in stack] == [str(c) for c in stitched[notation]]
+
+def test_split_chunk():
+    """ test a re-split chunk is covered by contiguous pieces which only consider reads starting in them """
+    from savana.run import split_chunk
+    pieces = split_chunk((3, 'tumour', 'tumour.bam', 'chr1', 1001, 2000, True, 2500, 999.0), 4)
+    assert pieces[0][4] == 1001 and pieces[-1][5] == 2000
+    assert all(a[5] == b[4] for a, b in zip(pieces, pieces[1:]))
+    assert all(piece[0] == 3 and piece[6] == piece[4] and piece[7] == 2500 for piece in pieces)
+
+def test_region_chunks():
+    """ test candidate regions are merged and each read is only considered by the first region it overlaps (or one read before) """
+    from savana.run import merge_intervals, subtract_intervals, plan_region_chunks
+    regions = {'chr1': merge_intervals([(500, 700), (100, 300), (250, 400)]), 'chr2': [(0, 50)]}
+    assert regions['chr1'] == [(100, 400), (500, 700)]
+    chunks = plan_region_chunks('normal', 'normal.bam', regions, 5)
+    assert [chunk[0] for chunk in chunks] == [5, 6, 7]
+    assert [chunk[6] for chunk in chunks] == [None, 400, None]
+    # regions added later don't consider the reads overlapping those already read
+    new_regions = {'chr1': subtract_intervals([(50, 150), (350, 600), (800, 900)], regions['chr1'])}
+    assert new_regions['chr1'] == [(50, 100), (400, 500), (800, 900)]
+    chunks = plan_region_chunks('normal', 'normal.bam', new_regions, 8, regions)
+    assert [(chunk[6], chunk[7]) for chunk in chunks] == [(None, 100), (400, 500), (700, None)]
+
+def test_index_windows(tmp_path):
+    """ test the BAI linear index is read into windows holding the reads' compressed bytes and cut into contiguous chunks """
+    import os
+    import pysam
+    from savana.index import read_index_windows, split_by_bytes
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 500000}, {'SN': 'chr2', 'LN': 10000}, {'SN': 'chr3', 'LN': 10000}]}
+    bam = str(tmp_path / 'test.bam')
+    with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+        for i, (chrom, pos) in enumerate([(0, p) for p in range(0, 400000, 50)] + [(1, p) for p in range(0, 5000, 500)]):
+            read = pysam.AlignedSegment(f.header)
+            read.query_name, read.reference_id, read.reference_start = f'read_{i}', chrom, pos
+            read.query_sequence, read.cigarstring, read.mapping_quality = 'ACGT'*25, '100M', 60
+            f.write(read)
+    pysam.index(bam)
+    windows = read_index_windows(bam, ['chr1', 'chr2', 'chr3'], False)
+    assert list(windows.keys()) == ['chr1', 'chr2']
+    window_starts, window_bytes = windows['chr1']
+    assert window_starts[-1] < 400000 and (window_bytes >= 0).all()
+    assert 0.5 < window_bytes.sum()/os.path.getsize(bam) <= 1
+    chunks = split_by_bytes(window_starts, window_bytes, 500000, window_bytes.sum()/4)
+    assert chunks[0][0] == 0 and chunks[-1][1] == 500000 and all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+    assert 3 <= len(chunks) <= 5
+
+def test_targeted_normal_matches_default(tmp_path):
+    """ test reading the normal around the tumour evidence calls the same breakpoints as reading all of it """
+    import argparse
+    import random
+    import pysam
+    from savana.core import PotentialBreakpoints
+    from savana.run import pool_get_potential_breakpoints, pool_cluster_breakpoints, pool_call_breakpoints
+    random.seed(0)
+    contigs = {'chr1': 30000, 'chr2': 30000, 'chr3': 30000}
+    ref = str(tmp_path / 'ref.fa')
+    with open(ref, 'w') as f:
+        for chrom, length in contigs.items():
+            f.write(f'>{chrom}\n' + ''.join(random.choice('ACGT') for _ in range(length)) + '\n')
+    pysam.faidx(ref)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': chrom, 'LN': length} for chrom, length in contigs.items()]}
+    reads = {'tumour': [], 'normal': []}
+    def add_split_read(label, name, segments, primary):
+        # segments of (chrom, start, cigar with S for every clip) in read order
+        for i, (chrom, start, cigar) in enumerate(segments):
+            sa = ''.join(f'{c},{s+1},+,{g},60,0;' for j, (c, s, g) in enumerate(segments) if j != i)
+            reads[label].append((name, chrom, start, cigar if i == primary else cigar.replace('S', 'H'), i != primary, sa))
+    # a germline translocation, with some normal reads split across a third alignment whose primary is elsewhere
+    for i in range(6):
+        add_split_read('tumour', f'tl_{i}', [('chr1', 9000, '1000M1000S'), ('chr2', 20000, '1000S1000M')], 0)
+    for i in range(3):
+        add_split_read('normal', f'tl_{i}', [('chr1', 9000, '1000M1000S'), ('chr2', 20000, '1000S1000M')], 1)
+        add_split_read('normal', f'tl_three_{i}', [('chr1', 9000, '1000M2000S'), ('chr2', 20000, '1000S1000M1000S'), ('chr3', 5000, '2000S1000M')], 2)
+    # an insertion in the tumour, with normal evidence chaining past the tumour cluster
+    for i in range(3):
+        reads['tumour'].append((f'ins_{i}', 'chr1', 4900, '100M60I100M', False, None))
+    for i, loc in enumerate([5150, 5300, 5450, 5600]):
+        reads['normal'].append((f'ins_chain_{i}', 'chr1', loc-100, '100M60I100M', False, None))
+    aln_files = {}
+    for label, label_reads in reads.items():
+        bam = str(tmp_path / f'{label}.bam')
+        with pysam.AlignmentFile(bam, 'wb', header=header) as f:
+            for name, chrom, start, cigar, supplementary, sa in sorted(label_reads, key=lambda read: (read[1], read[2])):
+                read = pysam.AlignedSegment(f.header)
+                read.query_name, read.reference_name, read.reference_start = name, chrom, start
+                read.cigarstring, read.mapping_quality = cigar, 60
+                read.query_sequence = ''.join(random.choice('ACGT') for _ in range(read.infer_query_length()))
+                read.is_supplementary = supplementary
+                if sa:
+                    read.set_tag('SA', sa)
+                f.write(read)
+        pysam.index(bam)
+        aln_files[label] = bam
+    args = argparse.Namespace(threads=1, buffer=10, insertion_buffer=100, length=30, mapq=5, depth=3, contigs=None,
+        ref=ref, ref_index=ref+'.fai', is_cram=False, ref_cache=None, checkpoint_dir=None, coverage_dir=None, debug=False)
+    def call_breakpoints(targeted_normal):
+        args.targeted_normal = targeted_normal
+        results = pool_get_potential_breakpoints({label: pysam.AlignmentFile(bam, 'rb') for label, bam in aln_files.items()}, args)
+        clusters = pool_cluster_breakpoints(args.threads, args.buffer, args.insertion_buffer, PotentialBreakpoints.concatenate(results).split_by_chrom())
+        breakpoints, _ = pool_call_breakpoints(args.threads, args.buffer, args.length, args.depth, clusters, args.debug)
+        return sorted((bp.start_chr, bp.start_loc, bp.end_chr, bp.end_loc, bp.breakpoint_notation, bp.support['tumour'], bp.support['normal'])
+            for chrom_breakpoints in breakpoints.values() for bp in chrom_breakpoints if bp.support['tumour'])
+    default_breakpoints = call_breakpoints(False)
+    assert call_breakpoints(True) == default_breakpoints
+    # both breakpoints are germline and the normal evidence was all read
+    assert [bp[4] for bp in default_breakpoints] == ['<INS>', '+-']
+    assert [bp[6] for bp in default_breakpoints] == [4, 6]